@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time the circulation queries of library_sys (managers and admin list
+filters) on a large SQLite database, without and with the indexes added
+by migration 0027.
+
+    python benchmarks/circulation.py [--loans 1000000] [--copies 200000]
+                                     [--db /tmp/library_sys_bench.sqlite3]
+
+The database is seeded on the first run and reused by the next ones
+(remove the file to seed it again). Needs the requirements of the app,
+django-la-tags included, in the Python path.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+''' INDEXES ADDED BY 0027, AS (model, columns) '''
+INDEXES = [
+    ('Book', ['activated']),
+    ('BookItem', ['last_history_item_id']),
+    ('HistoryItem', ['date_due']),
+    ('HistoryItem', ['date_taken']),
+    ('HistoryItem', ['status', 'date_taken']),
+    ('HistoryItem', ['book_item_id', 'date_taken']),
+    ('HistoryItem', ['reader_id', 'date_taken']),
+]
+
+COPIES_PER_BOOK = 4
+READERS = 20000
+AUTHORS = 2000
+PUBLISHERS = 200
+
+
+def configure(db):
+    settings.configure(
+        SECRET_KEY='benchmark',
+        INSTALLED_APPS=[
+            'django.contrib.admin',
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'django.contrib.messages',
+            'tags',
+            'library_sys.apps.LibrarySysConfig',
+        ],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': db}},
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.'
+                               'DjangoTemplates',
+                    'APP_DIRS': True}],
+        LIBRARY_SYS_SEARCH_BACKEND='library_sys.search.MemoryBackend',
+    )
+    django.setup()
+
+
+def insert(model, fields, rows):
+    """
+    Raw ``executemany`` of ``rows`` into ``model``: far faster than
+    ``bulk_create`` for a million rows, and it skips ``save``.
+    """
+    from django.db import connection
+
+    qn = connection.ops.quote_name
+    columns = [model._meta.get_field(name).column for name in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table), ', '.join(qn(c) for c in columns),
+        ', '.join(['%s'] * len(columns)))
+
+    batch = []
+    with connection.cursor() as cursor:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == 10000:
+                cursor.executemany(sql, batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+
+
+def loan_plan(copy_id, loans_per_copy, today):
+    """
+    Loans of a copy, oldest first, as ``(reader_id, date_taken, date_due,
+    date_returned)``. Seeded by ``copy_id``, so it can be replayed.
+    """
+    rng = random.Random(copy_id)
+    count = rng.randint(max(loans_per_copy - 2, 1), loans_per_copy + 2)
+
+    taken = today - timedelta(days=rng.randint(0, 30))
+    loans = []
+    for i in range(count):
+        due = taken + timedelta(days=14)
+        if i == 0 and rng.random() < 0.3:
+            returned = None
+        else:
+            returned = min(taken + timedelta(days=rng.randint(1, 30)), today)
+        loans.append((rng.randint(1, READERS), taken, due, returned))
+        taken -= timedelta(days=rng.randint(31, 120))
+
+    return loans[::-1]
+
+
+def seed(loans, copies):
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from django.utils import timezone
+
+    from library_sys.models import (Author, Book, BookItem, HistoryItem,
+                                    Publisher, Reader, name_key)
+
+    today = date.today()
+    now = timezone.now()
+    books = copies // COPIES_PER_BOOK
+    loans_per_copy = max(loans // copies, 1)
+    rng = random.Random(0)
+
+    with transaction.atomic():
+        insert(Author, ['id', 'name', 'name_key'],
+               ((i, name, name_key(name)) for i, name in (
+                   (i, 'Autor(a) %s' % i) for i in range(1, AUTHORS + 1))))
+        insert(Publisher, ['id', 'name', 'name_key'],
+               ((i, name, name_key(name)) for i, name in (
+                   (i, 'Editora %s' % i) for i in range(1, PUBLISHERS + 1))))
+        insert(User, ['id', 'password', 'is_superuser', 'username',
+                      'first_name', 'last_name', 'email', 'is_staff',
+                      'is_active', 'date_joined'],
+               ((i, '!', False, 'leitor-%s' % i, '', '', '', False, True,
+                 now) for i in range(1, READERS + 1)))
+        insert(Reader, ['user_ptr', 'phone_number', 'address', 'name_key'],
+               ((i, '', '', name_key('leitor-%s' % i))
+                for i in range(1, READERS + 1)))
+        insert(Book, ['id', 'author', 'publisher', 'title', 'title_key',
+                      'slug', 'activated', 'available', 'book_item_total',
+                      'book_item_unavailable', 'created_at', 'updated_at',
+                      'cover_hash', 'file_hash'],
+               ((i, rng.randint(1, AUTHORS), rng.randint(1, PUBLISHERS),
+                 title, name_key(title), 'livro-%s' % i,
+                 rng.random() < 0.95, rng.random() < 0.95, 0, 0, now, now,
+                 '', '')
+                for i, title in ((i, 'Livro %s' % rng.randint(1, books))
+                                 for i in range(1, books + 1))))
+
+        def book_items():
+            history_item_id = 0
+            for copy_id in range(1, books * COPIES_PER_BOOK + 1):
+                plan = loan_plan(copy_id, loans_per_copy, today)
+                history_item_id += len(plan)
+                reader_id, taken, due, returned = plan[-1]
+                yield (copy_id, (copy_id - 1) // COPIES_PER_BOOK + 1,
+                       rng.random() < 0.97, history_item_id, reader_id,
+                       taken, due, returned, BookItem.UNAVAILABLE)
+
+        insert(BookItem, ['id', 'book', 'available', 'last_history_item_id',
+                          'last_reader_id', 'last_date_taken',
+                          'last_date_due', 'last_date_returned', 'status'],
+               book_items())
+
+        def history_items():
+            history_item_id = 0
+            for copy_id in range(1, books * COPIES_PER_BOOK + 1):
+                for reader_id, taken, due, returned in loan_plan(
+                        copy_id, loans_per_copy, today):
+                    history_item_id += 1
+                    if returned:
+                        status = HistoryItem.RETURNED
+                    elif due < today:
+                        status = HistoryItem.PENDING
+                    else:
+                        status = HistoryItem.BORROWED
+                    yield (history_item_id, copy_id, reader_id, taken, due,
+                           returned, 0, 1, False, status)
+
+        insert(HistoryItem, ['id', 'book_item', 'reader', 'date_taken',
+                             'date_due', 'date_returned', 'fine',
+                             'daily_fine', 'is_fine_paid', 'status'],
+               history_items())
+
+        ''' COUNTERS, THEN THE status OF EVERY COPY '''
+        Book.objects.recount_counters()
+
+
+def rolled_back(func):
+    def run():
+        from django.db import transaction
+
+        with transaction.atomic():
+            func()
+            transaction.set_rollback(True)
+    return run
+
+
+def cases():
+    from django.contrib import admin
+    from django.test import RequestFactory
+
+    from library_sys.admin import (BookAdminListFilterAvailable,
+                                   BookItemAdminListFilterAvailable,
+                                   HistoryItemAdminListFilterStatus)
+    from library_sys.models import Book, BookItem, HistoryItem, Reader
+
+    rng = random.Random(1)
+    request = RequestFactory().get('/')
+    book_ids = list(Book.objects.values_list('id', flat=True)[:100000])
+    copy_ids = list(BookItem.objects.values_list('id', flat=True)[:100000])
+    reader_ids = list(Reader.objects.values_list('id', flat=True)[:100000])
+    sample_books = rng.sample(book_ids, 100)
+    sample_copies = rng.sample(copy_ids, 100)
+    sample_readers = rng.sample(reader_ids, 100)
+
+    def admin_filter(model, list_filter, value):
+        model_admin = admin.site._registry[model]
+
+        def run():
+            params = {list_filter.parameter_name: str(value)}
+            queryset = list_filter(request, params, model, model_admin
+                                   ).queryset(request,
+                                              model_admin.get_queryset(request))
+            queryset.count()
+            if model_admin.list_select_related:
+                queryset = queryset.select_related(
+                    *model_admin.list_select_related)
+            list(queryset[:100])
+        return run
+
+    def latest_loans():
+        for copy_id in sample_copies:
+            HistoryItem.objects.filter(book_item=copy_id).latest('date_taken')
+
+    def reader_loans():
+        for reader_id in sample_readers:
+            list(HistoryItem.objects.filter(reader=reader_id).select_related(
+                'book_item__book')[:20])
+
+    def account_summaries():
+        for reader_id in sample_readers:
+            HistoryItem.objects.account_summary(reader_id)
+
+    def refresh_status():
+        BookItem.objects.filter(book_id__in=sample_books).refresh_status()
+
+    yield 'BookItem.obj_availables.titles()', \
+        lambda: list(BookItem.obj_availables.titles()[:20])
+    for value, label in BookItem.AVAILABLE_CHOICES:
+        yield 'BookItemAdmin filter: %s' % label, \
+            admin_filter(BookItem, BookItemAdminListFilterAvailable, value)
+    for value, label in HistoryItem.STATUS_CHOICES:
+        yield 'HistoryAdmin filter: %s' % label, \
+            admin_filter(HistoryItem, HistoryItemAdminListFilterStatus, value)
+    for value in (True, False):
+        yield 'BookAdmin filter: disponível=%s' % value, \
+            admin_filter(Book, BookAdminListFilterAvailable, value)
+    yield 'HistoryAdmin first page', \
+        lambda: list(HistoryItem.objects.select_related(
+            'book_item__book', 'reader')[:100])
+    yield 'Book.obj_active.count()', lambda: Book.obj_active.count()
+    yield 'latest loan of 100 copies', latest_loans
+    yield 'loans of 100 readers', reader_loans
+    yield 'account_summary of 100 readers', account_summaries
+    yield 'refresh_status of 100 books', refresh_status
+    yield 'HistoryItem.objects.mark_overdue()', rolled_back(
+        lambda: HistoryItem.objects.mark_overdue(
+            date.today() + timedelta(days=7)))
+    yield 'HistoryItem.objects.accrue_fines()', rolled_back(
+        HistoryItem.objects.accrue_fines)
+
+
+def timings(repeat):
+    result = {}
+    for name, func in cases():
+        best = None
+        for i in range(repeat):
+            started = time.time()
+            func()
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        result[name] = best * 1000
+        sys.stderr.write('.')
+        sys.stderr.flush()
+    sys.stderr.write('\n')
+    return result
+
+
+def drop_indexes():
+    """
+    Drop the indexes of ``INDEXES``, returning the SQL to create them
+    again.
+    """
+    from django.apps import apps
+    from django.db import connection
+
+    saved = []
+    with connection.cursor() as cursor:
+        for model_name, columns in INDEXES:
+            table = apps.get_model('library_sys', model_name)._meta.db_table
+            constraints = connection.introspection.get_constraints(cursor,
+                                                                   table)
+            for name, info in constraints.items():
+                if (info['index'] and not info['unique'] and
+                        info['columns'] == columns):
+                    cursor.execute("SELECT sql FROM sqlite_master "
+                                   "WHERE type = 'index' AND name = %s",
+                                   [name])
+                    saved.append(cursor.fetchone()[0])
+                    cursor.execute('DROP INDEX %s' %
+                                   connection.ops.quote_name(name))
+        cursor.execute('ANALYZE')
+    return saved
+
+
+def restore_indexes(saved):
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        for sql in saved:
+            cursor.execute(sql)
+        cursor.execute('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n\n')[0])
+    parser.add_argument('--db', default='/tmp/library_sys_bench.sqlite3')
+    parser.add_argument('--loans', type=int, default=1000000)
+    parser.add_argument('--copies', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    seeded = os.path.exists(args.db)
+    configure(args.db)
+
+    from django.core.management import call_command
+
+    call_command('migrate', verbosity=0)
+    if not seeded:
+        started = time.time()
+        seed(args.loans, args.copies)
+        sys.stderr.write('seeded in %.1fs\n' % (time.time() - started))
+
+    saved = drop_indexes()
+    try:
+        before = timings(args.repeat)
+    finally:
+        restore_indexes(saved)
+    after = timings(args.repeat)
+
+    print('%-40s %12s %12s %8s' % ('query', 'before (ms)', 'after (ms)', ''))
+    for name in before:
+        print('%-40s %12.1f %12.1f %7.1fx' % (
+            name, before[name], after[name],
+            before[name] / max(after[name], 0.001)))
+
+
+if __name__ == '__main__':
+    main()
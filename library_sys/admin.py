@@ -1,25 +1,152 @@
-from datetime import date
+from functools import reduce
+from operator import or_
 
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.contrib.auth.forms import UserChangeForm
 from django.contrib.auth.models import User
+from django.conf.urls import url
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.http import JsonResponse
+from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 from django.utils import formats
 from django.urls import reverse
-from django.db.models import F, Q, Min
 from django import forms
 
 from tags.forms import FormTags, set_tags
 
+from . import caching
+from .exports import export_action
+from .forms import UploadImageField
 from .models import (Author, Publisher, Book, BookItem,
-                     Reader, HistoryItem, Category)
+                     Reader, HistoryItem, Category, name_key, prefix_lookup,
+                     startswith)
+from .uploadhandlers import oversize_form
+
+
+def get_page(request):
+    try:
+        return max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return 1
+
+
+class AutocompleteMixin(object):
+    """
+    Select holding only the chosen rows. The others are searched page by
+    page from the view named ``url_name``.
+    """
+    class Media:
+        js = ('library_sys/js/autocomplete.js',)
+
+    def __init__(self, url_name, placeholder='Buscar', attrs=None):
+        super().__init__(attrs)
+        self.url_name = url_name
+        self.placeholder = placeholder
+
+    def render(self, name, value, attrs=None):
+        attrs = dict(attrs or {})
+        attrs['data-autocomplete-url'] = reverse(self.url_name)
+        attrs['data-autocomplete-placeholder'] = self.placeholder
+
+        queryset = getattr(self.choices, 'queryset', None)
+        if queryset is not None:
+            ''' READ ONLY THE CHOSEN ROWS, NOT THE WHOLE TABLE '''
+            field = self.choices.field
+            values = value if isinstance(value, (list, tuple)) else [value]
+            choices = []
+            if field.empty_label is not None:
+                choices.append(('', field.empty_label))
+            choices.extend(
+                (obj.pk, field.label_from_instance(obj))
+                for obj in queryset.filter(pk__in=[
+                    v for v in values if v not in (None, '')]))
+            self.choices = choices
+        return super().render(name, value, attrs)
+
+
+class AutocompleteSelect(AutocompleteMixin, forms.Select):
+    pass
+
 
+class AutocompleteSelectMultiple(AutocompleteMixin, forms.SelectMultiple):
+    pass
 
-class CategoryAdmin(admin.ModelAdmin):
+
+class AutocompleteAdminMixin(object):
+    """
+    ``autocomplete/`` view of the admin, for ``AutocompleteSelect``: rows
+    matching ``q``, one page at a time, as
+    ``{"results": [{"id": ..., "text": ...}], "more": bool}``. Pages are
+    cached for ``autocomplete_cache_timeout`` seconds, or until a row of
+    an autocompleted model is saved or deleted (see ``signals.py``).
+    """
+    autocomplete_page_size = 20
+    autocomplete_cache_timeout = 60
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urls = [
+            url(r'^autocomplete/$',
+                self.admin_site.admin_view(self.autocomplete_view),
+                name='%s_%s_autocomplete' % info),
+        ]
+        return urls + super().get_urls()
+
+    def get_autocomplete_queryset(self, request, query):
+        """
+        Rows with a field of ``search_fields`` starting with ``query``,
+        as typed, so their indexes serve, in the order of the changelist.
+        """
+        queryset = self.get_queryset(request)
+        if query:
+            queryset = queryset.filter(reduce(or_, [
+                prefix_lookup(queryset.db, field.lstrip('^=@'), query)
+                for field in self.search_fields
+            ], Q(pk__in=[])))
+        ordering = list(self.get_ordering(request) or
+                        self.model._meta.ordering)
+        return queryset.order_by(*ordering + ['pk'])
+
+    def autocomplete_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        query = ' '.join(request.GET.get('q', '').split())
+        page = get_page(request)
+
+        key = caching.make_key(caching.AUTOCOMPLETE,
+                               self.model._meta.model_name, query, page)
+        data = cache.get(key)
+        if data is None:
+            offset = (page - 1) * self.autocomplete_page_size
+            rows = list(self.get_autocomplete_queryset(request, query)[
+                offset:offset + self.autocomplete_page_size + 1])
+
+            data = {
+                'results': [{'id': obj.pk, 'text': str(obj)}
+                            for obj in rows[:self.autocomplete_page_size]],
+                'more': len(rows) > self.autocomplete_page_size,
+            }
+            cache.set(key, data, self.autocomplete_cache_timeout)
+
+        return JsonResponse(data)
+
+
+class CategoryAdmin(AutocompleteAdminMixin, admin.ModelAdmin):
     exclude = ['slug']
 
+    def get_autocomplete_queryset(self, request, query):
+        slug = slugify(query)
+        if query and not slug:
+            return Category.objects.none()
+        return startswith(Category.objects.all(), 'slug', slug).order_by(
+            'slug', 'id').only('id', 'title')
+
     def get_model_perms(self, request):
         """
         Return empty perms dict thus hiding the model from admin index.
@@ -27,12 +154,22 @@ class CategoryAdmin(admin.ModelAdmin):
         return {}
 
 
-class AuthorAdmin(admin.ModelAdmin):
-    pass
+class AuthorAdmin(AutocompleteAdminMixin, admin.ModelAdmin):
+    search_fields = ('name',)
 
+    def get_autocomplete_queryset(self, request, query):
+        queryset = Author.objects.prefix(query) if query else \
+            Author.objects.all()
+        return queryset.order_by('name_key', 'id').only('id', 'name')
 
-class PublisherAdmin(admin.ModelAdmin):
-    pass
+
+class PublisherAdmin(AutocompleteAdminMixin, admin.ModelAdmin):
+    search_fields = ('name',)
+
+    def get_autocomplete_queryset(self, request, query):
+        queryset = Publisher.objects.prefix(query) if query else \
+            Publisher.objects.all()
+        return queryset.order_by('name_key', 'id').only('id', 'name')
 
 
 class BookItemAdminListFilterAvailable(admin.SimpleListFilter):
@@ -47,34 +184,18 @@ class BookItemAdminListFilterAvailable(admin.SimpleListFilter):
     def queryset(self, request, queryset):
         if self.value():
             value = int(self.value())
-            if value == queryset.model.AVAILABLE:
-                return queryset.filter(
-                    Q(book__available=True) &
-                    Q(available=True) &
-                    Q(book__book_item_total__gt=F('book__book_item_unavailable')),
-                    Q(last_history_item_id__isnull=True) |
-                    Q(last_history_item_id__isnull=False) &
-                    Q(last_date_returned__isnull=False)
-                )
-            elif value == queryset.model.UNAVAILABLE:
-                return queryset.filter(
-                    Q(book__available=False) |
-                    Q(available=False) |
-                    Q(book__book_item_total=F('book__book_item_unavailable')) |
-                    Q(last_history_item_id__isnull=False) &
-                    Q(last_date_returned__isnull=True)
-                )
-            elif value == queryset.model.BORROWED:
-                return queryset.filter(
-                    last_history_item_id__isnull=False,
-                    last_date_returned__isnull=True
-                )
-            elif value == queryset.model.PENDING:
-                return queryset.filter(
-                    last_history_item_id__isnull=False,
-                    last_date_returned__isnull=True,
-                    last_date_due__lt=date.today()
-                )
+            model = queryset.model
+            if value == model.AVAILABLE:
+                return queryset.filter(status=model.AVAILABLE)
+            elif value == model.UNAVAILABLE:
+                return queryset.filter(status__in=[model.UNAVAILABLE,
+                                                   model.BORROWED,
+                                                   model.PENDING])
+            elif value == model.BORROWED:
+                return queryset.filter(status__in=[model.BORROWED,
+                                                   model.PENDING])
+            elif value == model.PENDING:
+                return queryset.filter(status=model.PENDING)
             else:
                 return queryset
         else:
@@ -84,19 +205,23 @@ class BookItemAdminListFilterAvailable(admin.SimpleListFilter):
 class BookItemAdmin(admin.ModelAdmin):
     fields = ('book', 'available', 'comments')
     list_display = ('__str__', 'available_check', 'comments', 'last_loan')
+    list_select_related = ('book__author', 'book__publisher', 'last_reader')
     search_fields = ('book__id', 'book__title', 'book__publisher__name',
                      'book__author__name', 'historyitem__reader__username')
     list_filter = [BookItemAdminListFilterAvailable]
 
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        if db_field.name == 'book':
+            kwargs['widget'] = AutocompleteSelect(
+                'admin:library_sys_book_autocomplete', 'Buscar por título')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
     def last_loan(self, obj):
-        obj_available = self.model.obj_availables.filter(id=obj.id)
         link_borrow = '''<a href="%s?book_item_id=%s" target="_blank">
             [Emprestar]</a>''' % (reverse('admin:library_sys_historyitem_add'),
                                   obj.id)
         if not obj.last_history_item_id:
-            return link_borrow if obj_available else '-'
-
-        reader = Reader.objects.get(id=obj.last_reader_id)
+            return link_borrow if obj.status == BookItem.AVAILABLE else '-'
 
         if not obj.last_date_returned:
             link_borrow = ''
@@ -104,7 +229,7 @@ class BookItemAdmin(admin.ModelAdmin):
                                                   obj.last_date_due,
                                                   "SHORT_DATE_FORMAT")
         else:
-            link_borrow = '%s<hr>' % link_borrow if obj_available else ''
+            link_borrow = '%s<hr>' % link_borrow if obj.status == BookItem.AVAILABLE else ''
             status = 'devolvido em %s' % formats.date_format(
                                              obj.last_date_returned,
                                              "SHORT_DATE_FORMAT")
@@ -117,25 +242,31 @@ class BookItemAdmin(admin.ModelAdmin):
                ''' % (link_borrow, link,
                       formats.date_format(obj.last_date_taken,
                                           "DATE_FORMAT"),
-                      reader, status)
+                      obj.last_reader, status)
     last_loan.allow_tags = True
     last_loan.short_description = 'Último empréstimo'
 
     def available_check(self, obj):
-        return True if BookItem.obj_availables.filter(id=obj.id) else False
+        return obj.status == BookItem.AVAILABLE
 
     available_check.boolean = True
     available_check.allow_tags = True
     available_check.short_description = 'disponível'
 
     '''
-    Disabled actions to prevent erros in update of models.Book.book_item_total
-    when BookItem is deleted.
+    Disabled delete action to prevent erros in update of
+    models.Book.book_item_total when BookItem is deleted.
     The posible solution to call delete method of model when user want remove
     items selected found here but i prefer unable the actions:
     http://stackoverflow.com/questions/1471909/django-model-delete-not-triggered
     '''
-    actions = None
+    actions = [export_action('book_items', 'csv'),
+               export_action('book_items', 'jsonl')]
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
 
 
 class BookAdminListFilterAvailable(admin.SimpleListFilter):
@@ -149,14 +280,12 @@ class BookAdminListFilterAvailable(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value():
+            available_ids = BookItem.objects.filter(
+                status=BookItem.AVAILABLE).order_by().values('book_id')
             if self.value() == 'True':
-                return queryset.filter(available__exact=True,
-                    book_item_total__gt=F('book_item_unavailable'))
+                return queryset.filter(id__in=available_ids)
             else:
-                return queryset.filter(
-                    Q(available__exact=False) |
-                    Q(book_item_total__exact=F('book_item_unavailable')) &
-                    Q(book_item_unavailable__gt=0))
+                return queryset.exclude(id__in=available_ids)
         else:
             return queryset
 
@@ -165,9 +294,10 @@ class BookForm(FormTags):
     class Meta:
         model = Book
         fields = '__all__'
+        field_classes = {'cover': UploadImageField}
 
 
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(AutocompleteAdminMixin, admin.ModelAdmin):
     fieldsets = [
         (None,
          {'fields': ['title', 'author', 'publisher', 'year', 'book_item_total',
@@ -181,10 +311,37 @@ class BookAdmin(admin.ModelAdmin):
                     'activated', 'book_item_link',
                     'available_items')
     search_fields = ('title', 'author__name', 'publisher__name')
-    filter_horizontal = ('category',)
     list_filter = ['activated', BookAdminListFilterAvailable]
 
     form = BookForm
+    actions = [export_action('books', 'csv'), export_action('books', 'jsonl')]
+
+    def get_autocomplete_queryset(self, request, query):
+        key = name_key(query)
+        if query and not key:
+            return Book.objects.none()
+        return startswith(Book.objects.select_related('author'), 'title_key',
+                          key).order_by('title_key', 'id').only(
+            'id', 'title', 'author__name')
+
+    def get_form(self, request, obj=None, **kwargs):
+        return oversize_form(super().get_form(request, obj, **kwargs),
+                             request)
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        if db_field.name == 'author':
+            kwargs['widget'] = AutocompleteSelect(
+                'admin:library_sys_author_autocomplete', 'Buscar autor(a)')
+        elif db_field.name == 'publisher':
+            kwargs['widget'] = AutocompleteSelect(
+                'admin:library_sys_publisher_autocomplete', 'Buscar editora')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        if db_field.name == 'category':
+            kwargs['widget'] = AutocompleteSelectMultiple(
+                'admin:library_sys_category_autocomplete', 'Buscar categoria')
+        return super().formfield_for_manytomany(db_field, request, **kwargs)
 
     def save_model(self, request, obj, form, change):
         super().save_model(request, obj, form, change)
@@ -244,7 +401,7 @@ class Meta:
     model = Reader
 
 
-class ReaderAdmin(UserAdmin):
+class ReaderAdmin(AutocompleteAdminMixin, UserAdmin):
     form = ReaderChangeForm
     list_display = ('username', 'first_name',
                     'is_staff', 'is_active')
@@ -259,36 +416,34 @@ class ReaderAdmin(UserAdmin):
     )
     search_fields = ('username', 'first_name', 'last_name')
 
+    def get_autocomplete_queryset(self, request, query):
+        key = name_key(query)
+        if query and not key:
+            return Reader.objects.none()
+        return startswith(Reader.objects.all(), 'name_key', key).order_by(
+            'name_key', 'pk')
+
 
 class HistoryBookItemAvailableForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        field = self.fields['book_item']
         if self.instance.id:
-            choices = [(self.instance.book_item.id, self.instance.book_item)]
-        elif 'book_item_id' in kwargs['initial']:
-            book_item = BookItem.obj_availables.filter(
-                            id=kwargs['initial']['book_item_id'])
-            #import pdb;pdb.set_trace()
-            choices = [(None, '')] if not book_item else [(book_item[0].id,
-                                                           book_item[0])]
+            book_item_id = self.instance.book_item_id
+            choices = []
         else:
+            field.queryset = BookItem.obj_availables.all()
+            book_item_id = (self.data.get(self.add_prefix('book_item')) or
+                            self.initial.get('book_item_id'))
             choices = [(None, '')]
 
-        book_item_available = BookItem.obj_availables.values(
-                 'book_id',
-                 'book__title',
-                 'book__author__name',
-                 'book__publisher__name'
-        ).annotate(id_min=Min('id'))
-
-        for x in book_item_available:
-            label = '%s (%s - %s)' % (
-                        x['book__title'],
-                        x['book__author__name'],
-                        x['book__publisher__name']
-                    )
-            choices.append((x['id_min'], label))
+        if book_item_id:
+            book_item = field.queryset.select_related(
+                'book__author', 'book__publisher').filter(
+                id=book_item_id).first()
+            if book_item:
+                choices = [(book_item.id, book_item)]
 
         self.fields['book_item'].choices = choices
 
@@ -309,19 +464,86 @@ class HistoryItemAdminListFilterStatus(admin.SimpleListFilter):
     def queryset(self, request, queryset):
         if self.value():
             value = int(self.value())
-            if value == queryset.model.RETURNED:
-                return queryset.filter(date_returned__isnull=False)
-            elif value == queryset.model.BORROWED:
-                return queryset.filter(date_returned__isnull=True)
-            elif value == queryset.model.PENDING:
-                return queryset.filter(date_returned__isnull=True,
-                                       date_due__lt=date.today())
+            model = queryset.model
+            if value == model.RETURNED:
+                return queryset.filter(status=model.RETURNED)
+            elif value == model.BORROWED:
+                return queryset.filter(status__in=[model.BORROWED,
+                                                   model.PENDING])
+            elif value == model.PENDING:
+                return queryset.filter(status=model.PENDING)
             else:
                 return queryset
         else:
             return queryset
 
 
+class RelatedValuesListFilter(admin.SimpleListFilter):
+    """
+    Filter by the foreign key ``parameter_name``, listing only the values
+    found in the first ``scan_size`` rows of the current result set (at
+    most ``max_values`` of them) instead of every row of the related
+    table. Other values are reached through the search box.
+    """
+    scan_size = 500
+    max_values = 20
+    label_fields = ()
+
+    def lookups(self, request, model_admin):
+        ''' FILLED IN choices(), ONCE THE RESULT SET IS KNOWN '''
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.parameter_name: self.value()})
+        return queryset
+
+    def label(self, row):
+        return ' '.join(str(value) for value in row if value)
+
+    def related_model(self, model):
+        for name in self.parameter_name.split('__'):
+            model = model._meta.get_field(name).related_model
+        return model
+
+    def choices(self, changelist):
+        values = {}
+        rows = changelist.queryset.values_list(
+            '%s_id' % self.parameter_name, *self.label_fields)
+        for row in rows[:self.scan_size]:
+            if row[0] is not None and row[0] not in values:
+                values[row[0]] = self.label(row[1:])
+                if len(values) == self.max_values:
+                    break
+
+        if self.value() and self.value() not in map(str, values):
+            ''' FROM THE RELATED TABLE: NO ROW OF THE RESULT SET MAY HAVE IT '''
+            prefix = len(self.parameter_name) + 2
+            row = self.related_model(changelist.model).objects.filter(
+                pk=self.value()).values_list(
+                *[field[prefix:] for field in self.label_fields]).first()
+            values[self.value()] = self.label(row) if row else self.value()
+
+        self.lookup_choices = sorted(values.items(), key=lambda x: x[1])
+        return super().choices(changelist)
+
+
+class HistoryItemAdminListFilterReader(RelatedValuesListFilter):
+    title = 'usuári@'
+    parameter_name = 'reader'
+    label_fields = ('reader__username', 'reader__first_name',
+                    'reader__last_name')
+
+
+class HistoryItemAdminListFilterBook(RelatedValuesListFilter):
+    title = 'livro'
+    parameter_name = 'book_item__book'
+    label_fields = ('book_item__book__title',)
+
+
 class HistoryAdmin(admin.ModelAdmin):
 
     form = HistoryBookItemAvailableForm
@@ -331,8 +553,8 @@ class HistoryAdmin(admin.ModelAdmin):
     list_display = ('book_item', 'reader', 'date_taken', 'date_due',
                     'date_returned')
     list_filter = (HistoryItemAdminListFilterStatus,
-                   'reader__username',
-                   'reader', 'book_item__book')
+                   HistoryItemAdminListFilterReader,
+                   HistoryItemAdminListFilterBook)
     search_fields = (
         'reader__first_name',
         'reader__last_name',
@@ -341,7 +563,69 @@ class HistoryAdmin(admin.ModelAdmin):
         'book_item__book__author__name',
     )
 
-    actions = None
+    ''' NO DELETE ACTION, FOR THE SAME REASON AS BookItemAdmin '''
+    actions = [export_action('history_items', 'csv'),
+               export_action('history_items', 'jsonl')]
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    book_item_page_size = 20
+    book_item_cache_timeout = 5 * 60
+
+    def get_urls(self):
+        urls = [
+            url(r'^available_book_items/$',
+                self.admin_site.admin_view(self.available_book_items_view),
+                name='library_sys_historyitem_available_book_items'),
+        ]
+        return urls + super().get_urls()
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        if db_field.name == 'book_item':
+            kwargs['widget'] = AutocompleteSelect(
+                'admin:library_sys_historyitem_available_book_items',
+                'Buscar por título, autor(a) ou editora')
+        elif db_field.name == 'reader':
+            kwargs['widget'] = AutocompleteSelect(
+                'admin:library_sys_reader_autocomplete', 'Buscar usuári@')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def available_book_items_view(self, request):
+        """
+        Titles with an available copy matching ``q``, one page at a time,
+        as ``{"results": [{"id": ..., "text": ...}], "more": bool}``.
+
+        Pages are cached until a loan, a copy or a book changes.
+        """
+        if not (self.has_add_permission(request) or
+                self.has_change_permission(request)):
+            raise PermissionDenied
+
+        query = ' '.join(request.GET.get('q', '').lower().split())
+        page = get_page(request)
+
+        key = caching.make_key(caching.AVAILABILITY, 'titles', query, page)
+        data = cache.get(key)
+        if data is None:
+            offset = (page - 1) * self.book_item_page_size
+            rows = list(BookItem.obj_availables.titles(query)[
+                offset:offset + self.book_item_page_size + 1])
+
+            data = {
+                'results': [{
+                    'id': x['id_min'],
+                    'text': '%s (%s - %s)' % (x['book__title'],
+                                              x['book__author__name'],
+                                              x['book__publisher__name'])
+                } for x in rows[:self.book_item_page_size]],
+                'more': len(rows) > self.book_item_page_size,
+            }
+            cache.set(key, data, self.book_item_cache_timeout)
+
+        return JsonResponse(data)
 
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Author, AuthorAdmin)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class LibrarySysConfig(AppConfig):
     name = 'library_sys'
     verbose_name = 'Biblioteca'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,83 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+''' NAMESPACES OF CACHED DATA '''
+AUTOCOMPLETE = 'autocomplete'
+AVAILABILITY = 'availability'
+BOOK_DETAILS = 'book_details'
+READER_ACCOUNT = 'reader_account'
+
+KEY_PREFIX = 'library_sys'
+
+
+def _version_key(namespace):
+    return '%s:%s:version' % (KEY_PREFIX, namespace)
+
+
+def get_version(namespace):
+    """
+    Return the current generation of ``namespace``. Keys built with
+    ``make_key`` are dropped all at once by bumping it.
+    """
+    key = _version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def _changed_key(namespace):
+    return '%s:%s:changed' % (KEY_PREFIX, namespace)
+
+
+def get_changed_at(namespace):
+    """
+    Return when ``namespace`` was last invalidated, as a timestamp. After
+    the cache is emptied it is the time of the first call, so it never
+    goes back.
+    """
+    key = _changed_key(namespace)
+    changed_at = cache.get(key)
+    if changed_at is None:
+        cache.add(key, time.time(), None)
+        changed_at = cache.get(key, time.time())
+    return changed_at
+
+
+def make_key(namespace, *parts):
+    """
+    Build a key of ``namespace`` safe for any cache backend (``parts`` may
+    hold user input, so they are hashed).
+    """
+    digest = hashlib.md5(
+        ':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return '%s:%s:%s:%s' % (KEY_PREFIX, namespace, get_version(namespace),
+                            digest)
+
+
+def invalidate(namespace):
+    """
+    Bump the generation of ``namespace`` once the current transaction
+    commits, so no one can cache rows about to be rolled back.
+    """
+    def bump():
+        key = _version_key(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 2, None)
+        cache.set(_changed_key(namespace), time.time(), None)
+
+    transaction.on_commit(bump)
+
+
+def invalidate_key(namespace, *parts):
+    """
+    Drop the single key of ``namespace`` built from ``parts`` once the
+    current transaction commits.
+    """
+    transaction.on_commit(lambda: cache.delete(make_key(namespace, *parts)))
@@ -0,0 +1,136 @@
+"""
+Delivery of ``Book.file``.
+
+Settings:
+
+- ``LIBRARY_SYS_SENDFILE``: ``'x-accel-redirect'`` (nginx) or
+  ``'x-sendfile'`` (Apache mod_xsendfile, lighttpd) to let the web server
+  send the file, ranges included. By default Django streams it.
+- ``LIBRARY_SYS_SENDFILE_PREFIX``: internal location of ``MEDIA_ROOT`` for
+  ``X-Accel-Redirect``, by default ``'/protected/'``.
+"""
+import hashlib
+import mimetypes
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+SENDFILE = getattr(settings, 'LIBRARY_SYS_SENDFILE', None)
+SENDFILE_PREFIX = getattr(settings, 'LIBRARY_SYS_SENDFILE_PREFIX',
+                          '/protected/')
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def content_hash(field_file):
+    """
+    SHA-1 of the content of ``field_file``, read in chunks.
+    """
+    digest = hashlib.sha1()
+    field_file.open('rb')
+    try:
+        for chunk in field_file.chunks():
+            digest.update(chunk)
+    finally:
+        field_file.seek(0)
+    return digest.hexdigest()
+
+
+def parse_range(header, size):
+    """
+    ``(first, last)`` byte positions of a single range ``header`` of a
+    file of ``size`` bytes. ``None`` when the whole file should be sent
+    (no header, several ranges or a syntax error), ``()`` when the range
+    cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    if not size:
+        return ()
+
+    first, last = match.groups()
+    if not first:
+        ''' SUFFIX RANGE: THE LAST BYTES '''
+        if not int(last):
+            return ()
+        return max(size - int(last), 0), size - 1
+
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        return () if first >= size else None
+    return first, last
+
+
+def _read_range(field_file, first, last):
+    try:
+        field_file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = field_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        field_file.close()
+
+
+def serve(request, field_file, etag, filename):
+    """
+    Response with ``field_file``, validated by the strong ``etag``:
+    ``304`` for a matching ``If-None-Match``, ``206`` for a single range
+    (unless ``If-Range`` names another version), ``416`` for a range past
+    the end, and the whole file otherwise. The web server sends the bytes
+    when ``LIBRARY_SYS_SENDFILE`` is set.
+    """
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        content_type = (mimetypes.guess_type(field_file.name)[0] or
+                        'application/octet-stream')
+
+        if SENDFILE == 'x-accel-redirect':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = SENDFILE_PREFIX + field_file.name
+        elif SENDFILE == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = field_file.path
+        else:
+            size = field_file.size
+            byte_range = None
+            if request.META.get('HTTP_IF_RANGE', quote_etag(etag)) == \
+                    quote_etag(etag):
+                byte_range = parse_range(request.META.get('HTTP_RANGE'),
+                                         size)
+
+            if byte_range == ():
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%s' % size
+            elif byte_range:
+                first, last = byte_range
+                field_file.open('rb')
+                response = StreamingHttpResponse(
+                    _read_range(field_file, first, last), status=206,
+                    content_type=content_type)
+                response['Content-Range'] = 'bytes %s-%s/%s' % (first, last,
+                                                                size)
+                response['Content-Length'] = last - first + 1
+            else:
+                ''' THE WSGI SERVER MAY USE sendfile() FOR THE WHOLE FILE '''
+                field_file.open('rb')
+                response = FileResponse(field_file.file,
+                                        content_type=content_type)
+                response['Content-Length'] = size
+            response['Accept-Ranges'] = 'bytes'
+
+        if response.status_code != 416:
+            response['Content-Disposition'] = (
+                'attachment; filename="%s"' % filename)
+
+    response['ETag'] = quote_etag(etag)
+    return response
@@ -1,3 +1,4 @@
+from django import forms
 from django.contrib.auth import login, logout
 from django.contrib.auth.forms import AuthenticationForm
 from django.shortcuts import render_to_response, redirect
@@ -23,3 +24,15 @@ class LogoutView(View):
             return render_to_response("logout.html")
         else:
             return redirect("/index/")
+
+
+class UploadImageField(forms.ImageField):
+    """
+    ``ImageField`` that leaves uploads dropped by ``MaxSizeUploadHandler``
+    to the size check of the model validators, without opening them with
+    Pillow.
+    """
+    def to_python(self, data):
+        if getattr(data, 'oversize', False):
+            return forms.FileField.to_python(self, data)
+        return super().to_python(data)
@@ -0,0 +1,379 @@
+"""
+Bulk import of catalogue records into ``Book`` and ``BookItem``.
+
+Readers turn CSV, MARC21 (ISO 2709) or ONIX (2.1 and 3.0, reference
+tags) files into record dicts one at a time::
+
+    {'title': ..., 'author': ..., 'publisher': ..., 'year': ...,
+     'isbn': ..., 'categories': [...], 'synopsis': ..., 'copies': ...}
+
+``CatalogueImporter`` writes them in batches, each in one transaction
+with its ``ImportCheckpoint``, so an interrupted import resumes after the
+last committed batch. Nothing but the current batch and the bounded name
+caches is held in memory.
+"""
+import csv
+import re
+from collections import Counter
+from datetime import date
+from functools import reduce
+from itertools import islice
+from operator import or_
+from xml.etree.ElementTree import iterparse
+
+from django.db import transaction
+from django.db.models import Q
+from django.template.defaultfilters import slugify
+
+from . import caching
+from .models import Author, Book, BookItem, Category, Publisher, name_key
+from .signals import update_search_index
+
+FIELD_TERMINATOR = b'\x1e'
+SUBFIELD_DELIMITER = b'\x1f'
+
+YEAR_RE = re.compile(r'\d{4}')
+
+''' ONIX 3.0; ONIX 2.1 PATHS START AT Title/ '''
+TITLE_ELEMENT = 'DescriptiveDetail/TitleDetail/TitleElement/'
+
+
+def clean_text(value, max_length=None):
+    """
+    ``value`` with collapsed whitespace and without the trailing
+    punctuation of catalogue records ("Assis, Machado de," "Ática :").
+    """
+    value = ' '.join((value or '').split()).rstrip(' ,.;:/')
+    return value[:max_length] if max_length else value
+
+
+def clean_year(value):
+    match = YEAR_RE.search(str(value or ''))
+    if match and 1564 <= int(match.group()) <= date.today().year:
+        return int(match.group())
+    return None
+
+
+''' READERS '''
+
+
+def read_csv(stream, delimiter=','):
+    """
+    Records of a CSV file with a header row naming the record keys;
+    ``categories`` are separated by ``;``.
+    """
+    for row in csv.DictReader(stream, delimiter=delimiter):
+        row = {(key or '').strip().lower(): value
+               for key, value in row.items()}
+        row['categories'] = (row.get('categories') or '').split(';')
+        yield row
+
+
+def read_marc(stream):
+    """
+    Records of a binary MARC21 file. MARC-8 records are read as Latin-1.
+    """
+    while True:
+        length = stream.read(5).lstrip()
+        while length and len(length) < 5:
+            more = stream.read(5 - len(length))
+            if not more:
+                break
+            length += more
+        if len(length) < 5:
+            return
+
+        record = length + stream.read(int(length) - 5)
+        encoding = 'utf-8' if record[9:10] == b'a' else 'latin-1'
+        base = int(record[12:17])
+        directory = record[24:base - 1]
+
+        fields = {}
+        for i in range(0, len(directory) - 11, 12):
+            tag = directory[i:i + 3].decode('ascii')
+            size = int(directory[i + 3:i + 7])
+            start = base + int(directory[i + 7:i + 12])
+            if tag < '010':
+                continue
+            data = record[start:start + size].rstrip(FIELD_TERMINATOR)
+            subfields = {}
+            for subfield in data.split(SUBFIELD_DELIMITER)[1:]:
+                subfields.setdefault(subfield[:1].decode('ascii', 'replace'),
+                                     subfield[1:].decode(encoding, 'replace'))
+            fields.setdefault(tag, []).append(subfields)
+
+        def first(*tags, code='a'):
+            for tag in tags:
+                for subfields in fields.get(tag, []):
+                    if subfields.get(code):
+                        return subfields[code]
+            return None
+
+        yield {
+            'title': ' '.join(filter(None, [first('245'),
+                                            first('245', code='b')])),
+            'author': first('100', '110', '111', '700', '710'),
+            'publisher': first('264', '260', code='b'),
+            'year': first('264', '260', code='c'),
+            'isbn': (first('020') or '').split(' ')[0],
+            'categories': [subfields.get('a')
+                           for subfields in fields.get('650', [])],
+            'synopsis': first('520'),
+        }
+
+
+def read_onix(stream):
+    """
+    Records of the ``<Product>`` elements of an ONIX file, each dropped
+    from the tree once read.
+    """
+    def text(element, *paths):
+        for path in paths:
+            value = element.findtext(path)
+            if value and value.strip():
+                return value
+        return None
+
+    root = None
+    for event, element in iterparse(stream, events=('start', 'end')):
+        if root is None:
+            root = element
+        if event == 'start':
+            continue
+
+        ''' DROP NAMESPACES, SO PATHS WORK WITH AND WITHOUT THEM '''
+        element.tag = element.tag.rsplit('}', 1)[-1]
+        if element.tag != 'Product':
+            continue
+
+        product = element
+        contributors = (product.findall('DescriptiveDetail/Contributor') or
+                        product.findall('Contributor'))
+        contributors.sort(key=lambda c: c.findtext('ContributorRole') != 'A01')
+        author = None
+        for contributor in contributors:
+            author = (text(contributor, 'PersonName', 'CorporateName') or
+                      ' '.join(filter(None, [
+                          contributor.findtext('NamesBeforeKey'),
+                          contributor.findtext('KeyNames')])))
+            if author:
+                break
+
+        isbn = None
+        for identifier in product.findall('ProductIdentifier'):
+            if identifier.findtext('ProductIDType') in ('15', '02'):
+                isbn = identifier.findtext('IDValue')
+                break
+
+        title = text(product, TITLE_ELEMENT + 'TitleText', 'Title/TitleText')
+        if not title:
+            title = ' '.join(filter(None, [
+                text(product, TITLE_ELEMENT + 'TitlePrefix',
+                     'Title/TitlePrefix'),
+                text(product, TITLE_ELEMENT + 'TitleWithoutPrefix',
+                     'Title/TitleWithoutPrefix'),
+            ]))
+
+        yield {
+            'title': title,
+            'author': author,
+            'publisher': text(product, 'PublishingDetail/Publisher/'
+                                       'PublisherName',
+                              'Publisher/PublisherName'),
+            'year': text(product, 'PublishingDetail/PublishingDate/Date',
+                         'PublicationDate'),
+            'isbn': isbn,
+            'categories': [subject.findtext('SubjectHeadingText')
+                           for subject in product.iter('Subject')],
+            'synopsis': text(product, 'CollateralDetail/TextContent/Text',
+                             'OtherText/Text'),
+        }
+        root.clear()
+
+
+READERS = {
+    'csv': read_csv,
+    'marc': read_marc,
+    'onix': read_onix,
+}
+
+
+''' WRITERS '''
+
+
+class NameCache(object):
+    """
+    ``name -> id`` of the rows of ``model``, matched by ``key_field``
+    holding ``key(name)`` (the name itself by default) and creating the
+    missing ones in bulk. Emptied when it holds ``max_size`` keys, to
+    bound memory.
+    """
+
+    def __init__(self, model, field='name', key_field=None, key=None,
+                 max_size=100000, **defaults):
+        self.model = model
+        self.field = field
+        self.key_field = key_field or field
+        self.key = key or (lambda name: name)
+        self.max_size = max_size
+        self.defaults = defaults
+        self.ids = {}
+
+    def _fetch(self, keys):
+        for key, id in self.model.objects.filter(**{
+                '%s__in' % self.key_field: keys
+        }).order_by('-id').values_list(self.key_field, 'id'):
+            ''' THE OLDEST ROW WINS WHEN KEYS REPEAT '''
+            self.ids[key] = id
+
+    def make(self, name):
+        values = {key: make(name) for key, make in self.defaults.items()}
+        values[self.field] = name
+        values[self.key_field] = self.key(name)
+        return self.model(**values)
+
+    def get_ids(self, names):
+        """
+        ``{name: id}`` of ``names``, created when missing.
+        """
+        keys = {name: self.key(name) for name in set(names)}
+        if len(self.ids) + len(keys) > self.max_size:
+            self.ids.clear()
+
+        missing = {key: name for name, key in keys.items()
+                   if key not in self.ids}
+        if missing:
+            self._fetch(list(missing))
+            missing = {key: name for key, name in missing.items()
+                       if key not in self.ids}
+            if missing:
+                self.model.objects.bulk_create(
+                    [self.make(name) for name in missing.values()])
+                self._fetch(list(missing))
+        return {name: self.ids[key] for name, key in keys.items()}
+
+
+def unique_slugs(titles):
+    """
+    Slugs of ``titles`` not used by any book nor by each other, following
+    ``Book.get_unique_slug``, with a few queries for the whole batch.
+    """
+    bases = [slugify(title)[:190] or 'livro' for title in titles]
+    taken = set(Book.objects.filter(slug__in=set(bases)).values_list(
+        'slug', flat=True))
+
+    counts = Counter(bases)
+    repeated = sorted(base for base in counts
+                      if base in taken or counts[base] > 1)
+    for i in range(0, len(repeated), 100):
+        ''' RANGES RATHER THAN LIKE, SO THE UNIQUE INDEX IS USED '''
+        taken.update(Book.objects.filter(reduce(or_, [
+            Q(slug__gt=base + '-', slug__lt=base + '.')
+            for base in repeated[i:i + 100]
+        ])).values_list('slug', flat=True))
+
+    slugs = []
+    for base in bases:
+        unique, i = base, 2
+        while unique in taken:
+            unique = '%s-%s' % (base, i)
+            i += 1
+        taken.add(unique)
+        slugs.append(unique)
+    return slugs
+
+
+class CatalogueImporter(object):
+    """
+    Write catalogue records in batches of ``batch_size``. Records without
+    title, author or publisher are skipped. ``copies`` is the number of
+    copies of records that do not tell it.
+    """
+
+    def __init__(self, batch_size=500, copies=1):
+        self.batch_size = batch_size
+        self.copies = copies
+        self.authors = NameCache(Author, key_field='name_key', key=name_key)
+        self.publishers = NameCache(Publisher, key_field='name_key',
+                                    key=name_key)
+        self.categories = NameCache(Category, 'title', slug=slugify)
+
+    def clean(self, record):
+        try:
+            copies = int(record.get('copies') or self.copies)
+        except ValueError:
+            copies = self.copies
+
+        record = {
+            'title': clean_text(record.get('title'), 100),
+            'author': clean_text(record.get('author'), 200),
+            'publisher': clean_text(record.get('publisher'), 200),
+            'year': clean_year(record.get('year')),
+            'isbn': clean_text(record.get('isbn'), 30) or None,
+            'categories': sorted({clean_text(c, 160) for c in
+                                  record.get('categories') or []} - {''}),
+            'synopsis': (record.get('synopsis') or '').strip() or None,
+            'copies': min(max(copies, 1), 1000),
+        }
+        if record['title'] and record['author'] and record['publisher']:
+            return record
+        return None
+
+    def write_batch(self, records):
+        """
+        Insert the books and copies of ``records``. Returns the new book
+        ids.
+        """
+        if not records:
+            return []
+
+        authors = self.authors.get_ids(r['author'] for r in records)
+        publishers = self.publishers.get_ids(r['publisher'] for r in records)
+        categories = self.categories.get_ids(
+            c for r in records for c in r['categories'])
+
+        slugs = unique_slugs([r['title'] for r in records])
+        Book.objects.bulk_create([
+            Book(title=r['title'], title_key=name_key(r['title']),
+                 slug=slug,
+                 author_id=authors[r['author']],
+                 publisher_id=publishers[r['publisher']],
+                 year=r['year'], isbn=r['isbn'], synopsis=r['synopsis'],
+                 book_item_total=r['copies'])
+            for r, slug in zip(records, slugs)])
+        ids = dict(Book.objects.filter(slug__in=slugs).values_list('slug',
+                                                                   'id'))
+
+        Book.category.through.objects.bulk_create([
+            Book.category.through(book_id=ids[slug],
+                                  category_id=categories[category])
+            for r, slug in zip(records, slugs) for category in r['categories']
+        ])
+        BookItem.objects.bulk_create([
+            BookItem(book_id=ids[slug])
+            for r, slug in zip(records, slugs) for i in range(r['copies'])
+        ])
+        BookItem.objects.filter(book_id__in=ids.values()).refresh_status()
+
+        update_search_index(ids.values())
+        return list(ids.values())
+
+    def run(self, records, checkpoint):
+        """
+        Import ``records`` after the ones ``checkpoint`` already counts.
+        Yields ``(read, imported)`` after each batch.
+        """
+        records = islice(records, checkpoint.records, None)
+        while True:
+            batch = list(islice(records, self.batch_size))
+            if not batch:
+                return
+
+            with transaction.atomic():
+                imported = self.write_batch(
+                    [r for r in map(self.clean, batch) if r])
+                checkpoint.records += len(batch)
+                checkpoint.imported += len(imported)
+                checkpoint.save()
+                caching.invalidate(caching.AVAILABILITY)
+            yield len(batch), len(imported)
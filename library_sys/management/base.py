@@ -0,0 +1,25 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class TimedCommand(BaseCommand):
+    """
+    Command reporting how long it ran: ``report`` logs ``log_message`` and
+    writes ``message``, both formatted with ``values``, followed by the
+    elapsed time, in ``style`` (by default ``SUCCESS``).
+    """
+
+    def execute(self, *args, **options):
+        self.started = time.time()
+        return super().execute(*args, **options)
+
+    def report(self, log_message, message, *values, stream=None,
+               style=None):
+        elapsed = time.time() - self.started
+        logging.getLogger(self.__module__).info(
+            '%s: %s in %%.3fs' % (self.__module__.rsplit('.', 1)[-1],
+                                  log_message), *(values + (elapsed,)))
+        (stream or self.stdout).write((style or self.style.SUCCESS)(
+            '%s em %.3fs.' % (message % values, elapsed)))
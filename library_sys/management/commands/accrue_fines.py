@@ -0,0 +1,13 @@
+from library_sys.management.base import TimedCommand
+from library_sys.models import HistoryItem
+
+
+class Command(TimedCommand):
+    help = ('Update the fines of open overdue loans to the value of today. '
+            'Meant to run nightly, e.g. from cron.')
+
+    def handle(self, *args, **options):
+        rows = HistoryItem.objects.accrue_fines()
+
+        self.report('%s loans updated', '%s empréstimo(s) atualizado(s)',
+                    rows)
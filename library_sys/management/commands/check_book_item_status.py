@@ -0,0 +1,34 @@
+from library_sys.management.base import TimedCommand
+from library_sys.models import BookItem
+
+
+class Command(TimedCommand):
+    help = ('Compare the stored status of every copy with the one computed '
+            'from its loans and book, and fix the drift with --repair.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+                            help='Write the computed status of the drifted '
+                                 'copies.')
+
+    def handle(self, *args, **options):
+        if options['repair']:
+            total = BookItem.objects.refresh_status()
+            self.report('%s copies repaired', '%s exemplar(es) corrigido(s)',
+                        total)
+            return
+
+        labels = dict(BookItem.AVAILABLE_CHOICES)
+        drifted = BookItem.objects.with_drifted_status().order_by('id')
+        total = 0
+        for item_id, status, expected in drifted.values_list(
+                'id', 'status', 'expected_status').iterator():
+            total += 1
+            self.stdout.write('№%s: %s, deveria ser %s' % (
+                item_id, labels[status], labels[expected]))
+
+        self.report('%s copies drifted', '%s exemplar(es) divergente(s)',
+                    total, style=self.style.WARNING if total else None)
+        if total:
+            self.stdout.write(self.style.WARNING(
+                'Use --repair para corrigir.'))
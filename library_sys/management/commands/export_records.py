@@ -0,0 +1,73 @@
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from library_sys.exports import (EXPORT_LAG, EXPORTS, FORMATS, to_csv,
+                                 to_jsonl, to_parquet)
+from library_sys.management.base import TimedCommand
+from library_sys.models import ExportCheckpoint
+
+
+class Command(TimedCommand):
+    help = ('Stream books, copies or loans as CSV, JSON Lines or Parquet. '
+            'With --checkpoint, each run only exports what changed since the '
+            'previous one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output',
+                            help='File to write, by default the standard '
+                                 'output (required for Parquet).')
+        parser.add_argument('--since',
+                            help='Export only rows past this updated_at '
+                                 '(books, optionally followed by ",id") or '
+                                 'id (copies and loans).')
+        parser.add_argument('--checkpoint',
+                            help='Name under which the last exported key is '
+                                 'kept, to start the next run after it.')
+
+    def handle(self, *args, **options):
+        export = EXPORTS[options['export']]
+        output = options['output']
+        if options['format'] == 'parquet' and not output:
+            raise CommandError('Exportações Parquet precisam de --output.')
+
+        checkpoint = None
+        try:
+            since = export.parse_cursor(options['since'])
+        except ValueError:
+            raise CommandError('Valor de --since inválido: %s. Informe uma '
+                               'data (AAAA-MM-DD), data e hora ou id.' %
+                               options['since'])
+        if options['checkpoint']:
+            checkpoint, created = ExportCheckpoint.objects.get_or_create(
+                name=options['checkpoint'])
+            if since is None:
+                since = export.parse_cursor(checkpoint.cursor)
+
+        cursor = {}
+        rows = export.rows(since=since, until=timezone.now() - EXPORT_LAG,
+                           cursor=cursor)
+        if options['format'] == 'parquet':
+            try:
+                to_parquet(export, rows, output)
+            except ImportError as e:
+                raise CommandError(e)
+        else:
+            writer = to_csv if options['format'] == 'csv' else to_jsonl
+            if output:
+                with open(output, 'w', encoding='utf-8', newline='') as f:
+                    for line in writer(export.columns, rows):
+                        f.write(line)
+            else:
+                for line in writer(export.columns, rows):
+                    self.stdout.write(line, ending='')
+
+        if checkpoint and cursor['key'] is not None:
+            checkpoint.cursor = export.format_cursor(cursor['key'])
+            checkpoint.save()
+
+        self.report('%s rows of %s exported',
+                    '%s registro(s) de %s exportado(s)',
+                    cursor['rows'], options['export'],
+                    stream=self.stdout if output else self.stderr)
@@ -0,0 +1,72 @@
+import os
+
+from django.core.management.base import CommandError
+
+from library_sys.importers import READERS, CatalogueImporter
+from library_sys.management.base import TimedCommand
+from library_sys.models import ImportCheckpoint
+
+''' FORMAT BY FILE EXTENSION, WHEN --format IS NOT GIVEN '''
+EXTENSIONS = {
+    '.csv': 'csv',
+    '.mrc': 'marc',
+    '.marc': 'marc',
+    '.xml': 'onix',
+    '.onix': 'onix',
+}
+
+
+class Command(TimedCommand):
+    help = ('Import books and their copies from a CSV, MARC21 or ONIX file. '
+            'An interrupted import resumes after the last saved batch.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=sorted(READERS),
+                            help='File format, by default from the extension.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Records saved per transaction.')
+        parser.add_argument('--copies', type=int, default=1,
+                            help='Copies of the records that do not tell.')
+        parser.add_argument('--delimiter', default=',',
+                            help='CSV field delimiter.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the progress of previous runs.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or EXTENSIONS.get(
+            os.path.splitext(path)[1].lower())
+        if not fmt:
+            raise CommandError('Informe o formato do arquivo com --format.')
+
+        checkpoint, created = ImportCheckpoint.objects.get_or_create(
+            source=os.path.abspath(path)[-255:])
+        if options['restart']:
+            checkpoint.records = checkpoint.imported = 0
+            checkpoint.save()
+        elif checkpoint.records:
+            self.stdout.write('Continuando após %s registro(s).' %
+                              checkpoint.records)
+
+        if fmt == 'csv':
+            stream = open(path, encoding='utf-8-sig', newline='')
+            records = READERS[fmt](stream, options['delimiter'])
+        else:
+            stream = open(path, 'rb')
+            records = READERS[fmt](stream)
+
+        read = imported = 0
+        importer = CatalogueImporter(options['batch_size'], options['copies'])
+        with stream:
+            for batch_read, batch_imported in importer.run(records,
+                                                           checkpoint):
+                read += batch_read
+                imported += batch_imported
+                if options['verbosity'] > 1:
+                    self.stdout.write('%s registro(s) lido(s), %s livro(s) '
+                                      'importado(s).' % (read, imported))
+
+        self.report('%s records read, %s books imported',
+                    '%s registro(s) lido(s), %s livro(s) importado(s)',
+                    read, imported)
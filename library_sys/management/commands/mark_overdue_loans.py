@@ -0,0 +1,12 @@
+from library_sys.management.base import TimedCommand
+from library_sys.models import HistoryItem
+
+
+class Command(TimedCommand):
+    help = ('Mark the loans that passed their due date as pending and send '
+            'loans_overdue for them. Meant to run daily, e.g. from cron.')
+
+    def handle(self, *args, **options):
+        rows = len(HistoryItem.objects.mark_overdue())
+
+        self.report('%s loans marked', '%s empréstimo(s) em atraso', rows)
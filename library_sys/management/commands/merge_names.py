@@ -0,0 +1,45 @@
+from django.core.management.base import CommandError
+
+from library_sys.management.base import TimedCommand
+from library_sys.models import Author, Publisher
+
+MODELS = {
+    'authors': Author,
+    'publishers': Publisher,
+}
+
+
+class Command(TimedCommand):
+    help = ('Merge duplicate authors or publishers, pointing their books at '
+            'the one kept: the given ids into the first one, or with '
+            '--duplicates every group sharing a normalized name into its '
+            'oldest row.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(MODELS))
+        parser.add_argument('ids', nargs='*', type=int,
+                            help='Id to keep followed by the ids to merge '
+                                 'into it.')
+        parser.add_argument('--duplicates', action='store_true',
+                            help='Merge every group of equal name keys.')
+
+    def handle(self, *args, **options):
+        model = MODELS[options['model']]
+        ids = options['ids']
+        if options['duplicates'] == bool(ids):
+            raise CommandError('Informe os ids a unir ou --duplicates.')
+
+        if ids:
+            target = ids[0]
+            if not model.objects.filter(id=target).exists():
+                raise CommandError('Registro %s não encontrado.' % target)
+            duplicates = set(model.objects.filter(id__in=ids[1:]).values_list(
+                'id', flat=True))
+            moved = model.objects.merge({dup: target for dup in duplicates})
+            removed = len(duplicates - {target})
+        else:
+            removed, moved = model.objects.merge_duplicates()
+
+        self.report('%s rows removed, %s books moved',
+                    '%s registro(s) unido(s), %s livro(s) atualizado(s)',
+                    removed, moved)
@@ -0,0 +1,17 @@
+from library_sys.management.base import TimedCommand
+from library_sys.models import MediaCleanup
+
+
+class Command(TimedCommand):
+    help = ('Remove the old covers and files queued by book saves and '
+            'deletes. Meant to run periodically, e.g. from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Queued paths handled per query.')
+
+    def handle(self, *args, **options):
+        removed, failed = MediaCleanup.objects.process(options['batch_size'])
+
+        self.report('%s paths removed, %s failed',
+                    '%s arquivo(s) removido(s), %s com erro', removed, failed)
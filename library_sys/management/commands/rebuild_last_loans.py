@@ -0,0 +1,13 @@
+from library_sys.management.base import TimedCommand
+from library_sys.models import HistoryItem
+
+
+class Command(TimedCommand):
+    help = ('Point every copy at its most recent loan again, e.g. after an '
+            'import or a manual change of the loans.')
+
+    def handle(self, *args, **options):
+        total = HistoryItem.objects.rebuild_latest()
+
+        self.report('%s copies updated', '%s exemplar(es) atualizado(s)',
+                    total)
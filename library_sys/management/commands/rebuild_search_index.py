@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from library_sys.search import MemoryBackend, get_backend
+
+
+class Command(BaseCommand):
+    help = 'Index every active book again for the public search.'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        if isinstance(backend, MemoryBackend):
+            self.stderr.write(self.style.WARNING(
+                'MemoryBackend mantém o índice na memória de cada processo: '
+                'reinicie o servidor para reconstruí-lo. Nada foi feito.'))
+            return
+
+        backend.rebuild()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Índice de busca reconstruído (%s).' % type(backend).__name__))
@@ -0,0 +1,12 @@
+from library_sys.management.base import TimedCommand
+from library_sys.models import Book
+
+
+class Command(TimedCommand):
+    help = ('Rebuild book_item_total and book_item_unavailable of every book '
+            'from its copies and open loans.')
+
+    def handle(self, *args, **options):
+        total = Book.objects.recount_counters()
+
+        self.report('%s books recounted', '%s livro(s) recontado(s)', total)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from library_sys import search
+
+    backend = search.create_tables(schema_editor.connection)
+    if backend:
+        Book = apps.get_model('library_sys', 'Book')
+        backend().rebuild(Book.objects.filter(activated=True))
+
+
+def drop_search_index(apps, schema_editor):
+    from library_sys import search
+
+    search.drop_tables(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0019_book_isbn'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
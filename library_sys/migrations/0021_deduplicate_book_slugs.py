@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.template.defaultfilters import slugify
+
+
+def deduplicate_slugs(apps, schema_editor):
+    """
+    Give every book a slug of its own before the unique index is built.
+    The first book keeps the slug, the next ones get -2, -3...
+    """
+    Book = apps.get_model('library_sys', 'Book')
+
+    taken = set()
+    rows = Book.objects.order_by('id').values_list('id', 'slug', 'title')
+    for book_id, slug, title in rows.iterator():
+        base = (slug or slugify(title))[:190] or 'livro'
+        unique, i = base, 2
+        while unique in taken:
+            unique = '%s-%s' % (base, i)
+            i += 1
+
+        taken.add(unique)
+        if unique != slug:
+            Book.objects.filter(id=book_id).update(slug=unique)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0020_book_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_slugs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 06:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0021_deduplicate_book_slugs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='slug',
+            field=models.SlugField(max_length=200, unique=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 07:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0022_auto_20261018_0600'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookitem',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Disponível'), (2, 'Indisponível'), (3, 'Emprestado'), (4, 'Entrega pendente')], db_index=True, default=1, editable=False, verbose_name='situação'),
+        ),
+    ]
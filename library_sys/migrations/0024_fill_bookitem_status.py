@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import migrations
+from django.db.models import F
+
+AVAILABLE, UNAVAILABLE, BORROWED, PENDING = 1, 2, 3, 4
+
+
+def fill_status(apps, schema_editor):
+    """
+    Set the status of every copy with four set-based UPDATEs, the later
+    ones taking precedence as in ``book_item_status_expression``.
+    """
+    BookItem = apps.get_model('library_sys', 'BookItem')
+    on_loan = BookItem.objects.filter(last_history_item_id__isnull=False,
+                                      last_date_returned__isnull=True)
+
+    BookItem.objects.update(status=UNAVAILABLE)
+    BookItem.objects.filter(
+        book__available=True,
+        available=True,
+        book__book_item_total__gt=F('book__book_item_unavailable'),
+    ).update(status=AVAILABLE)
+    on_loan.update(status=BORROWED)
+    on_loan.filter(last_date_due__lt=date.today()).update(status=PENDING)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0023_bookitem_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 08:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0024_fill_bookitem_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historyitem',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Devolvido'), (2, 'Emprestado'), (3, 'Entrega pendente')], default=2, editable=False, verbose_name='situação'),
+        ),
+        migrations.AlterIndexTogether(
+            name='historyitem',
+            index_together=set([('status', 'date_due')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import migrations
+
+RETURNED, BORROWED, PENDING = 1, 2, 3
+
+
+def fill_status(apps, schema_editor):
+    """
+    Returned and overdue loans get their status; the other ones keep the
+    BORROWED default. No loans_overdue is sent for the existing ones.
+    """
+    HistoryItem = apps.get_model('library_sys', 'HistoryItem')
+
+    HistoryItem.objects.filter(date_returned__isnull=False).update(
+        status=RETURNED)
+    HistoryItem.objects.filter(date_returned__isnull=True,
+                               date_due__lt=date.today()).update(
+        status=PENDING)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0025_historyitem_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_status, migrations.RunPython.noop),
+    ]
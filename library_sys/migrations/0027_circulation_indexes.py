@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 09:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0026_fill_historyitem_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='activated',
+            field=models.BooleanField(db_index=True, default=True, help_text='Caso desmarque esta opção\n                                        o registro não aparecerá no site.', verbose_name='ativo'),
+        ),
+        migrations.AlterField(
+            model_name='bookitem',
+            name='last_history_item_id',
+            field=models.SmallIntegerField(blank=True, db_index=True, null=True, verbose_name='ultimo empréstimo'),
+        ),
+        migrations.AlterField(
+            model_name='historyitem',
+            name='date_due',
+            field=models.DateField(db_index=True, verbose_name='à ser entregue em'),
+        ),
+        migrations.AlterField(
+            model_name='historyitem',
+            name='date_taken',
+            field=models.DateField(db_index=True, verbose_name='emprestado em'),
+        ),
+        migrations.AlterIndexTogether(
+            name='historyitem',
+            index_together=set([('status', 'date_due'), ('reader', 'date_taken'), ('status', 'date_taken'), ('book_item', 'date_taken')]),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 10:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    Move the integer pointers aside and add the foreign keys in their
+    columns. Renaming and adding nullable columns is quick, and 0029 fills
+    the new columns in batches.
+    """
+
+    dependencies = [
+        ('library_sys', '0027_circulation_indexes'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='bookitem',
+            old_name='last_history_item_id',
+            new_name='legacy_last_history_item_id',
+        ),
+        migrations.RenameField(
+            model_name='bookitem',
+            old_name='last_reader_id',
+            new_name='legacy_last_reader_id',
+        ),
+        migrations.AddField(
+            model_name='bookitem',
+            name='last_history_item',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='library_sys.HistoryItem', verbose_name='ultimo empréstimo'),
+        ),
+        migrations.AddField(
+            model_name='bookitem',
+            name='last_reader',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='library_sys.Reader', verbose_name='ultimo leitor(a)'),
+        ),
+    ]
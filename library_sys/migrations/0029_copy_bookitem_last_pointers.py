@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import migrations, transaction
+from django.db.models import F, Max
+
+''' SMALL ENOUGH FOR THE 999 PARAMETERS OF SQLITE '''
+BATCH_SIZE = 500
+
+AVAILABLE, UNAVAILABLE, BORROWED, PENDING = 1, 2, 3, 4
+
+''' FROZEN COPY OF BookItem.LAST_LOAN_FIELDS, BY FIELD NAME '''
+LAST_LOAN_FIELDS = (
+    ('last_history_item', 'id'),
+    ('last_reader', 'reader'),
+    ('last_date_taken', 'date_taken'),
+    ('last_date_due', 'date_due'),
+    ('last_date_returned', 'date_returned'),
+)
+
+LATEST_SQL = '''
+    SELECT hi.{source} FROM {history_item} hi
+    WHERE hi.book_item_id = {book_item}.id
+    ORDER BY hi.date_taken DESC, hi.id DESC LIMIT 1
+'''
+
+
+def rebuild_latest(connection, BookItem, HistoryItem, book_item_ids):
+    """
+    Point the copies of ``book_item_ids`` at their most recent loan, as
+    ``HistoryItemManager.rebuild_latest`` does, then set their status as
+    0024 did.
+    """
+    qn = connection.ops.quote_name
+    book_item = qn(BookItem._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE %s SET %s WHERE id IN (%s)' % (
+            book_item,
+            ', '.join('%s = (%s)' % (
+                qn(BookItem._meta.get_field(target).column),
+                LATEST_SQL.format(
+                    source=qn(HistoryItem._meta.get_field(source).column),
+                    history_item=qn(HistoryItem._meta.db_table),
+                    book_item=book_item))
+                for target, source in LAST_LOAN_FIELDS),
+            ', '.join(['%s'] * len(book_item_ids))), book_item_ids)
+
+    items = BookItem.objects.using(connection.alias).filter(
+        id__in=book_item_ids)
+    on_loan = items.filter(last_history_item_id__isnull=False,
+                           last_date_returned__isnull=True)
+    items.update(status=UNAVAILABLE)
+    items.filter(
+        book__available=True,
+        available=True,
+        book__book_item_total__gt=F('book__book_item_unavailable'),
+    ).update(status=AVAILABLE)
+    on_loan.update(status=BORROWED)
+    on_loan.filter(last_date_due__lt=date.today()).update(status=PENDING)
+
+
+def copy_pointers(apps, schema_editor):
+    """
+    Copy the integer pointers into the foreign keys, one range of copies
+    per transaction, so the table is never locked for long. Copies whose
+    pointer names a loan that no longer exists are pointed at their most
+    recent loan again; pointers to deleted readers are left NULL.
+    """
+    connection = schema_editor.connection
+    db = connection.alias
+    BookItem = apps.get_model('library_sys', 'BookItem')
+    HistoryItem = apps.get_model('library_sys', 'HistoryItem')
+    Reader = apps.get_model('library_sys', 'Reader')
+
+    last_id = BookItem.objects.using(db).aggregate(Max('id'))['id__max'] or 0
+    for start in range(0, last_id, BATCH_SIZE):
+        batch = BookItem.objects.using(db).filter(id__gt=start,
+                                                  id__lte=start + BATCH_SIZE)
+        rows = list(batch.values_list('legacy_last_history_item_id',
+                                      'legacy_last_reader_id'))
+        history_item_ids = {row[0] for row in rows if row[0]}
+        reader_ids = {row[1] for row in rows if row[1]}
+
+        with transaction.atomic(using=db):
+            found = list(HistoryItem.objects.using(db).filter(
+                id__in=history_item_ids).values_list('id', flat=True))
+            batch.filter(legacy_last_history_item_id__in=found).update(
+                last_history_item_id=F('legacy_last_history_item_id'))
+            batch.filter(legacy_last_reader_id__in=list(
+                Reader.objects.using(db).filter(
+                    pk__in=reader_ids).values_list('pk', flat=True))
+            ).update(last_reader_id=F('legacy_last_reader_id'))
+
+            unresolved = list(batch.filter(
+                legacy_last_history_item_id__isnull=False
+            ).exclude(legacy_last_history_item_id__in=found).values_list(
+                'id', flat=True))
+            if unresolved:
+                rebuild_latest(connection, BookItem, HistoryItem, unresolved)
+
+
+def copy_pointers_back(apps, schema_editor):
+    BookItem = apps.get_model('library_sys', 'BookItem')
+    BookItem.objects.using(schema_editor.connection.alias).update(
+        legacy_last_history_item_id=F('last_history_item_id'),
+        legacy_last_reader_id=F('last_reader_id'))
+
+
+class Migration(migrations.Migration):
+
+    ''' EACH BATCH COMMITS ON ITS OWN '''
+    atomic = False
+
+    dependencies = [
+        ('library_sys', '0028_bookitem_last_foreign_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_pointers, copy_pointers_back),
+    ]
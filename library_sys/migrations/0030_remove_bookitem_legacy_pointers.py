@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 10:00
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0029_copy_bookitem_last_pointers'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='bookitem',
+            name='legacy_last_history_item_id',
+        ),
+        migrations.RemoveField(
+            model_name='bookitem',
+            name='legacy_last_reader_id',
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 14:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0033_book_media_sniffing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='file_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40, verbose_name='hash do arquivo'),
+        ),
+    ]
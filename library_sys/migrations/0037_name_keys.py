@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+''' SMALL ENOUGH FOR THE 999 PARAMETERS OF SQLITE '''
+BATCH_SIZE = 400
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def name_key(name):
+    """ ``models.name_key`` as of this migration. """
+    text = unicodedata.normalize('NFKD', str(name or ''))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(TOKEN_RE.findall(text.casefold()))[:200]
+
+
+def fill_name_keys(apps, schema_editor):
+    """
+    Set the key of every author and publisher, one UPDATE per batch.
+    """
+    db = schema_editor.connection.alias
+    for model_name in ('Author', 'Publisher'):
+        queryset = apps.get_model('library_sys', model_name).objects.using(db)
+        last_id = 0
+        while True:
+            rows = list(queryset.filter(id__gt=last_id).order_by(
+                'id').values_list('id', 'name')[:BATCH_SIZE])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            queryset.filter(id__in=[id for id, name in rows]).update(
+                name_key=Case(*[When(id=id, then=Value(name_key(name)))
+                                for id, name in rows],
+                              output_field=models.CharField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0036_exports'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='name_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=200),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='publisher',
+            name='name_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=200),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_name_keys, migrations.RunPython.noop),
+    ]
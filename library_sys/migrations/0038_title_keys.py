@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+''' SMALL ENOUGH FOR THE 999 PARAMETERS OF SQLITE '''
+BATCH_SIZE = 400
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def name_key(name):
+    """ ``models.name_key`` as of this migration. """
+    text = unicodedata.normalize('NFKD', str(name or ''))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(TOKEN_RE.findall(text.casefold()))[:200]
+
+
+def fill_keys(queryset, key_field, fields, make_key):
+    """
+    Set ``key_field`` of the rows of ``queryset`` to ``make_key`` of their
+    ``fields``, one UPDATE per batch.
+    """
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by(
+            'pk').values_list('pk', *fields)[:BATCH_SIZE])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        queryset.filter(pk__in=[row[0] for row in rows]).update(**{
+            key_field: Case(*[When(pk=row[0], then=Value(make_key(*row[1:])))
+                              for row in rows],
+                            output_field=models.CharField())})
+
+
+def fill_title_keys(apps, schema_editor):
+    db = schema_editor.connection.alias
+    fill_keys(apps.get_model('library_sys', 'Book').objects.using(db),
+              'title_key', ['title'], name_key)
+    fill_keys(apps.get_model('library_sys', 'Reader').objects.using(db),
+              'name_key', ['first_name', 'last_name', 'username'],
+              lambda first_name, last_name, username: name_key(
+                  '%s %s' % (first_name, last_name)) or name_key(username))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0037_name_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='title_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=200),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='reader',
+            name='name_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=200),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_title_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library_sys', '0038_title_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportcheckpoint',
+            name='cursor',
+            field=models.CharField(blank=True, max_length=100, verbose_name='última chave exportada'),
+        ),
+    ]
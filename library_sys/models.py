@@ -1,25 +1,143 @@
 # -- coding: utf-8 --
 
+from collections import Counter, defaultdict
 from datetime import datetime, date
 import glob
+import logging
 import os
 
-from django.db import models
-from django.db.models import F, Q
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import (Case, F, IntegerField, Max, Min, Q, Sum, Value,
+                              When)
+from django.db.models.functions import Greatest
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User, UserManager
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
+from django.core.cache import cache
 from django.urls import reverse
+from django.utils import timezone
+
+from . import caching, downloads, thumbnails
+from .search import normalize
+from .validators import IMAGE_MIMETYPES, FileValidator
+
+logger = logging.getLogger(__name__)
+
+''' DAYS FROM date_due TO THE DATE GIVEN AS PARAMETER, BY DATABASE '''
+DAYS_SINCE_SQL = {
+    'sqlite': 'CAST(julianday(%s) - julianday(date_due) AS INTEGER)',
+    'postgresql': '(%s - date_due)',
+    'mysql': 'DATEDIFF(%s, date_due)',
+}
+MAX_FINE = 32767
+
+ACCOUNT_CACHE_TIMEOUT = getattr(settings,
+                                'LIBRARY_SYS_ACCOUNT_CACHE_TIMEOUT',
+                                60 * 60)
+
+
+def name_key(name):
+    """
+    ``name`` folded for matching: without accents, case, punctuation and
+    extra whitespace ("  Veríssimo, Érico." -> "verissimo erico").
+    """
+    return ' '.join(normalize(name))[:200]
+
+
+def prefix_lookup(using, field, value):
+    """
+    ``Q`` of the rows whose ``field`` starts with ``value``
+    (case-sensitive), in a way the index of ``field`` serves on the
+    database ``using``.
+    """
+    if connections[using].vendor == 'sqlite':
+        ''' LIKE SKIPS THE INDEX ON SQLITE, A RANGE DOES NOT '''
+        return Q(**{'%s__gte' % field: value,
+                    '%s__lt' % field: value + '\U0010ffff'})
+    return Q(**{'%s__startswith' % field: value})
+
+
+def startswith(queryset, field, value):
+    """
+    ``queryset`` filtered to the rows whose ``field`` starts with
+    ``value`` (case-sensitive), in a way the index of ``field`` serves.
+    """
+    return queryset.filter(prefix_lookup(queryset.db, field, value))
+
+
+class NameQuerySet(models.QuerySet):
+    """
+    Lookups by ``name_key`` and merges of ``Author`` and ``Publisher``.
+    """
+
+    def by_name(self, name):
+        return self.filter(name_key=name_key(name))
+
+    def prefix(self, text):
+        """ Rows whose ``name_key`` starts with the key of ``text``. """
+        key = name_key(text)
+        if not key:
+            return self.none()
+        return startswith(self, 'name_key', key)
+
+    def merge(self, targets):
+        """
+        Point the books of the rows ``{duplicate_id: target_id}`` at their
+        target, with a single UPDATE, and delete the duplicates. Returns
+        the number of books moved.
+        """
+        from .signals import update_search_index
+
+        targets = {dup: target for dup, target in targets.items()
+                   if dup != target}
+        if not targets:
+            return 0
 
-from .validators import FileValidator
+        column = '%s_id' % self.model.book_set.field.name
+        with transaction.atomic(using=self.db):
+            books = Book.objects.using(self.db).filter(**{
+                '%s__in' % column: list(targets)})
+            book_ids = list(books.values_list('id', flat=True))
+            moved = books.update(updated_at=timezone.now(), **{
+                column: Case(*[When(then=Value(target), **{column: dup})
+                               for dup, target in targets.items()],
+                             output_field=IntegerField())})
+            self.filter(id__in=list(targets)).delete()
+            update_search_index(book_ids)
+        return moved
+
+    def merge_duplicates(self, batch_size=500):
+        """
+        Merge the rows sharing a ``name_key`` into the oldest of them.
+        Returns ``(rows removed, books moved)``.
+        """
+        keys = list(self.exclude(name_key='').values('name_key').annotate(
+            n=models.Count('id')).filter(n__gt=1).order_by().values_list(
+            'name_key', flat=True))
+
+        removed = moved = 0
+        for i in range(0, len(keys), batch_size):
+            keep = {}
+            targets = {}
+            for id, key in self.filter(
+                    name_key__in=keys[i:i + batch_size]).order_by(
+                    'id').values_list('id', 'name_key'):
+                targets[id] = keep.setdefault(key, id)
+            moved += self.merge(targets)
+            removed += len(targets) - len(keep)
+        return removed, moved
 
 
 class Author(models.Model):
 
     name = models.CharField("autor(a)", max_length=200)
+    name_key = models.CharField(max_length=200, editable=False,
+                                db_index=True)
+
+    objects = NameQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -27,10 +145,18 @@ class Author(models.Model):
     class Meta:
         verbose_name = "autor(a)"
 
+    def save(self, *args, **kwargs):
+        self.name_key = name_key(self.name)
+        super().save(*args, **kwargs)
+
 
 class Publisher(models.Model):
 
     name = models.CharField("editora", max_length=200)
+    name_key = models.CharField(max_length=200, editable=False,
+                                db_index=True)
+
+    objects = NameQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -38,6 +164,10 @@ class Publisher(models.Model):
     class Meta:
         verbose_name = "editora"
 
+    def save(self, *args, **kwargs):
+        self.name_key = name_key(self.name)
+        super().save(*args, **kwargs)
+
 
 class Category(models.Model):
 
@@ -63,6 +193,84 @@ class BookActiveManager(models.Manager):
         return super().get_queryset().filter(activated=True)
 
 
+class BookManager(models.Manager):
+
+    def adjust_counters(self, total=None, unavailable=None):
+        """
+        Apply ``{book_id: delta}`` maps to ``book_item_total`` and
+        ``book_item_unavailable`` with a single atomic UPDATE.
+
+        The new values are computed by the database from the current ones
+        (``F()`` expressions), so concurrent loans of the same title never
+        overwrite each other. Counters are clamped at zero.
+        """
+        fields = {}
+        for field, deltas in (('book_item_total', total),
+                              ('book_item_unavailable', unavailable)):
+            deltas = {k: v for k, v in (deltas or {}).items() if v}
+            if deltas:
+                fields[field] = deltas
+        if not fields:
+            return 0
+
+        ''' THE UPDATE COVERS THE BOOKS OF BOTH FIELDS, SO A BARE DELTA IS
+            ONLY SAFE WHEN IT IS A SINGLE BOOK '''
+        book_ids = set().union(*fields.values())
+        values = {}
+        for field, deltas in fields.items():
+            if len(book_ids) == 1:
+                delta = Value(list(deltas.values())[0])
+            else:
+                delta = Case(*[When(id=book_id, then=Value(value))
+                               for book_id, value in deltas.items()],
+                             default=Value(0),
+                             output_field=IntegerField())
+            values[field] = Greatest(F(field) + delta, Value(0))
+
+        caching.invalidate(caching.AVAILABILITY)
+        return self.filter(id__in=book_ids).update(updated_at=timezone.now(),
+                                                   **values)
+
+    def recount_counters(self):
+        """
+        Rebuild the counters of the whole catalogue from ``BookItem`` and
+        ``HistoryItem`` in one set-based UPDATE.
+
+        A copy is counted as unavailable once when it is flagged as
+        unavailable and once for each loan not yet returned, matching the
+        increments done by ``BookItem.save`` and ``HistoryItem.save``.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        book = qn(Book._meta.db_table)
+        book_item = qn(BookItem._meta.db_table)
+        history_item = qn(HistoryItem._meta.db_table)
+
+        sql = '''
+            UPDATE {book} SET
+                book_item_total = (
+                    SELECT COUNT(*) FROM {book_item} bi
+                    WHERE bi.book_id = {book}.id),
+                book_item_unavailable = (
+                    SELECT COUNT(*) FROM {book_item} bi
+                    WHERE bi.book_id = {book}.id AND bi.available = %s
+                ) + (
+                    SELECT COUNT(*) FROM {history_item} hi
+                    INNER JOIN {book_item} bi ON bi.id = hi.book_item_id
+                    WHERE bi.book_id = {book}.id
+                    AND hi.date_returned IS NULL)
+        '''.format(book=book, book_item=book_item, history_item=history_item)
+
+        caching.invalidate(caching.AVAILABILITY)
+        with transaction.atomic(using=self.db):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [False])
+                rows = cursor.rowcount
+
+            BookItem.objects.using(self.db).refresh_status()
+        return rows
+
+
 class Book(models.Model):
 
     def get_absolute_url(self):
@@ -70,33 +278,33 @@ class Book(models.Model):
                        args=[str(self.slug)])
 
     def get_upload_to_image(self, filename):
-        ext = filename[-3:].lower()
-        if ext == 'peg':
-            ext = 'jpeg'
+        ext = os.path.splitext(filename)[1].lower()
 
-        return 'book/cover/%s_%s.%s' % (self.slug,
+        return 'book/cover/%s_%s%s' % (self.slug,
                    datetime.now().strftime('%Y%m%d%H%M%S'),
                    ext)
 
     def get_upload_to_file(self, filename):
-        ext = filename[-3:].lower()
+        ext = os.path.splitext(filename)[1].lower()
 
-        return 'book/file/%s_%s.%s' % (self.slug,
-                                       datetime.now().strftime('%Y%m%d%H%M%S'),
-                                       ext)
+        return 'book/file/%s_%s%s' % (self.slug,
+                                      datetime.now().strftime('%Y%m%d%H%M%S'),
+                                      ext)
 
     author = models.ForeignKey(Author, verbose_name="autor(a)")
     publisher = models.ForeignKey(Publisher, verbose_name="editora")
     category = models.ManyToManyField(Category, verbose_name=u"categorias",
                                       blank=True)
     title = models.CharField("título", max_length=100)
-    slug = models.SlugField(max_length=200)
+    title_key = models.CharField(max_length=200, editable=False,
+                                 db_index=True)
+    slug = models.SlugField(max_length=200, unique=True)
     year = models.PositiveSmallIntegerField(
         "Ano", blank=True, null=True, 
         validators=[MinValueValidator(1564),
                     MaxValueValidator(date.today().year)]
     )
-    activated = models.BooleanField('ativo', default=True,
+    activated = models.BooleanField('ativo', default=True, db_index=True,
                                     help_text=_('''Caso desmarque esta opção
                                         o registro não aparecerá no site.'''))
     available = models.BooleanField('disponível', default=True,
@@ -124,7 +332,7 @@ class Book(models.Model):
                             title='Mais informações'
                             target='_blank'>(?)</a>'''))
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     cover_height = models.PositiveSmallIntegerField('altura da capa',
                                                     blank=True, null=True)
@@ -136,25 +344,34 @@ class Book(models.Model):
                               width_field='cover_width',
                               blank=True, null=True,
                               validators=[FileValidator(
-                                  max_size=1 * 1024 * 1024)],
+                                  max_size=1 * 1024 * 1024,
+                                  allowed_mimetypes=IMAGE_MIMETYPES,
+                                  sniff=True)],
                               help_text=_('''Selecione a imagem de capa
                                do livro, normalmente nos formatos
                                jpg, png, gif, etc.'''))
+    cover_hash = models.CharField('hash da capa', max_length=40, blank=True,
+                                  editable=False)
 
     file = models.FileField('arquivo', upload_to=get_upload_to_file,
                             blank=True, null=True,
                             validators=[FileValidator(
                                   max_size=5 * 1024 * 1024,
                                   allowed_mimetypes=('application/pdf',
-                                                     'application/epub+zip'))],
+                                                     'application/epub+zip'),
+                                  sniff=True)],
                             help_text=_('''Selecione o arquivo do livro
                              para download, normalmente nos formatos
                              pdf, epub, etc.'''))
+    file_hash = models.CharField('hash do arquivo', max_length=40,
+                                 blank=True, editable=False)
 
     ''' Managers '''
-    objects = models.Manager()
+    objects = BookManager()
     obj_active = BookActiveManager()
 
+    COUNTER_FIELDS = ('book_item_total', 'book_item_unavailable')
+
     class Meta:
         verbose_name = "livro"
         verbose_name_plural = "livros"
@@ -164,10 +381,28 @@ class Book(models.Model):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__original_book_item_total = self.book_item_total
+        self.__original = self.field_values()
+
+    def field_values(self):
+        """
+        Values of the concrete fields loaded on this instance, files by
+        name. Deferred fields are left out, so nothing is fetched.
+        """
+        values = {}
+        for field in self._meta.concrete_fields:
+            if field.attname in self.__dict__:
+                value = self.__dict__[field.attname]
+                values[field.name] = getattr(value, 'name', value)
+        return values
+
+    def changed_fields(self):
+        """ Names of the fields changed since the instance was loaded. """
+        return [name for name, value in self.field_values().items()
+                if name not in self.__original or
+                self.__original[name] != value]
 
     def clean(self):
-        original_book_item_total = self._Book__original_book_item_total
+        original_book_item_total = self.__original.get('book_item_total')
         book_item_total = self.book_item_total
 
         if (original_book_item_total
@@ -177,64 +412,295 @@ class Book(models.Model):
                 _('Para reduzir o total de exemplares você deve excluir individualmente'),
             })
 
+    def get_unique_slug(self):
+        """
+        Slug of the title, suffixed with -2, -3... when another book
+        already uses it.
+        """
+        slug = slugify(self.title)[:190] or 'livro'
+        taken = set(Book.objects.filter(slug__startswith=slug).exclude(
+            id=self.id).values_list('slug', flat=True))
+
+        unique, i = slug, 2
+        while unique in taken:
+            unique = '%s-%s' % (slug, i)
+            i += 1
+        return unique
+
     def save(self, *args, **kwargs):
         if not self.id:
-            self.slug = slugify(self.title)
-            super().save()
-
-            i = 0
-            to_persist = []
-            while i < self.book_item_total:
-                to_persist.append(BookItem(book_id=self.id))
-                i += 1
-
-            BookItem.objects.bulk_create(to_persist)
-        else:
-            ''' UPDATE BOOK ITEM TOTAL FIELD '''
-            if self.book_item_total > self.__original_book_item_total:
-                i = self.__original_book_item_total
+            self.title_key = name_key(self.title)
+            if self.cover:
+                self.cover_hash = downloads.content_hash(self.cover)
+            if self.file:
+                self.file_hash = downloads.content_hash(self.file)
+
+            with transaction.atomic():
+                ''' RETRY WHEN A CONCURRENT SAVE TOOK THE SAME SLUG '''
+                for attempt in range(3):
+                    self.slug = self.get_unique_slug()
+                    try:
+                        with transaction.atomic():
+                            super().save()
+                        break
+                    except IntegrityError:
+                        if attempt == 2:
+                            raise
+
+                ''' COPIES CREATED HERE ARE ALREADY IN book_item_total '''
+                i = 0
                 to_persist = []
                 while i < self.book_item_total:
                     to_persist.append(BookItem(book_id=self.id))
                     i += 1
 
                 BookItem.objects.bulk_create(to_persist)
+                BookItem.objects.filter(book_id=self.id).refresh_status()
+        else:
+            changed = self.changed_fields()
+            if 'title' in changed:
+                self.title_key = name_key(self.title)
+                changed.append('title_key')
+            if 'cover' in changed:
+                self.cover_hash = (downloads.content_hash(self.cover)
+                                   if self.cover else '')
+                changed.append('cover_hash')
+            if 'file' in changed:
+                self.file_hash = (downloads.content_hash(self.file)
+                                  if self.file else '')
+                changed.append('file_hash')
+
+            with transaction.atomic():
+                ''' MEDIA MAINTENANCE, ONLY FOR A REPLACED COVER OR FILE '''
+                MediaCleanup.objects.enqueue(
+                    self.__original.get(name) for name in ('cover', 'file')
+                    if name in changed)
+                if self.__original.get('cover_hash') not in ('', None,
+                                                             self.cover_hash):
+                    MediaCleanup.objects.enqueue([thumbnails.thumbnail_prefix(
+                        self.__original['cover_hash'])])
+
+                ''' UPDATE BOOK ITEM TOTAL FIELD '''
+                added = 0
+                if 'book_item_total' in self.__original:
+                    added = (self.book_item_total -
+                             self.__original['book_item_total'])
+                if added > 0:
+                    BookItem.objects.bulk_create(
+                        [BookItem(book_id=self.id) for i in range(added)])
+
+                '''
+                Only the changed columns are written. Counters never are:
+                loans made since this instance was loaded may have moved
+                them.
+                '''
+                super().save(update_fields={'updated_at'} | {
+                    name for name in changed
+                    if name != 'id' and name not in self.COUNTER_FIELDS
+                })
+
+                if added > 0:
+                    Book.objects.adjust_counters(total={self.id: added})
+
+                if added > 0 or 'available' in changed:
+                    BookItem.objects.filter(book_id=self.id).refresh_status()
+
+        if self.cover and self.cover_hash != self.__original.get('cover_hash'):
+            thumbnails.generate_on_commit(self)
+
+        caching.invalidate(caching.AVAILABILITY)
+        self.__original = self.field_values()
 
-            ''' MEDIA MAINTENANCE '''
-            obj_book = Book.objects.get(id=self.id)
+    def delete(self):
+        with transaction.atomic():
+            super().delete()
+            MediaCleanup.objects.enqueue(
+                self.__original.get(name) for name in ('cover', 'file'))
+            if self.__original.get('cover_hash'):
+                MediaCleanup.objects.enqueue([thumbnails.thumbnail_prefix(
+                    self.__original['cover_hash'])])
+        caching.invalidate(caching.AVAILABILITY)
+
+
+class MediaCleanupManager(models.Manager):
+
+    def enqueue(self, paths):
+        """
+        Queue the media ``paths`` no longer used by their book. The rows
+        are committed or rolled back with the current transaction.
+        """
+        self.bulk_create([self.model(path=path) for path in paths if path])
+
+    def process(self, batch_size=100):
+        """
+        Remove the queued files (and the files named after them, like
+        their derivatives) in batches of ``batch_size``. Paths used by a
+        book again, and thumbnails of a cover still used, are kept. Rows
+        whose files could not be removed stay queued for the next run.
+        Returns ``(removed, failed)`` row counts.
+        """
+        removed = failed = 0
+        last_id = 0
+        while True:
+            batch = list(self.filter(id__gt=last_id).order_by('id')[
+                :batch_size])
+            if not batch:
+                return removed, failed
+            last_id = batch[-1].id
+
+            paths = {item.path for item in batch}
+            in_use = set()
+            for cover, file in Book.objects.filter(
+                    Q(cover__in=paths) | Q(file__in=paths)
+            ).values_list('cover', 'file'):
+                in_use.update([cover, file])
+            hashes = {thumbnails.hash_of_prefix(path) for path in paths}
+            in_use.update(thumbnails.thumbnail_prefix(cover_hash)
+                          for cover_hash in Book.objects.filter(
+                              cover_hash__in=hashes - {None}
+                          ).values_list('cover_hash', flat=True))
+
+            done = []
+            for item in batch:
+                try:
+                    if item.path not in in_use:
+                        for fl in glob.glob("%s/%s*" % (settings.MEDIA_ROOT,
+                                                        item.path)):
+                            os.remove(fl)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    logger.exception('could not remove %s', item.path)
+                    failed += 1
+                    continue
+                if (item.path not in in_use and
+                        thumbnails.hash_of_prefix(item.path)):
+                    thumbnails.forget(thumbnails.hash_of_prefix(item.path))
+                done.append(item.id)
+
+            self.filter(id__in=done).delete()
+            removed += len(done)
+
+
+class MediaCleanup(models.Model):
+
+    path = models.CharField('arquivo', max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
 
-            if obj_book.cover and self.cover not in [obj_book.cover]:
-                for fl in glob.glob("%s/%s*" % (settings.MEDIA_ROOT,
-                                                obj_book.cover)):
-                    os.remove(fl)
+    objects = MediaCleanupManager()
 
-            if obj_book.file and self.cover not in [obj_book.file]:
-                for fl in glob.glob("%s/%s*" % (settings.MEDIA_ROOT,
-                                                obj_book.file)):
-                    os.remove(fl)
+    class Meta:
+        verbose_name = "arquivo a remover"
+        verbose_name_plural = "arquivos a remover"
 
-            super().save()
+    def __str__(self):
+        return self.path
 
-    def delete(self):
-        obj_photo = Book.objects.get(id=self.id)
-        super().delete()
 
-        if obj_photo.cover:
-            for fl in glob.glob("%s/%s*" % (settings.MEDIA_ROOT,
-                                            obj_photo.cover)):
-                os.remove(fl)
+class ImportCheckpoint(models.Model):
+
+    source = models.CharField('origem', max_length=255, unique=True)
+    records = models.PositiveIntegerField('registros lidos', default=0)
+    imported = models.PositiveIntegerField('livros importados', default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "importação"
+        verbose_name_plural = "importações"
+
+    def __str__(self):
+        return self.source
+
+
+class ExportCheckpoint(models.Model):
+
+    name = models.CharField('nome', max_length=100, unique=True)
+    cursor = models.CharField('última chave exportada', max_length=100,
+                              blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "exportação"
+        verbose_name_plural = "exportações"
+
+    def __str__(self):
+        return self.name
+
+
+def book_item_status_expression(today=None):
+    """
+    The ``BookItem.status`` a copy should have, computed by the database
+    from the copy, its last loan and its book.
+    """
+    today = today or date.today()
+    on_loan = (Q(last_history_item_id__isnull=False) &
+               Q(last_date_returned__isnull=True))
+    return Case(
+        When(on_loan & Q(last_date_due__lt=today),
+             then=Value(BookItem.PENDING)),
+        When(on_loan, then=Value(BookItem.BORROWED)),
+        When(Q(book__available=True) &
+             Q(available=True) &
+             Q(book__book_item_total__gt=F('book__book_item_unavailable')),
+             then=Value(BookItem.AVAILABLE)),
+        default=Value(BookItem.UNAVAILABLE),
+        output_field=models.PositiveSmallIntegerField())
+
+
+class BookItemQuerySet(models.QuerySet):
+    def with_drifted_status(self, today=None):
+        """
+        Copies whose stored ``status`` differs from the computed one, which
+        is annotated as ``expected_status``.
+        """
+        return self.annotate(
+            expected_status=book_item_status_expression(today)
+        ).exclude(status=F('expected_status'))
+
+    def refresh_status(self, today=None):
+        """
+        Recompute ``status`` for the copies of this queryset, writing only
+        the ones that drifted. Called inside the transactions that change
+        copies, loans or book counters. Returns the number of copies fixed.
+        """
+        changed = defaultdict(list)
+        for item_id, status in self.with_drifted_status(today).order_by(
+                ).values_list('id', 'expected_status'):
+            changed[status].append(item_id)
+
+        for status, ids in changed.items():
+            for i in range(0, len(ids), 500):
+                BookItem.objects.filter(id__in=ids[i:i + 500]).update(
+                    status=status)
+
+        return sum(len(ids) for ids in changed.values())
 
 
 class BookItemAvailableManager(models.Manager):
     def get_queryset(self):
-        return super().get_queryset().filter(
-            Q(book__available=True) &
-            Q(available=True) &
-            Q(book__book_item_total__gt=F('book__book_item_unavailable')),
-            Q(last_history_item_id__isnull=True) |
-            Q(last_history_item_id__isnull=False) &
-            Q(last_date_returned__isnull=False)
-        )
+        return super().get_queryset().filter(status=BookItem.AVAILABLE)
+
+    def titles(self, query=''):
+        """
+        One row per title with available copies, holding the lowest copy
+        id as ``id_min``. Every word of ``query`` must match the title,
+        the author or the publisher.
+        """
+        queryset = self.get_queryset()
+        for term in query.split():
+            queryset = queryset.filter(
+                Q(book__title__icontains=term) |
+                Q(book__author__name__icontains=term) |
+                Q(book__publisher__name__icontains=term))
+
+        return queryset.values(
+            'book_id',
+            'book__title',
+            'book__author__name',
+            'book__publisher__name'
+        ).annotate(id_min=Min('id')).order_by('book__title',
+                                              'book__author__name',
+                                              'book_id')
 
 
 class BookItem(models.Model):
@@ -256,11 +722,16 @@ class BookItem(models.Model):
     comments = models.TextField(verbose_name='observações',
                                 null=True, blank=True)
 
-    last_history_item_id = models.SmallIntegerField(
-                               verbose_name="ultimo empréstimo",
-                               blank=True, null=True)
-    last_reader_id = models.SmallIntegerField(verbose_name="ultimo leitor(a)",
-                                              blank=True, null=True)
+    last_history_item = models.ForeignKey('HistoryItem',
+                                          verbose_name="ultimo empréstimo",
+                                          blank=True, null=True,
+                                          on_delete=models.SET_NULL,
+                                          related_name='+')
+    last_reader = models.ForeignKey('Reader',
+                                    verbose_name="ultimo leitor(a)",
+                                    blank=True, null=True,
+                                    on_delete=models.SET_NULL,
+                                    related_name='+')
     last_date_taken = models.DateField(verbose_name="data ultimo empréstimo",
                                        blank=True, null=True)
     last_date_due = models.DateField(verbose_name="previsão de entrega",
@@ -268,8 +739,24 @@ class BookItem(models.Model):
     last_date_returned = models.DateField(verbose_name="entregue em",
                                      blank=True, null=True)
 
+    ''' MAINTAINED BY refresh_status, NEVER EDITED BY HAND '''
+    status = models.PositiveSmallIntegerField('situação',
+                                              choices=AVAILABLE_CHOICES,
+                                              default=AVAILABLE,
+                                              editable=False,
+                                              db_index=True)
+
+    ''' last_* FIELDS AND THE HistoryItem FIELDS THEY COPY '''
+    LAST_LOAN_FIELDS = (
+        ('last_history_item_id', 'id'),
+        ('last_reader_id', 'reader_id'),
+        ('last_date_taken', 'date_taken'),
+        ('last_date_due', 'date_due'),
+        ('last_date_returned', 'date_returned'),
+    )
+
     ''' Managers '''
-    objects = models.Manager()
+    objects = BookItemQuerySet.as_manager()
     obj_availables = BookItemAvailableManager()
 
     class Meta:
@@ -289,39 +776,55 @@ class BookItem(models.Model):
         self.__original_available = self.available
 
     def save(self):
-        if not self.id:
-            super().save()
-            book = Book.objects.get(id=self.book.id)
-            book.book_item_total += 1
-            if not self.available:
-                book.book_item_unavailable += 1
-            book.save()
-        else:
-            if self.book.id != self.__original_book:
-                book = Book.objects.get(id=self.book.id)
-                book.book_item_total += 1
-                book.save()
-
-                original_book = Book.objects.get(id=self.__original_book)
-                original_book.book_item_total -= 1
-                original_book.save()
+        total = Counter()
+        unavailable = Counter()
 
-            if self.__original_available != self.available:
-                book = Book.objects.get(id=self.book.id)
+        with transaction.atomic():
+            if not self.id:
+                super().save()
+                total[self.book_id] += 1
                 if not self.available:
-                    book.book_item_unavailable += 1
-                else:
-                    book.book_item_unavailable -= 1
-                book.save()
+                    unavailable[self.book_id] += 1
+            else:
+                if self.book_id != self.__original_book:
+                    total[self.book_id] += 1
+                    total[self.__original_book] -= 1
+
+                    ''' OPEN LOANS OF THE COPY ARE COUNTED BY ITS BOOK '''
+                    moved = self.historyitem_set.filter(
+                        date_returned__isnull=True).count()
+                    if not self.__original_available:
+                        moved += 1
+                    unavailable[self.__original_book] -= moved
+                    unavailable[self.book_id] += moved
+
+                if self.__original_available != self.available:
+                    if not self.available:
+                        unavailable[self.book_id] += 1
+                    else:
+                        unavailable[self.book_id] -= 1
+
+                super().save()
+
+            Book.objects.adjust_counters(total=total, unavailable=unavailable)
+            BookItem.objects.filter(
+                book_id__in={self.book_id, self.__original_book}
+            ).refresh_status()
 
-            super().save()
+        self.__original_book = self.book_id
+        self.__original_available = self.available
 
     def delete(self):
-        super().delete()
-        book = Book.objects.get(id=self.book.id)
-        if (book.book_item_total > 0):
-            book.book_item_total -= 1
-            book.save()
+        with transaction.atomic():
+            ''' LOANS ARE DELETED IN CASCADE, WITHOUT HistoryItem.delete '''
+            open_loans = self.historyitem_set.filter(
+                             date_returned__isnull=True).count()
+            unavailable = open_loans + (0 if self.available else 1)
+
+            super().delete()
+            Book.objects.adjust_counters(total={self.book_id: -1},
+                                         unavailable={self.book_id: -unavailable})
+            BookItem.objects.filter(book_id=self.book_id).refresh_status()
 
 
 # noinspection PyAbstractClass
@@ -329,6 +832,8 @@ class Reader(User):
 
     phone_number = models.CharField(blank=True, verbose_name="Telefone", max_length=16)
     address = models.CharField(verbose_name="Endereço", blank=True, max_length=50)
+    name_key = models.CharField(max_length=200, editable=False,
+                                db_index=True)
     objects = UserManager()
 
     class Meta:
@@ -341,6 +846,329 @@ class Reader(User):
             self.username
         )
 
+    def save(self, *args, **kwargs):
+        ''' THE USERNAME STANDS FOR READERS WITHOUT A NAME '''
+        self.name_key = name_key('%s %s' % (self.first_name, self.last_name)
+                                 ) or name_key(self.username)
+        super().save(*args, **kwargs)
+
+
+class HistoryItemManager(models.Manager):
+
+    def checkout_many(self, reader, book_items, date_due, date_taken=None,
+                      daily_fine=0):
+        """
+        Open one loan per copy in ``book_items`` for ``reader``.
+
+        The copies are locked and checked for availability, then the loans,
+        the ``last_*`` fields of the copies and the book counters are written
+        with a constant number of queries, whatever the size of the batch.
+        Returns the created loans.
+        """
+        book_item_ids = {getattr(item, 'pk', item) for item in book_items}
+        date_taken = date_taken or date.today()
+        if not book_item_ids:
+            return []
+
+        with transaction.atomic():
+            available = dict(BookItem.obj_availables.select_for_update(
+                ).filter(id__in=book_item_ids).values_list('id', 'book_id'))
+
+            unavailable_ids = book_item_ids - set(available)
+            if unavailable_ids:
+                raise ValidationError(
+                    _('Exemplares indisponíveis: %(ids)s'),
+                    params={'ids': ', '.join(
+                        str(i) for i in sorted(unavailable_ids))})
+
+            reader_id = getattr(reader, 'pk', reader)
+            history_items = []
+            for book_item_id in sorted(available):
+                history_item = HistoryItem(book_item_id=book_item_id,
+                                           reader_id=reader_id,
+                                           date_taken=date_taken,
+                                           date_due=date_due,
+                                           daily_fine=daily_fine)
+                history_item.fine = history_item.calculate_fine()
+                history_item.status = history_item.calculate_status()
+                history_items.append(history_item)
+
+            self.bulk_create(history_items)
+
+            ''' ONLY SOME BACKENDS SET THE PK ON bulk_create '''
+            if history_items[0].pk is None:
+                ids = dict(self.filter(
+                    book_item_id__in=available,
+                    date_returned__isnull=True
+                ).order_by().values('book_item_id').annotate(
+                    last_id=Max('id')).values_list('book_item_id', 'last_id'))
+                for history_item in history_items:
+                    history_item.pk = ids[history_item.book_item_id]
+
+            ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
+            BookItem.objects.filter(id__in=available).update(
+                last_history_item_id=Case(
+                    *[When(id=item.book_item_id, then=Value(item.pk))
+                      for item in history_items],
+                    output_field=IntegerField()),
+                last_reader_id=reader_id,
+                last_date_taken=date_taken,
+                last_date_due=date_due,
+                last_date_returned=None)
+
+            ''' COUNT BOOK ITEM UNAVAILABLE '''
+            Book.objects.adjust_counters(
+                unavailable=Counter(available.values()))
+            BookItem.objects.filter(
+                book_id__in=set(available.values())).refresh_status()
+
+            caching.invalidate_key(caching.READER_ACCOUNT, reader_id)
+            self.send_overdue([item for item in history_items
+                               if item.status == HistoryItem.PENDING])
+
+        return history_items
+
+    def return_many(self, history_items, date_returned=None):
+        """
+        Close the open loans in ``history_items`` on ``date_returned``.
+
+        Fines, the ``last_date_returned`` of the copies still pointing at
+        these loans and the book counters are updated set-based. Loans
+        already returned are ignored. Returns the number of loans closed.
+        """
+        history_item_ids = {getattr(item, 'pk', item) for item in history_items}
+        date_returned = date_returned or date.today()
+        if not history_item_ids:
+            return 0
+
+        with transaction.atomic():
+            open_items = list(self.select_for_update().filter(
+                id__in=history_item_ids, date_returned__isnull=True
+            ).select_related('book_item'))
+            if not open_items:
+                return 0
+
+            fines = defaultdict(list)
+            for history_item in open_items:
+                history_item.date_returned = date_returned
+                fines[history_item.calculate_fine()].append(history_item.id)
+
+            self.filter(id__in=[item.id for item in open_items]).update(
+                date_returned=date_returned,
+                status=HistoryItem.RETURNED,
+                fine=Case(*[When(id__in=ids, then=Value(fine))
+                            for fine, ids in fines.items()],
+                          default=Value(0),
+                          output_field=IntegerField()))
+
+            ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
+            BookItem.objects.filter(id__in=[
+                item.book_item_id for item in open_items
+                if item.book_item.last_history_item_id == item.id
+            ]).update(last_date_returned=date_returned)
+
+            ''' COUNT BOOK ITEM UNAVAILABLE '''
+            book_ids = Counter(item.book_item.book_id for item in open_items)
+            Book.objects.adjust_counters(unavailable={
+                book_id: -count for book_id, count in book_ids.items()})
+            BookItem.objects.filter(book_id__in=book_ids).refresh_status()
+
+            for reader_id in {item.reader_id for item in open_items}:
+                caching.invalidate_key(caching.READER_ACCOUNT, reader_id)
+
+        return len(open_items)
+
+    def send_overdue(self, history_items, today=None):
+        """
+        Send ``loans_overdue`` for ``history_items`` once the current
+        transaction commits.
+        """
+        from .signals import loans_overdue
+
+        history_items = list(history_items)
+        today = today or date.today()
+        if history_items:
+            transaction.on_commit(lambda: loans_overdue.send(
+                sender=self.model, history_items=history_items, date=today))
+
+    def mark_overdue(self, today=None):
+        """
+        Move the open loans due before ``today`` from BORROWED to PENDING,
+        along with their copies, and send ``loans_overdue`` for them.
+
+        Loans marked by earlier runs are no longer BORROWED, so the
+        ``(status, date_due)`` index only hands this run the loans due since
+        the last one. Returns the loans marked.
+        """
+        today = today or date.today()
+
+        with transaction.atomic():
+            history_items = list(self.select_for_update().filter(
+                status=HistoryItem.BORROWED, date_due__lt=today
+            ).order_by('date_due', 'id'))
+            if not history_items:
+                return []
+
+            ids = [item.id for item in history_items]
+            for i in range(0, len(ids), 500):
+                chunk = history_items[i:i + 500]
+                self.filter(id__in=ids[i:i + 500]).update(
+                    status=HistoryItem.PENDING)
+                BookItem.objects.filter(
+                    id__in={item.book_item_id for item in chunk},
+                    last_history_item_id__in=ids[i:i + 500],
+                    status=BookItem.BORROWED
+                ).update(status=BookItem.PENDING)
+
+            for history_item in history_items:
+                history_item.status = HistoryItem.PENDING
+
+            caching.invalidate(caching.AVAILABILITY)
+            for reader_id in {item.reader_id for item in history_items}:
+                caching.invalidate_key(caching.READER_ACCOUNT, reader_id)
+            self.send_overdue(history_items, today)
+
+        return history_items
+
+    def rebuild_latest(self, book_item_ids=None):
+        """
+        Point the copies of ``book_item_ids`` (all of them by default) at
+        their most recent loan with set-based UPDATEs, for imports and
+        repairs. Returns the number of copies updated.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        book_item = qn(BookItem._meta.db_table)
+
+        ''' ONE INDEXED SUBQUERY PER COLUMN, ALL OF THEM PORTABLE '''
+        latest = '''
+            SELECT hi.{source} FROM {history_item} hi
+            WHERE hi.book_item_id = {book_item}.id
+            ORDER BY hi.date_taken DESC, hi.id DESC LIMIT 1
+        '''
+        sql = 'UPDATE {book_item} SET {columns}'.format(
+            book_item=book_item,
+            columns=', '.join('%s = (%s)' % (
+                qn(BookItem._meta.get_field(target).column),
+                latest.format(
+                    source=qn(self.model._meta.get_field(source).column),
+                    history_item=qn(self.model._meta.db_table),
+                    book_item=book_item))
+                for target, source in BookItem.LAST_LOAN_FIELDS))
+
+        if book_item_ids is None:
+            chunks = [None]
+        else:
+            book_item_ids = sorted(set(book_item_ids))
+            chunks = [book_item_ids[i:i + 500]
+                      for i in range(0, len(book_item_ids), 500)]
+
+        rows = 0
+        with transaction.atomic(using=self.db):
+            for chunk in chunks:
+                queryset = BookItem.objects.using(self.db)
+                with connection.cursor() as cursor:
+                    if chunk is None:
+                        cursor.execute(sql)
+                    else:
+                        cursor.execute('%s WHERE id IN (%s)' % (
+                            sql, ', '.join(['%s'] * len(chunk))), chunk)
+                        queryset = queryset.filter(id__in=chunk)
+                    rows += cursor.rowcount
+
+                queryset.refresh_status()
+
+        caching.invalidate(caching.AVAILABILITY)
+        return rows
+
+    def accrue_fines(self, today=None):
+        """
+        Bring the fines of the open overdue loans up to
+        ``daily_fine * (today - date_due)`` with one UPDATE, touching only
+        the rows whose fine changes. Returns the number of rows updated.
+        """
+        today = today or date.today()
+        connection = connections[self.db]
+        if connection.vendor not in DAYS_SINCE_SQL:
+            return self._accrue_fines_by_row(today)
+        days = DAYS_SINCE_SQL[connection.vendor]
+
+        fine = ('CASE WHEN daily_fine * {days} > {max} THEN {max} '
+                'ELSE daily_fine * {days} END').format(days=days,
+                                                      max=MAX_FINE)
+        ''' OPEN LOANS BY status, SO THE (status, date_due) INDEX IS USED '''
+        sql = '''
+            UPDATE {table} SET fine = {fine}
+            WHERE status IN ({borrowed}, {pending}) AND date_due < %s
+            AND fine <> {fine}
+        '''.format(table=connection.ops.quote_name(self.model._meta.db_table),
+                   fine=fine, borrowed=HistoryItem.BORROWED,
+                   pending=HistoryItem.PENDING)
+
+        with transaction.atomic(using=self.db):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [today] * sql.count('%s'))
+                rows = cursor.rowcount
+
+        if rows:
+            caching.invalidate(caching.READER_ACCOUNT)
+        return rows
+
+    def _accrue_fines_by_row(self, today):
+        """
+        ``accrue_fines`` for databases without a ``DAYS_SINCE_SQL``: the
+        fines are computed here and written with one UPDATE per amount.
+        """
+        changed = defaultdict(list)
+        for id, daily_fine, date_due, fine in self.filter(
+                status__in=[HistoryItem.BORROWED, HistoryItem.PENDING],
+                date_due__lt=today).values_list(
+                'id', 'daily_fine', 'date_due', 'fine').iterator():
+            new_fine = min(daily_fine * (today - date_due).days, MAX_FINE)
+            if new_fine != fine:
+                changed[new_fine].append(id)
+
+        with transaction.atomic(using=self.db):
+            for fine, ids in changed.items():
+                for i in range(0, len(ids), 500):
+                    self.filter(id__in=ids[i:i + 500]).update(fine=fine)
+
+        rows = sum(len(ids) for ids in changed.values())
+        if rows:
+            caching.invalidate(caching.READER_ACCOUNT)
+        return rows
+
+    def account_summary(self, reader):
+        """
+        Open loans, overdue loans and unpaid fines of ``reader``, computed
+        with one aggregate query and cached until the reader's loans change
+        or the day turns.
+        """
+        reader_id = getattr(reader, 'pk', reader)
+        today = date.today()
+        key = caching.make_key(caching.READER_ACCOUNT, reader_id)
+
+        summary = cache.get(key)
+        if summary is None or summary['date'] != today:
+            summary = self.filter(reader_id=reader_id).aggregate(
+                open_loans=Sum(Case(
+                    When(date_returned__isnull=True, then=Value(1)),
+                    default=Value(0), output_field=IntegerField())),
+                overdue=Sum(Case(
+                    When(date_returned__isnull=True, date_due__lt=today,
+                         then=Value(1)),
+                    default=Value(0), output_field=IntegerField())),
+                fine_owed=Sum(Case(
+                    When(Q(fine__gt=0) &
+                         (Q(is_fine_paid=False) | Q(is_fine_paid__isnull=True)),
+                         then=F('fine')),
+                    default=Value(0), output_field=IntegerField())))
+            summary = {k: v or 0 for k, v in summary.items()}
+            summary['date'] = today
+            cache.set(key, summary, ACCOUNT_CACHE_TIMEOUT)
+
+        return summary
+
 
 class HistoryItem(models.Model):
 
@@ -356,8 +1184,9 @@ class HistoryItem(models.Model):
 
     book_item = models.ForeignKey(BookItem, verbose_name="exemplar")
     reader = models.ForeignKey(Reader, verbose_name="leitor(a)")
-    date_taken = models.DateField(verbose_name="emprestado em")
-    date_due = models.DateField(verbose_name="à ser entregue em")
+    date_taken = models.DateField(verbose_name="emprestado em", db_index=True)
+    date_due = models.DateField(verbose_name="à ser entregue em",
+                                db_index=True)
     date_returned = models.DateField(verbose_name="entregue em",
                                      blank=True, null=True)
     fine = models.SmallIntegerField(verbose_name="multa total", default=0)
@@ -365,10 +1194,24 @@ class HistoryItem(models.Model):
     is_fine_paid = models.NullBooleanField(verbose_name="multa paga?",
                                            default=False)
 
+    ''' SET BY save, return_many AND mark_overdue '''
+    status = models.PositiveSmallIntegerField('situação',
+                                              choices=STATUS_CHOICES,
+                                              default=BORROWED,
+                                              editable=False)
+
+    objects = HistoryItemManager()
+
     class Meta:
         verbose_name = u"empréstimo"
         verbose_name_plural = u"empréstimos"
         ordering = ['-date_taken']
+        index_together = [
+            ('status', 'date_due'),
+            ('status', 'date_taken'),
+            ('book_item', 'date_taken'),
+            ('reader', 'date_taken'),
+        ]
 
     def __str__(self):
         return u'{}: №{} {} - {}'.format(
@@ -380,122 +1223,150 @@ class HistoryItem(models.Model):
     def calculate_fine(self):
         if self.date_due < date.today():
             if not self.date_returned:
-                return self.daily_fine * (date.today() - self.date_due).days
+                fine = self.daily_fine * (date.today() - self.date_due).days
             elif self.date_returned > self.date_due:
-                return self.daily_fine * (self.date_returned - self.date_due).days
+                fine = self.daily_fine * (self.date_returned - self.date_due).days
             else:
                 return 0
+            ''' THE SAME CAP AS accrue_fines '''
+            return min(fine, MAX_FINE)
         else:
             return 0
 
+    def calculate_status(self):
+        if self.date_returned:
+            return self.RETURNED
+        elif self.date_due < date.today():
+            return self.PENDING
+        else:
+            return self.BORROWED
+
+    def last_loan_values(self):
+        """ Values of the ``last_*`` fields of a copy lent by this loan. """
+        return {target: getattr(self, source)
+                for target, source in BookItem.LAST_LOAN_FIELDS}
+
     def set_latest_history_item(self, book_item_id):
-        try:
-            last_book_item = HistoryItem.objects.filter(
-            book_item=book_item_id).latest('date_taken')
-        except ObjectDoesNotExist:
-            last_book_item = None
-
-        book_item = BookItem.objects.get(id=book_item_id)
-        if last_book_item:
-            book_item.last_history_item_id = last_book_item.id
-            book_item.last_reader_id = last_book_item.reader.id
-            book_item.last_date_taken = last_book_item.date_taken
-            book_item.last_date_due = last_book_item.date_due
-            book_item.last_date_returned = last_book_item.date_returned
+        """
+        Point ``book_item_id`` at its most recent loan, found through the
+        ``(book_item, date_taken)`` index. Only the ``last_*`` columns are
+        written, without going through ``BookItem.save``.
+        """
+        latest = HistoryItem.objects.filter(book_item=book_item_id).order_by(
+            '-date_taken', '-id').first()
+        if latest:
+            values = latest.last_loan_values()
         else:
-            book_item.last_history_item_id = None
-            book_item.last_reader_id = None
-            book_item.last_date_taken = None
-            book_item.last_date_due = None
-            book_item.last_date_returned = None
-        book_item.save()
+            values = dict.fromkeys(
+                target for target, source in BookItem.LAST_LOAN_FIELDS)
+        BookItem.objects.filter(id=book_item_id).update(**values)
+
+    def promote_to_latest(self):
+        """
+        Point the copy at this loan if it is more recent than the copy's
+        current last loan, with one conditional UPDATE.
+        """
+        BookItem.objects.filter(
+            Q(last_history_item__isnull=True) |
+            Q(last_date_taken__lt=self.date_taken) |
+            Q(last_date_taken=self.date_taken,
+              last_history_item_id__lt=self.id),
+            id=self.book_item_id
+        ).update(**self.last_loan_values())
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        if self.id:
-            self.__original_book_item = self.book_item
+        self.__original_book_item = self.book_item_id
+        self.__original_date_taken = self.date_taken
         self.__original_date_returned = self.date_returned
+        self.__original_reader = self.reader_id
+        self.__original_status = self.status
 
     def save(self, *args, **kwargs):
         self.fine = self.calculate_fine()
+        self.status = self.calculate_status()
 
-        if not self.id:
-            super().save()
+        with transaction.atomic():
+            if not self.id:
+                super().save()
 
-            ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
-            book_item = BookItem.objects.get(id=self.book_item.id)
-            book_item.last_history_item_id = self.id
-            book_item.last_reader_id = self.reader.id
-            book_item.last_date_taken = self.date_taken
-            book_item.last_date_due = self.date_due
-            book_item.last_date_returned = self.date_returned
-            book_item.save()
+                ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
+                self.promote_to_latest()
 
-            ''' COUNT BOOK ITEM UNAVAILABLE '''
-            if not self.date_returned:
-                book = Book.objects.get(id=self.book_item.book_id)
-                book.book_item_unavailable += 1
-                book.save()
-        else:
-            ''' COUNT BOOK ITEM UNAVAILABLE '''
-            if self.__original_book_item.id != self.book_item.id:
-                if self.__original_date_returned == self.date_returned:
-                    if not self.date_returned:
-                        book = Book.objects.get(
-                                   id=self.__original_book_item.book_id)
-                        book.book_item_unavailable -= 1
-                        book.save()
-
-                        book = Book.objects.get(id=self.book_item.book_id)
-                        book.book_item_unavailable += 1
-                        book.save()
-                else:
-                    if not self.__original_date_returned:
-                        book = Book.objects.get(
-                                   id=self.__original_book_item.book_id)
-                        book.book_item_unavailable -= 1
-                        book.save()
-                    if not self.date_returned:
-                        book = Book.objects.get(id=self.book_item.book_id)
-                        book.book_item_unavailable += 1
-                        book.save()
+                ''' COUNT BOOK ITEM UNAVAILABLE '''
+                book_id = self.book_item.book_id
+                if not self.date_returned:
+                    Book.objects.adjust_counters(unavailable={book_id: 1})
+
+                book_ids = {book_id}
             else:
-                if self.__original_date_returned != self.date_returned:
-                    if not self.__original_date_returned:
-                        book = Book.objects.get(id=self.book_item.book_id)
-                        book.book_item_unavailable -= 1
-                        book.save()
-                    if not self.date_returned:
-                        book = Book.objects.get(id=self.book_item.book_id)
-                        book.book_item_unavailable += 1
-                        book.save()
-
-            super().save()
+                original_book_item = BookItem.objects.select_for_update(
+                    ).values('book_id', 'last_history_item_id'
+                    ).get(id=self.__original_book_item)
+
+                ''' COUNT BOOK ITEM UNAVAILABLE '''
+                unavailable = Counter()
+                if not self.__original_date_returned:
+                    unavailable[original_book_item['book_id']] -= 1
+                if not self.date_returned:
+                    unavailable[self.book_item.book_id] += 1
+
+                super().save()
+                Book.objects.adjust_counters(unavailable=unavailable)
+
+                ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
+                was_latest = (original_book_item['last_history_item_id'] ==
+                              self.id)
+                moved = self.__original_book_item != self.book_item_id
+                if (was_latest and not moved and
+                        self.date_taken >= self.__original_date_taken):
+                    ''' STILL THE LATEST LOAN, ONLY ITS VALUES CHANGED '''
+                    BookItem.objects.filter(id=self.book_item_id).update(
+                        **self.last_loan_values())
+                else:
+                    if was_latest:
+                        self.set_latest_history_item(self.__original_book_item)
+                    if moved or self.date_taken != self.__original_date_taken:
+                        self.promote_to_latest()
 
-            ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
-            if self.__original_book_item.last_history_item_id == self.id:
-                if self.__original_book_item.id != self.book_item.id:
-                    self.set_latest_history_item(self.__original_book_item.id)
-
-                book_item = BookItem.objects.get(id=self.book_item.id)
-                book_item.last_history_item_id = self.id
-                book_item.last_reader_id = self.reader.id
-                book_item.last_date_taken = self.date_taken
-                book_item.last_date_due = self.date_due
-                book_item.last_date_returned = self.date_returned
-                book_item.save()
+                book_ids = {original_book_item['book_id'],
+                            self.book_item.book_id}
+
+            BookItem.objects.filter(book_id__in=book_ids).refresh_status()
+            caching.invalidate(caching.AVAILABILITY)
+            for reader_id in {self.reader_id, self.__original_reader} - {None}:
+                caching.invalidate_key(caching.READER_ACCOUNT, reader_id)
+
+            if (self.status == self.PENDING and
+                    self.__original_status != self.PENDING):
+                HistoryItem.objects.send_overdue([self])
+
+        self.__original_book_item = self.book_item_id
+        self.__original_date_taken = self.date_taken
+        self.__original_date_returned = self.date_returned
+        self.__original_reader = self.reader_id
+        self.__original_status = self.status
 
     def delete(self):
         id = self.id
-        super().delete()
+        with transaction.atomic():
+            ''' READ BEFORE THE DELETE SETS ITS POINTER TO NULL, AND NOT FROM
+                A CACHED self.book_item THAT MAY BE OLDER THAN THE POINTER '''
+            book_item = BookItem.objects.select_for_update().values(
+                'book_id', 'last_history_item_id').get(id=self.book_item_id)
+            super().delete()
+            caching.invalidate(caching.AVAILABILITY)
+            caching.invalidate_key(caching.READER_ACCOUNT, self.reader_id)
 
-        ''' COUNT BOOK ITEM UNAVAILABLE '''
-        if not self.date_returned:
-            book = Book.objects.get(id=self.book_item.book_id)
-            book.book_item_unavailable -= 1
-            book.save()
+            ''' COUNT BOOK ITEM UNAVAILABLE '''
+            if not self.date_returned:
+                Book.objects.adjust_counters(
+                    unavailable={book_item['book_id']: -1})
+
+            ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
+            if book_item['last_history_item_id'] == id:
+                self.set_latest_history_item(self.book_item_id)
 
-        ''' PERSIST VALUES OF LAST BORROWED BOOK ITEM '''
-        if self.book_item.last_history_item_id == id:
-            self.set_latest_history_item(self.book_item.id)
+            BookItem.objects.filter(
+                book_id=book_item['book_id']).refresh_status()
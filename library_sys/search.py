@@ -0,0 +1,435 @@
+"""
+Full text search over the active books of the catalogue.
+
+Books are indexed by title, author, ISBN, publisher, categories and
+synopsis. Text is case and accent folded ("Análise" matches "analise")
+and every query word matches as a prefix. Results are ranked, with hits
+on the title weighing more than hits on the synopsis.
+
+Backends:
+    SQLiteFTS5Backend: FTS5 virtual table, used on SQLite when it was built
+        with FTS5.
+    PostgresBackend: tsvector table with a GIN index, used on PostgreSQL.
+    MemoryBackend: inverted index kept in the memory of the process, used
+        by any other database. For development and single process servers
+        only: each process loads its own index on its first search and
+        never sees the changes made by other processes (nor by
+        ``rebuild_search_index``) until it restarts.
+
+``LIBRARY_SYS_SEARCH_BACKEND`` may hold the dotted path of the backend
+class to use instead. The index follows Book, Author, Publisher and
+Category changes (see ``signals.py``).
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+import re
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils.module_loading import import_string
+
+FIELDS = (
+    ('title', 8),
+    ('author', 4),
+    ('isbn', 4),
+    ('publisher', 2),
+    ('categories', 2),
+    ('synopsis', 1),
+)
+WEIGHTS = dict(FIELDS)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    """
+    Fold case and accents of ``text`` and return its words.
+    """
+    text = unicodedata.normalize('NFKD', str(text or ''))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return TOKEN_RE.findall(text.casefold())
+
+
+def parse_terms(text, field=None):
+    """
+    Turn ``text`` into search terms, ``(field, word)`` pairs. A term with
+    no field matches any of them.
+    """
+    return [(field, word) for word in normalize(text)]
+
+
+def book_documents(queryset):
+    """
+    Yield ``(book_id, {field: words})`` for the books of ``queryset``.
+    """
+    queryset = queryset.select_related('author', 'publisher').prefetch_related(
+        'category')
+    for book in queryset:
+        isbn = normalize(book.isbn)
+        if len(isbn) > 1:
+            isbn.append(''.join(isbn))
+
+        yield book.id, {
+            'title': normalize(book.title),
+            'author': normalize(book.author.name),
+            'isbn': isbn,
+            'publisher': normalize(book.publisher.name),
+            'categories': normalize(' '.join(
+                category.title for category in book.category.all())),
+            'synopsis': normalize(book.synopsis),
+        }
+
+
+class BaseSearchBackend(object):
+
+    def search(self, terms, limit=20, after=None):
+        """
+        Return ``(hits, total)``: up to ``limit`` ``(rank, book_id)`` pairs
+        of the books matching every term, best first (lowest rank), and the
+        total of books matching.
+
+        Pages are read by keyset: ``after`` is the last pair of the previous
+        page, so no page scans the ones before it.
+        """
+        raise NotImplementedError
+
+    def index(self, documents):
+        raise NotImplementedError
+
+    def remove(self, book_ids):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def update(self, book_ids):
+        """
+        Index again the books of ``book_ids``, dropping the inactive ones.
+        """
+        from .models import Book
+
+        book_ids = set(book_ids)
+        documents = list(book_documents(
+            Book.obj_active.filter(id__in=book_ids)))
+        self.remove(book_ids - {book_id for book_id, fields in documents})
+        self.index(documents)
+
+    def rebuild(self, queryset=None):
+        """
+        Index the whole catalogue again. ``queryset`` defaults to the
+        active books.
+        """
+        from .models import Book
+
+        if queryset is None:
+            queryset = Book.obj_active.all()
+
+        self.clear()
+        batch = []
+        for document in book_documents(queryset.order_by('id')):
+            batch.append(document)
+            if len(batch) == 500:
+                self.index(batch)
+                batch = []
+        self.index(batch)
+
+
+class MemoryBackend(BaseSearchBackend):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.postings = defaultdict(lambda: defaultdict(set))
+            self.vocabulary = []
+            self.documents = {}
+
+    def rebuild(self, queryset=None):
+        """
+        Build a new index apart and swap it in, so searches and updates
+        only wait for the swap.
+        """
+        index = MemoryBackend()
+        BaseSearchBackend.rebuild(index, queryset)
+        with self.lock:
+            self.postings = index.postings
+            self.vocabulary = index.vocabulary
+            self.documents = index.documents
+            self.loaded = True
+
+    def index(self, documents):
+        with self.lock:
+            for book_id, fields in documents:
+                self._remove(book_id)
+                self.documents[book_id] = fields
+                for field, words in fields.items():
+                    for word in words:
+                        if word not in self.postings:
+                            self.vocabulary.insert(
+                                bisect_left(self.vocabulary, word), word)
+                        self.postings[word][field].add(book_id)
+
+    def remove(self, book_ids):
+        with self.lock:
+            for book_id in book_ids:
+                self._remove(book_id)
+
+    def _remove(self, book_id):
+        for field, words in self.documents.pop(book_id, {}).items():
+            for word in words:
+                self.postings[word][field].discard(book_id)
+
+    def _expand(self, prefix):
+        i = bisect_left(self.vocabulary, prefix)
+        while (i < len(self.vocabulary) and
+               self.vocabulary[i].startswith(prefix)):
+            yield self.vocabulary[i]
+            i += 1
+
+    def search(self, terms, limit=20, after=None):
+        if not self.loaded:
+            with self.load_lock:
+                if not self.loaded:
+                    self.rebuild()
+
+        with self.lock:
+            scores = None
+            for term_field, prefix in terms:
+                matches = defaultdict(int)
+                for word in self._expand(prefix):
+                    boost = 2 if word == prefix else 1
+                    for field, book_ids in self.postings[word].items():
+                        if term_field and field != term_field:
+                            continue
+                        for book_id in book_ids:
+                            matches[book_id] = max(matches[book_id],
+                                                   WEIGHTS[field] * boost)
+
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {book_id: score + matches[book_id]
+                              for book_id, score in scores.items()
+                              if book_id in matches}
+
+        ranked = [(-score, book_id) for book_id, score in
+                  (scores or {}).items()]
+        hits = sorted(hit for hit in ranked if after is None or hit > after)
+        return hits[:limit], len(ranked)
+
+
+class SQLiteFTS5Backend(BaseSearchBackend):
+
+    table = 'library_sys_book_fts'
+
+    @classmethod
+    def create_table(cls, cursor):
+        cursor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s)' % (
+                cls.table, ', '.join(field for field, w in FIELDS)))
+
+    @classmethod
+    def drop_table(cls, cursor):
+        cursor.execute('DROP TABLE IF EXISTS %s' % cls.table)
+
+    def index(self, documents):
+        documents = list(documents)
+        if not documents:
+            return
+
+        self.remove([book_id for book_id, fields in documents])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO %s (rowid, %s) VALUES (%%s, %s)' % (
+                    self.table,
+                    ', '.join(field for field, w in FIELDS),
+                    ', '.join(['%s'] * len(FIELDS))),
+                [[book_id] + [' '.join(fields[field]) for field, w in FIELDS]
+                 for book_id, fields in documents])
+
+    def remove(self, book_ids):
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (
+                self.table, ', '.join(['%s'] * len(book_ids))), book_ids)
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % self.table)
+
+    def search(self, terms, limit=20, after=None):
+        if not terms:
+            return [], 0
+
+        match = ' AND '.join(
+            '%s"%s" *' % ('%s : ' % field if field else '', word)
+            for field, word in terms)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s WHERE %s MATCH %%s' % (
+                self.table, self.table), [match])
+            total = cursor.fetchone()[0]
+
+            where, params = '', [match]
+            if after:
+                where = 'WHERE score > %s OR (score = %s AND rowid > %s)'
+                params += [after[0], after[0], after[1]]
+
+            cursor.execute(
+                'SELECT score, rowid FROM ('
+                'SELECT bm25(%s, %s) AS score, rowid FROM %s '
+                'WHERE %s MATCH %%s) %s ORDER BY score, rowid LIMIT %%s' % (
+                    self.table,
+                    ', '.join(str(weight) for field, weight in FIELDS),
+                    self.table, self.table, where),
+                params + [limit])
+            return [tuple(row) for row in cursor.fetchall()], total
+
+
+class PostgresBackend(BaseSearchBackend):
+
+    table = 'library_sys_book_search'
+    labels = {'title': 'A', 'author': 'B', 'isbn': 'B', 'publisher': 'C',
+              'categories': 'C', 'synopsis': 'D'}
+
+    @classmethod
+    def create_table(cls, cursor):
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS %s ('
+            'book_id integer PRIMARY KEY, document tsvector NOT NULL, %s)'
+            % (cls.table, ', '.join('%s tsvector' % field
+                                    for field, w in FIELDS)))
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS %s_document ON %s '
+            'USING gin (document)' % (cls.table, cls.table))
+
+    @classmethod
+    def drop_table(cls, cursor):
+        cursor.execute('DROP TABLE IF EXISTS %s' % cls.table)
+
+    def index(self, documents):
+        documents = list(documents)
+        if not documents:
+            return
+
+        columns = ', '.join(field for field, w in FIELDS)
+        vectors = ', '.join(["to_tsvector('simple', %s)"] * len(FIELDS))
+        document = ' || '.join(
+            "setweight(to_tsvector('simple', %%s), '%s')" % self.labels[field]
+            for field, w in FIELDS)
+
+        self.remove([book_id for book_id, fields in documents])
+        with connection.cursor() as cursor:
+            for book_id, fields in documents:
+                values = [' '.join(fields[field]) for field, w in FIELDS]
+                cursor.execute(
+                    'INSERT INTO %s (book_id, document, %s) '
+                    'VALUES (%%s, %s, %s)' % (self.table, columns,
+                                              document, vectors),
+                    [book_id] + values + values)
+
+    def remove(self, book_ids):
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE book_id = ANY(%%s)' %
+                           self.table, [book_ids])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE %s' % self.table)
+
+    def search(self, terms, limit=20, after=None):
+        if not terms:
+            return [], 0
+
+        query = ' & '.join('%s:*' % word for field, word in terms)
+        where = ["document @@ to_tsquery('simple', %s)"]
+        params = [query]
+        for field, word in terms:
+            if field:
+                where.append("%s @@ to_tsquery('simple', %%s)" % field)
+                params.append('%s:*' % word)
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s WHERE %s' % (
+                self.table, ' AND '.join(where)), params)
+            total = cursor.fetchone()[0]
+
+            after_where, after_params = '', []
+            if after:
+                after_where = 'WHERE rank > %s OR (rank = %s AND book_id > %s)'
+                after_params = [after[0], after[0], after[1]]
+
+            cursor.execute(
+                "SELECT rank, book_id FROM ("
+                "SELECT -ts_rank(document, to_tsquery('simple', %%s))::float8 "
+                "AS rank, book_id FROM %s WHERE %s"
+                ") AS hits %s ORDER BY rank, book_id LIMIT %%s" % (
+                    self.table, ' AND '.join(where), after_where),
+                [query] + params + after_params + [limit])
+            return [tuple(row) for row in cursor.fetchall()], total
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_tables(connection):
+    """
+    Create the table of the database backend of ``connection``, if it has
+    one. Returns the class of the backend created or None. Used by the
+    migrations.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            PostgresBackend.create_table(cursor)
+            return PostgresBackend
+        elif connection.vendor == 'sqlite':
+            try:
+                SQLiteFTS5Backend.create_table(cursor)
+            except DatabaseError:
+                ''' SQLITE BUILT WITHOUT FTS5 '''
+                return None
+            return SQLiteFTS5Backend
+
+
+def drop_tables(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            PostgresBackend.drop_table(cursor)
+        elif connection.vendor == 'sqlite':
+            SQLiteFTS5Backend.drop_table(cursor)
+
+
+def get_backend():
+    """
+    Return the search backend of the project, created on first use.
+    """
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            path = getattr(settings, 'LIBRARY_SYS_SEARCH_BACKEND', None)
+            if path:
+                _backend = import_string(path)()
+            elif connection.vendor == 'postgresql':
+                _backend = PostgresBackend()
+            elif (connection.vendor == 'sqlite' and SQLiteFTS5Backend.table
+                  in connection.introspection.table_names()):
+                _backend = SQLiteFTS5Backend()
+            else:
+                _backend = MemoryBackend()
+
+    return _backend
@@ -0,0 +1,110 @@
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+
+from . import caching
+from .models import Author, Book, Category, Publisher, Reader
+from .search import get_backend
+
+''' SENT ONCE FOR EACH LOAN, AFTER THE COMMIT THAT MADE IT OVERDUE '''
+loans_overdue = Signal(providing_args=['history_items', 'date'])
+
+
+def update_search_index(book_ids):
+    """
+    Index the books of ``book_ids`` again once the transaction commits.
+    """
+    book_ids = set(book_ids)
+    if book_ids:
+        transaction.on_commit(lambda: get_backend().update(book_ids))
+
+
+def touch_books(queryset):
+    """
+    Bump ``updated_at`` of the books of ``queryset``, so their cached
+    detail pages and ETags change with them.
+    """
+    queryset.update(updated_at=timezone.now())
+
+
+''' Book FIELDS READ BY search.book_documents '''
+INDEXED_FIELDS = {'title', 'author', 'publisher', 'isbn', 'synopsis',
+                  'activated'}
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or update_fields and not INDEXED_FIELDS & set(update_fields):
+        return
+    update_search_index([instance.id])
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    book_id = instance.id
+    transaction.on_commit(lambda: get_backend().remove([book_id]))
+
+
+@receiver(m2m_changed, sender=Book.category.through)
+def book_category_changed(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            touch_books(Book.objects.filter(id=instance.id))
+            update_search_index([instance.id])
+    elif action in ('post_add', 'post_remove'):
+        touch_books(Book.objects.filter(id__in=pk_set))
+        update_search_index(pk_set)
+    elif action == 'pre_clear':
+        touch_books(instance.book_set.all())
+        update_search_index(instance.book_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Publisher)
+@receiver(post_save, sender=Category)
+def name_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        touch_books(instance.book_set.all())
+        update_search_index(instance.book_set.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    ''' THE LINKS TO THE BOOKS ARE GONE WITHOUT m2m_changed '''
+    touch_books(instance.book_set.all())
+    update_search_index(instance.book_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Publisher)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Reader)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Publisher)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Reader)
+def autocompleted_changed(sender, raw=False, update_fields=None, **kwargs):
+    ''' THE PAGES OF THE ADMIN autocomplete/ VIEWS, NOT ON EVERY LOGIN '''
+    if raw or update_fields and set(update_fields) == {'last_login'}:
+        return
+    caching.invalidate(caching.AUTOCOMPLETE)
+
+
+def tags_changed(sender, **kwargs):
+    caching.invalidate(caching.BOOK_DETAILS)
+
+
+if apps.is_installed('tags'):
+    for model in apps.get_app_config('tags').get_models():
+        post_save.connect(tags_changed, sender=model,
+                          dispatch_uid='library_sys_tags_saved_%s' %
+                                       model._meta.model_name)
+        post_delete.connect(tags_changed, sender=model,
+                            dispatch_uid='library_sys_tags_deleted_%s' %
+                                         model._meta.model_name)
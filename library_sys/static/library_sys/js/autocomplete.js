@@ -0,0 +1,62 @@
+/*
+ * Search the options of the admin selects marked with
+ * data-autocomplete-url page by page, instead of rendering every row of
+ * the related table into the <select>.
+ */
+(function($) {
+    'use strict';
+
+    function bind(select) {
+        var $select = $(select),
+            url = $select.data('autocomplete-url'),
+            $search = $('<input type="search" class="vTextField">'),
+            $more = $('<a href="#" style="display: none">mais resultados</a>'),
+            page = 1,
+            timer = null,
+            request = null;
+
+        $search.attr('placeholder', $select.data('autocomplete-placeholder') || 'Buscar');
+        $select.before($search, '<br>');
+        $select.after(' ', $more);
+
+        function load(append) {
+            if (request) {
+                request.abort();
+            }
+            request = $.getJSON(url, {q: $search.val(), page: page},
+                function(data) {
+                    if (!append) {
+                        $select.find('option').not(':selected').not('[value=""]').remove();
+                    }
+                    $.each(data.results, function(i, item) {
+                        if (!$select.find('option[value="' + item.id + '"]').length) {
+                            $select.append($('<option>').val(item.id).text(item.text));
+                        }
+                    });
+                    $more.toggle(data.more);
+                });
+        }
+
+        $search.on('input', function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                page = 1;
+                load(false);
+            }, 300);
+        });
+
+        $more.on('click', function(event) {
+            event.preventDefault();
+            page += 1;
+            load(true);
+        });
+
+        load(false);
+    }
+
+    $(function() {
+        $('select[data-autocomplete-url]').each(function() {
+            bind(this);
+        });
+    });
+})(django.jQuery);
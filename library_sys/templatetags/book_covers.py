@@ -0,0 +1,49 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from library_sys import thumbnails
+
+register = template.Library()
+
+
+@register.simple_tag
+def cover_srcset(book, fmt='JPEG'):
+    """
+    ``srcset`` of the cover thumbnails of ``book`` in ``fmt``, for hand
+    written ``<img>`` and ``<source>`` tags.
+    """
+    return thumbnails.srcset(book, fmt.upper())
+
+
+@register.simple_tag
+def book_cover(book, sizes=None, css_class='cover'):
+    """
+    ``<picture>`` of the cover of ``book``: WebP thumbnails when the
+    browser takes them, JPEG otherwise. ``sizes`` defaults to the smallest
+    thumbnail width. Empty when the book has no cover.
+    """
+    found = thumbnails.get_thumbnails(book)
+    if not found:
+        return ''
+
+    url = book.cover.storage.url
+    srcsets = {fmt: ', '.join('%s %sw' % (url(name), width)
+                              for width, name in items)
+               for fmt, items in found.items()}
+
+    fallback = 'JPEG' if 'JPEG' in found else thumbnails.FORMATS[0]
+    width, name = found[fallback][0]
+    height = (round(book.cover_height * width / book.cover_width)
+              if book.cover_width and book.cover_height else '')
+    if sizes is None:
+        sizes = '%spx' % width
+
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((thumbnails.MIME_TYPES[fmt], srcsets[fmt], sizes)
+         for fmt in thumbnails.FORMATS if fmt != fallback and fmt in found))
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" width="{}" '
+        'height="{}" alt="{}" class="{}" loading="lazy"></picture>',
+        sources, url(name), srcsets[fallback], sizes, width, height,
+        book.title, css_class)
@@ -1,3 +1,1834 @@
-from django.test import TestCase
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import date, time, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf.urls import include, url
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.forms import modelform_factory
+from django.http.multipartparser import MultiPartParser
+from django.template import Context, Template
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings,
+                         skipUnlessDBFeature)
+from django.test.client import (BOUNDARY, MULTIPART_CONTENT,
+                                encode_multipart)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (caching, downloads, exports, models, search,
+               signals, thumbnails)
+from .importers import CatalogueImporter, read_csv
+from .admin import HistoryBookItemAvailableForm
+from .models import (Author, Publisher, Book, BookItem, Category, Reader,
+                     HistoryItem, ImportCheckpoint, MediaCleanup)
+from .uploadhandlers import MaxSizeUploadHandler
+
+urlpatterns = [
+    url(r'^admin/', admin.site.urls),
+    url(r'^', include('library_sys.urls')),
+]
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class BookItemAdminChangelistTest(TestCase):
+
+    def setUp(self):
+        self.client.force_login(Reader.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin'))
+        self.author = Author.objects.create(name='Machado de Assis')
+        self.publisher = Publisher.objects.create(name='Garnier')
+
+    def add_books(self, total):
+        start = Book.objects.count()
+        for i in range(start, start + total):
+            book = Book(title='Livro %s' % i, author=self.author,
+                        publisher=self.publisher, book_item_total=2)
+            book.save()
+
+            reader = Reader.objects.create_user('leitor-%s' % i)
+            HistoryItem.objects.checkout_many(
+                reader, BookItem.objects.filter(book=book)[:1],
+                date.today() + timedelta(days=7))
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                reverse('admin:library_sys_bookitem_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_books(2)
+        few_rows = self.changelist_queries()
+
+        self.add_books(20)
+        many_rows = self.changelist_queries()
+
+        self.assertEqual(few_rows, many_rows)
+        self.assertLessEqual(many_rows, 10)
+
+
+class SmallUploadHandler(MaxSizeUploadHandler):
+    max_size = 2 * 1024 * 1024
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests', FILE_UPLOAD_HANDLERS=[
+    'library_sys.tests.SmallUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+])
+class OversizeUploadTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.client.force_login(Reader.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin'))
+
+    def test_upload_over_the_handler_limit_is_refused(self):
+        # 3 MB: under the 5 MB of Book.file, over the 2 MB of the handler
+        upload = SimpleUploadedFile('livro.pdf',
+                                    b'%PDF-1.4\n' + b'0' * 3 * 1024 * 1024,
+                                    'application/pdf')
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.post(reverse('admin:library_sys_book_add'), {
+                'title': 'Dom Casmurro',
+                'author': Author.objects.create(name='Machado de Assis').id,
+                'publisher': Publisher.objects.create(name='Garnier').id,
+                'book_item_total': 1,
+                'file': upload,
+            })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'muito grande')
+        self.assertFalse(Book.objects.exists())
+        self.assertEqual(os.listdir(self.media_root), [])
+
+    def test_request_is_not_read_past_the_limit(self):
+        body = encode_multipart(BOUNDARY, {
+            'title': 'Dom Casmurro',
+            'file': SimpleUploadedFile('livro.pdf',
+                                       b'%PDF-1.4\n' + b'0' * 3 * 1024 * 1024,
+                                       'application/pdf'),
+            'year': '1899',
+        })
+        stream = io.BytesIO(body)
+        request = RequestFactory().post('/')
+        meta = {'CONTENT_TYPE': MULTIPART_CONTENT,
+                'CONTENT_LENGTH': len(body)}
+
+        post, files = MultiPartParser(meta, stream,
+                                      [SmallUploadHandler(request)]).parse()
+
+        self.assertLess(stream.tell(), 2.5 * 1024 * 1024)
+        self.assertEqual(post['title'], 'Dom Casmurro')
+        self.assertNotIn('file', files)
+        self.assertTrue(request.oversize_uploads['file'].oversize)
+        self.assertGreater(request.oversize_uploads['file'].size,
+                           SmallUploadHandler.max_size)
+
+
+def use_temporary_media_root(test):
+    """ Point MEDIA_ROOT at a directory removed after ``test``. """
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root)
+    media_settings = test.settings(MEDIA_ROOT=media_root)
+    media_settings.enable()
+    test.addCleanup(media_settings.disable)
+    return media_root
+
+
+def image(fmt='PNG', size=(4, 3)):
+    content = io.BytesIO()
+    Image.new('RGB', size).save(content, fmt)
+    return content.getvalue()
+
+
+class CoverTest(TestCase):
+
+    def setUp(self):
+        use_temporary_media_root(self)
+        self.book = Book(title='Dom Casmurro',
+                         author=Author.objects.create(name='Machado de Assis'),
+                         publisher=Publisher.objects.create(name='Garnier'),
+                         book_item_total=1)
+
+    def test_webp_cover_is_stored_and_validated_again(self):
+        self.book.cover = SimpleUploadedFile('capa.webp', image('WEBP'),
+                                             'image/webp')
+        self.book.save()
+
+        book = Book.objects.get()
+        self.assertTrue(book.cover.name.endswith('.webp'))
+        self.assertEqual((book.cover_width, book.cover_height), (4, 3))
+        book.title = 'Dom Casmurro (2a edição)'
+        book.full_clean()
+
+    def test_stored_cover_is_sniffed(self):
+        self.book.cover = SimpleUploadedFile('capa.tif', image('TIFF'),
+                                             'image/tiff')
+        self.book.save()
+
+        book = Book.objects.get()
+        self.assertTrue(book.cover.name.endswith('.tif'))
+        book.full_clean()
+
+        with open(book.cover.path, 'wb') as f:
+            f.write(b'not an image')
+        with self.assertRaisesMessage(ValidationError, 'MIME type'):
+            book.full_clean()
+
+
+class ThumbnailTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.media_root = use_temporary_media_root(self)
+        self.author = Author.objects.create(name='Machado de Assis')
+        self.publisher = Publisher.objects.create(name='Garnier')
+
+    def add_book(self, title, cover):
+        book = Book(title=title, author=self.author, publisher=self.publisher,
+                    cover=SimpleUploadedFile('capa.png', cover),
+                    book_item_total=1)
+        with run_on_commit():
+            book.save()
+        return book
+
+    def stored(self, cover_hash):
+        directory = os.path.join(self.media_root, os.path.dirname(
+            thumbnails.thumbnail_prefix(cover_hash)))
+        return sorted(os.listdir(directory))
+
+    def test_thumbnails_are_named_after_the_cover_hash(self):
+        book = self.add_book('Dom Casmurro', image(size=(400, 600)))
+
+        found = thumbnails.get_thumbnails(book)
+        self.assertEqual(set(found), set(thumbnails.FORMATS))
+        for fmt, items in found.items():
+            # never enlarged
+            self.assertEqual([width for width, name in items], [160, 320])
+            for width, name in items:
+                self.assertEqual(name, thumbnails.thumbnail_name(
+                    book.cover_hash, width, fmt))
+                with Image.open(os.path.join(self.media_root, name)) as f:
+                    self.assertEqual(f.size, (width, width * 3 // 2))
+
+    def test_known_thumbnails_are_not_read_again(self):
+        book = self.add_book('Dom Casmurro', image(size=(400, 600)))
+        found = thumbnails.get_thumbnails(book)
+
+        with mock.patch.object(thumbnails, 'generate') as generate, \
+                self.assertNumQueries(0):
+            self.assertEqual(thumbnails.get_thumbnails(book), found)
+        generate.assert_not_called()
+
+        thumbnails.forget(book.cover_hash)
+        with mock.patch.object(book.cover.storage, 'save') as save:
+            self.assertEqual(thumbnails.get_thumbnails(book), found)
+        save.assert_not_called()
+
+    def test_books_with_the_same_cover_share_the_thumbnails(self):
+        cover = image(size=(400, 600))
+        first = self.add_book('Dom Casmurro', cover)
+        stored = self.stored(first.cover_hash)
+
+        second = self.add_book('Dom Casmurro (2a edição)', cover)
+        self.assertEqual(second.cover_hash, first.cover_hash)
+        self.assertEqual(self.stored(second.cover_hash), stored)
+        self.assertEqual(thumbnails.get_thumbnails(second),
+                         thumbnails.get_thumbnails(first))
+
+    def test_new_cover_has_new_thumbnails(self):
+        book = self.add_book('Dom Casmurro', image(size=(400, 600)))
+        old_hash = book.cover_hash
+        old = thumbnails.get_thumbnails(book)
+
+        book.cover = SimpleUploadedFile('capa.png', image(size=(200, 300)))
+        with run_on_commit():
+            book.save()
+        self.assertNotEqual(book.cover_hash, old_hash)
+        self.assertNotEqual(thumbnails.get_thumbnails(book), old)
+        self.assertIn(thumbnails.thumbnail_prefix(old_hash), set(
+            MediaCleanup.objects.values_list('path', flat=True)))
+
+    def test_cover_stored_before_the_hash_was_kept(self):
+        book = self.add_book('Dom Casmurro', image(size=(100, 150)))
+        cover_hash = book.cover_hash
+        Book.objects.update(cover_hash='')
+        cache.clear()
+
+        book = Book.objects.get()
+        self.assertEqual(thumbnails.get_thumbnails(book)['JPEG'], [
+            (100, thumbnails.thumbnail_name(cover_hash, 100, 'JPEG'))])
+        self.assertEqual(Book.objects.get().cover_hash, cover_hash)
+
+    def test_unreadable_cover(self):
+        book = self.add_book('Dom Casmurro', image(size=(100, 150)))
+        cache.clear()
+        with open(book.cover.path, 'wb') as f:
+            f.write(b'not an image')
+
+        self.assertEqual(thumbnails.get_thumbnails(book), {})
+        self.assertEqual(Template(
+            '{% load book_covers %}{% book_cover book %}').render(
+            Context({'book': book})), '')
+
+    def test_book_cover_tag(self):
+        book = self.add_book('Dom Casmurro', image(size=(400, 600)))
+
+        html = Template('{% load book_covers %}{% book_cover book %}').render(
+            Context({'book': book}))
+        self.assertIn('width="160" height="240"', html)
+        self.assertIn(thumbnails.thumbnail_name(book.cover_hash, 320, 'JPEG'),
+                      html)
+
+
+class BookDirtyFieldsTest(TestCase):
+
+    def setUp(self):
+        use_temporary_media_root(self)
+        self.book = Book(title='Dom Casmurro',
+                         author=Author.objects.create(name='Machado de Assis'),
+                         publisher=Publisher.objects.create(name='Garnier'),
+                         cover=SimpleUploadedFile('capa.png', image()),
+                         book_item_total=2)
+        self.book.save()
+
+    def save(self, book):
+        """ Save ``book``, returning the statements run, by table. """
+        with CaptureQueriesContext(connection) as context:
+            book.save()
+        queries = {}
+        for query in context.captured_queries:
+            table = re.search(r'(?:UPDATE|FROM|INTO) "(\w+)"', query['sql'])
+            if table:
+                queries.setdefault(table.group(1), []).append(query['sql'])
+        return queries
+
+    def updated_columns(self, queries):
+        """ Columns written by the save, the first UPDATE of the book. """
+        updates = [sql for sql in queries['library_sys_book']
+                   if sql.startswith('UPDATE')]
+        return set(re.findall(r'"(\w+)" = ',
+                              updates[0].split(' WHERE ')[0]))
+
+    def test_save_without_changes(self):
+        book = Book.objects.get()
+        self.assertEqual(book.changed_fields(), [])
+
+        queries = self.save(book)
+        self.assertEqual(self.updated_columns(queries), {'updated_at'})
+        self.assertNotIn('library_sys_bookitem', queries)
+        self.assertNotIn('library_sys_mediacleanup', queries)
+
+    def test_save_writes_the_changed_fields(self):
+        book = Book.objects.get()
+        book.title = 'Dom Casmurro (2a edição)'
+        book.synopsis = 'Romance.'
+
+        self.assertEqual(self.updated_columns(self.save(book)), {
+            'title', 'title_key', 'synopsis', 'updated_at'})
+        self.assertEqual(book.changed_fields(), [])
+
+        book = Book.objects.get()
+        self.assertEqual(book.title_key, 'dom casmurro 2a edicao')
+        self.assertEqual(book.synopsis, 'Romance.')
+
+    def test_deferred_fields_are_not_written(self):
+        Book.objects.update(synopsis='Romance.')
+        book = Book.objects.only('id', 'title').get()
+        book.title = 'Quincas Borba'
+
+        self.assertEqual(self.updated_columns(self.save(book)), {
+            'title', 'title_key', 'updated_at'})
+        self.assertEqual(Book.objects.get().synopsis, 'Romance.')
+
+    def test_status_is_refreshed_only_for_available_and_new_copies(self):
+        book = Book.objects.get()
+        book.year = 1899
+        self.assertNotIn('library_sys_bookitem', self.save(book))
+
+        book.available = False
+        queries = self.save(book)
+        self.assertIn('available', self.updated_columns(queries))
+        self.assertTrue(queries['library_sys_bookitem'])
+        self.assertEqual(set(BookItem.objects.values_list(
+            'status', flat=True)), {BookItem.UNAVAILABLE})
+
+        book.book_item_total = 3
+        queries = self.save(book)
+        self.assertNotIn('book_item_total', self.updated_columns(queries))
+        # the counter is moved by its own UPDATE, not overwritten
+        self.assertIn('"book_item_total" + 1',
+                      queries['library_sys_book'][-1])
+        self.assertEqual(BookItem.objects.count(), 3)
+        self.assertEqual(Book.objects.get().book_item_total, 3)
+
+    def test_replaced_cover_is_queued_for_cleanup(self):
+        book = Book.objects.get()
+        old_cover, old_hash = book.cover.name, book.cover_hash
+        book.cover = SimpleUploadedFile('capa.webp', image('WEBP', (8, 6)))
+
+        queries = self.save(book)
+        self.assertEqual(self.updated_columns(queries), {
+            'cover', 'cover_hash', 'cover_width', 'cover_height',
+            'updated_at'})
+        self.assertNotEqual(book.cover_hash, old_hash)
+        self.assertEqual(Book.objects.values_list(
+            'cover_width', 'cover_height').get(), (8, 6))
+        self.assertEqual(
+            set(MediaCleanup.objects.values_list('path', flat=True)),
+            {old_cover, thumbnails.thumbnail_prefix(old_hash)})
+
+    def test_first_cover_of_a_book(self):
+        Book.objects.update(cover=None, cover_hash='', cover_width=None,
+                            cover_height=None)
+        book = Book.objects.get()
+        book.cover = SimpleUploadedFile('capa.png', image(size=(8, 6)))
+        book.save()
+
+        self.assertEqual(Book.objects.values_list(
+            'cover_hash', 'cover_width', 'cover_height').get(),
+            (book.cover_hash, 8, 6))
+        self.assertFalse(MediaCleanup.objects.exists())
+
+    def test_file_replaced_and_deleted(self):
+        book = Book.objects.get()
+        book.file = SimpleUploadedFile('livro.pdf', b'%PDF-1.4 um')
+        book.save()
+        first = book.file.name
+        self.assertFalse(MediaCleanup.objects.exists())
+
+        book.file = SimpleUploadedFile('livro.pdf', b'%PDF-1.4 dois')
+        book.save()
+        self.assertEqual(list(MediaCleanup.objects.values_list(
+            'path', flat=True)), [first])
+
+        MediaCleanup.objects.all().delete()
+        cover, cover_hash = book.cover.name, book.cover_hash
+        book.delete()
+        self.assertEqual(
+            set(MediaCleanup.objects.values_list('path', flat=True)),
+            {cover, book.file.name, thumbnails.thumbnail_prefix(cover_hash)})
+
+
+class MediaCleanupTest(TestCase):
+
+    def setUp(self):
+        self.media_root = use_temporary_media_root(self)
+        self.book = Book(title='Dom Casmurro',
+                         author=Author.objects.create(name='Machado de Assis'),
+                         publisher=Publisher.objects.create(name='Garnier'),
+                         cover=SimpleUploadedFile('capa.png', image()),
+                         book_item_total=1)
+        self.book.save()
+        self.cover = self.book.cover.name
+
+    def media(self, path, content=b''):
+        path = os.path.join(self.media_root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def queued(self):
+        return set(MediaCleanup.objects.values_list('path', flat=True))
+
+    def test_replaced_cover_is_not_queued_after_a_rollback(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            book = Book.objects.get()
+            book.cover = SimpleUploadedFile('capa.png', image(size=(8, 6)))
+            book.save()
+            self.assertIn(self.cover, self.queued())
+            raise ValueError
+
+        self.assertEqual(self.queued(), set())
+        self.assertEqual(Book.objects.get().cover.name, self.cover)
+
+    def test_replaced_cover_is_removed(self):
+        thumbnail = self.media(thumbnails.thumbnail_name(
+            self.book.cover_hash, 160, 'JPEG'))
+        self.book.cover = SimpleUploadedFile('capa.png', image(size=(8, 6)))
+        self.book.save()
+
+        self.assertEqual(MediaCleanup.objects.process(), (2, 0))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.media_root, self.cover)))
+        self.assertFalse(os.path.exists(thumbnail))
+        self.assertTrue(os.path.exists(self.book.cover.path))
+        self.assertEqual(self.queued(), set())
+
+    def test_paths_in_use_are_kept(self):
+        thumbnail = self.media(thumbnails.thumbnail_name(
+            self.book.cover_hash, 160, 'JPEG'))
+        MediaCleanup.objects.enqueue([
+            self.cover, thumbnails.thumbnail_prefix(self.book.cover_hash)])
+
+        self.assertEqual(MediaCleanup.objects.process(), (2, 0))
+        self.assertTrue(os.path.exists(self.book.cover.path))
+        self.assertTrue(os.path.exists(thumbnail))
+
+    def test_missing_file_is_skipped(self):
+        other = self.media('book/files/outro.pdf')
+        MediaCleanup.objects.enqueue(['book/files/nao-existe.pdf',
+                                      'book/files/outro.pdf'])
+
+        self.assertEqual(MediaCleanup.objects.process(batch_size=1), (2, 0))
+        self.assertFalse(os.path.exists(other))
+        self.assertEqual(self.queued(), set())
+
+    def test_failed_removal_stays_queued(self):
+        self.media('book/files/outro.pdf')
+        MediaCleanup.objects.enqueue(['book/files/outro.pdf'])
+
+        with mock.patch('library_sys.models.os.remove',
+                        side_effect=PermissionError), \
+                mock.patch('library_sys.models.logger'):
+            self.assertEqual(MediaCleanup.objects.process(), (0, 1))
+        self.assertEqual(self.queued(), {'book/files/outro.pdf'})
+
+    def test_process_media_cleanup(self):
+        self.book.delete()
+
+        stdout = io.StringIO()
+        call_command('process_media_cleanup', stdout=stdout)
+        self.assertIn('2 arquivo(s) removido(s), 0 com erro',
+                      stdout.getvalue())
+        self.assertFalse(os.path.exists(
+            os.path.join(self.media_root, self.cover)))
+        self.assertEqual(self.queued(), set())
+
+
+class CirculationTestCase(TestCase):
+
+    def setUp(self):
+        self.book = Book(title='Dom Casmurro',
+                         author=Author.objects.create(name='Machado de Assis'),
+                         publisher=Publisher.objects.create(name='Garnier'),
+                         book_item_total=3)
+        self.book.save()
+        self.book_items = list(
+            BookItem.objects.filter(book=self.book).order_by('id'))
+        self.reader = Reader.objects.create_user('leitor')
+
+    def assertCounters(self, total, unavailable):
+        book = Book.objects.get(id=self.book.id)
+        self.assertEqual((book.book_item_total, book.book_item_unavailable),
+                         (total, unavailable))
+
+
+class BookCountersTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other = Book(title='Quincas Borba', author=self.book.author,
+                          publisher=self.book.publisher, book_item_total=1)
+        self.other.save()
+
+    def assertOtherCounters(self, total, unavailable):
+        other = Book.objects.get(id=self.other.id)
+        self.assertEqual((other.book_item_total, other.book_item_unavailable),
+                         (total, unavailable))
+
+    def move(self, book_item, **changes):
+        book_item = BookItem.objects.get(id=book_item.id)
+        book_item.book = self.other
+        for name, value in changes.items():
+            setattr(book_item, name, value)
+        book_item.save()
+
+    def test_adjust_counters_of_several_books(self):
+        Book.objects.adjust_counters(total={self.book.id: -1},
+                                     unavailable={self.other.id: 1})
+
+        self.assertCounters(2, 0)
+        self.assertOtherCounters(1, 1)
+
+    def test_move_available_copy(self):
+        self.move(self.book_items[0])
+
+        self.assertCounters(2, 0)
+        self.assertOtherCounters(2, 0)
+
+    def test_move_unavailable_copy(self):
+        self.book_items[0].available = False
+        self.book_items[0].save()
+        self.move(self.book_items[0])
+
+        self.assertCounters(2, 0)
+        self.assertOtherCounters(2, 1)
+
+    def test_move_unavailable_copy_making_it_available(self):
+        self.book_items[0].available = False
+        self.book_items[0].save()
+        self.move(self.book_items[0], available=True)
+
+        self.assertCounters(2, 0)
+        self.assertOtherCounters(2, 0)
+
+    def test_move_lent_copy(self):
+        HistoryItem.objects.checkout_many(self.reader, self.book_items[:1],
+                                          date.today() + timedelta(days=7))
+        self.move(self.book_items[0])
+
+        self.assertCounters(2, 0)
+        self.assertOtherCounters(2, 1)
+
+    def test_recount_counters(self):
+        HistoryItem.objects.checkout_many(self.reader, self.book_items[:2],
+                                          date.today() + timedelta(days=7))
+        BookItem.objects.filter(id=self.book_items[2].id).update(
+            available=False)
+        Book.objects.update(book_item_total=0, book_item_unavailable=9)
+
+        self.assertEqual(Book.objects.recount_counters(), 2)
+        self.assertCounters(3, 3)
+        self.assertOtherCounters(1, 0)
+
+        Book.objects.update(book_item_total=0)
+        stdout = io.StringIO()
+        call_command('recount_book_counters', stdout=stdout)
+        self.assertIn('2 livro(s) recontado(s)', stdout.getvalue())
+        self.assertCounters(3, 3)
+
+    def test_checkouts_from_stale_books_do_not_overwrite_each_other(self):
+        stale = Book.objects.get(id=self.book.id)
+        for book_item in self.book_items:
+            HistoryItem.objects.checkout_many(
+                self.reader, [book_item], date.today() + timedelta(days=7))
+        stale.save()
+
+        self.assertCounters(3, 3)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentCheckoutTest(TransactionTestCase):
+
+    def test_each_copy_is_lent_once(self):
+        book = Book(title='Dom Casmurro',
+                    author=Author.objects.create(name='Machado de Assis'),
+                    publisher=Publisher.objects.create(name='Garnier'),
+                    book_item_total=3)
+        book.save()
+        book_items = list(BookItem.objects.filter(book=book))
+        readers = [Reader.objects.create_user('leitor-%s' % i)
+                   for i in range(len(book_items) * 2)]
+
+        results = []
+        barrier = threading.Barrier(len(readers))
+
+        def checkout(reader, book_item):
+            try:
+                barrier.wait()
+                HistoryItem.objects.checkout_many(
+                    reader, [book_item], date.today() + timedelta(days=7))
+                results.append(True)
+            except ValidationError:
+                results.append(False)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=checkout,
+                                    args=(reader, book_items[i % 3]))
+                   for i, reader in enumerate(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [False] * 3 + [True] * 3)
+        book = Book.objects.get(id=book.id)
+        self.assertEqual((book.book_item_total, book.book_item_unavailable),
+                         (3, 3))
+        self.assertEqual(HistoryItem.objects.count(), 3)
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class AvailableCopiesTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client.force_login(Reader.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin'))
+        self.other = Book(title='Quincas Borba', author=self.book.author,
+                          publisher=self.book.publisher, book_item_total=1)
+        self.other.save()
+
+    def titles(self, query=''):
+        """ Results of the copy search and the copy queries it ran. """
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(
+                'admin:library_sys_historyitem_available_book_items'),
+                {'q': query})
+        self.assertEqual(response.status_code, 200)
+        queries = [q['sql'] for q in context.captured_queries
+                   if 'library_sys_bookitem' in q['sql']]
+        return ([(result['id'], result['text'])
+                 for result in response.json()['results']], queries)
+
+    def test_one_row_per_title_with_its_first_copy(self):
+        results, queries = self.titles('MACHADO')
+        self.assertEqual(results, [
+            (self.book_items[0].id, 'Dom Casmurro (Machado de Assis - '
+                                    'Garnier)'),
+            (self.other.bookitem_set.get().id, 'Quincas Borba (Machado de '
+                                               'Assis - Garnier)')])
+        self.assertEqual(len(queries), 1)
+
+        self.assertEqual(self.titles('quincas garnier')[0], results[1:])
+
+    def test_pages_are_cached_until_a_loan(self):
+        results = self.titles()[0]
+        self.assertEqual(self.titles(), (results, []))
+
+        with run_on_commit():
+            HistoryItem.objects.checkout_many(
+                self.reader, self.book_items[:1],
+                date.today() + timedelta(days=7))
+        self.assertEqual(self.titles()[0][0][0], self.book_items[1].id)
+
+        with run_on_commit():
+            HistoryItem.objects.checkout_many(
+                self.reader, self.book_items[1:],
+                date.today() + timedelta(days=7))
+        self.assertEqual(self.titles()[0], results[1:])
+
+    def test_pages_are_cached_until_a_book_or_copy_changes(self):
+        results = self.titles()[0]
+
+        with run_on_commit():
+            self.other.available = False
+            self.other.save()
+        self.assertEqual(self.titles()[0], results[:1])
+
+        with run_on_commit():
+            book_item = self.book_items[0]
+            book_item.available = False
+            book_item.save()
+        self.assertEqual(self.titles()[0][0][0], self.book_items[1].id)
+
+    def test_form_lists_only_the_chosen_copy(self):
+        # as HistoryAdmin builds it
+        form_class = modelform_factory(HistoryItem,
+                                       form=HistoryBookItemAvailableForm,
+                                       fields=['book_item'])
+        form = form_class(data={'book_item': self.book_items[1].id})
+        self.assertEqual([choice[0] for choice in
+                          form.fields['book_item'].choices],
+                         [self.book_items[1].id])
+
+        HistoryItem.objects.checkout_many(
+            self.reader, self.book_items[1:2],
+            date.today() + timedelta(days=7))
+        form = form_class(data={'book_item': self.book_items[1].id})
+        self.assertEqual(list(form.fields['book_item'].choices), [(None, '')])
+        self.assertIn('book_item', form.errors)
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class AccountSummaryTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.other_reader = Reader.objects.create_user('outro')
+        self.today = date.today()
+
+    def lend(self, reader, book_item, days_ago=0, fine=0, returned=False):
+        history_item = HistoryItem(
+            book_item=book_item, reader=reader, daily_fine=fine,
+            date_taken=self.today - timedelta(days=days_ago),
+            date_due=self.today - timedelta(days=days_ago - 7),
+            date_returned=self.today if returned else None)
+        history_item.save()
+        return history_item
+
+    def summary(self, reader):
+        summary = HistoryItem.objects.account_summary(reader)
+        return (summary['open_loans'], summary['overdue'],
+                summary['fine_owed'])
+
+    def test_summary(self):
+        self.assertEqual(self.summary(self.reader), (0, 0, 0))
+
+        self.lend(self.reader, self.book_items[0])
+        self.lend(self.reader, self.book_items[1], days_ago=10, fine=2)
+        self.lend(self.reader, self.book_items[2], days_ago=20, fine=1,
+                  returned=True)
+        cache.clear()
+        self.assertEqual(self.summary(self.reader), (2, 1, 6 + 13))
+
+    def test_cached_until_the_loans_of_the_reader_change(self):
+        self.summary(self.reader)
+        self.summary(self.other_reader)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.summary(self.reader), (0, 0, 0))
+
+        with run_on_commit():
+            history_item = self.lend(self.reader, self.book_items[0])
+        self.assertEqual(self.summary(self.reader), (1, 0, 0))
+        with self.assertNumQueries(0):
+            self.summary(self.other_reader)
+
+        with run_on_commit():
+            history_item.reader = self.other_reader
+            history_item.save()
+        self.assertEqual(self.summary(self.reader), (0, 0, 0))
+        self.assertEqual(self.summary(self.other_reader), (1, 0, 0))
+
+        with run_on_commit():
+            HistoryItem.objects.return_many([history_item])
+        self.assertEqual(self.summary(self.other_reader), (0, 0, 0))
+
+    def test_cached_until_fines_accrue_or_the_day_turns(self):
+        history_item = self.lend(self.reader, self.book_items[0],
+                                 days_ago=10, fine=2)
+        HistoryItem.objects.filter(id=history_item.id).update(fine=0)
+        cache.clear()
+        self.assertEqual(self.summary(self.reader), (1, 1, 0))
+
+        with run_on_commit():
+            HistoryItem.objects.accrue_fines()
+        self.assertEqual(self.summary(self.reader), (1, 1, 6))
+
+        HistoryItem.objects.filter(id=history_item.id).update(fine=0)
+        key = caching.make_key(caching.READER_ACCOUNT, self.reader.pk)
+        cache.set(key, dict(cache.get(key),
+                            date=self.today - timedelta(days=1)))
+        self.assertEqual(self.summary(self.reader), (1, 1, 0))
+
+    def test_book_list_pages(self):
+        HistoryItem.objects.bulk_create([
+            HistoryItem(book_item=self.book_items[0], reader=self.reader,
+                        date_taken=self.today - timedelta(days=i),
+                        date_due=self.today - timedelta(days=i - 7),
+                        date_returned=self.today, status=HistoryItem.RETURNED)
+            for i in range(25)])
+        self.lend(self.other_reader, self.book_items[1], days_ago=10, fine=1)
+
+        response = self.client.get(reverse('book_list'))
+        self.assertEqual(list(response.context['books']), [])
+
+        self.client.force_login(self.reader)
+        response = self.client.get(reverse('book_list'))
+        self.assertEqual(len(response.context['books']), 20)
+        self.assertEqual(response.context['total_fine'], 0)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('book_list'), {'page': 2})
+        self.assertEqual(len(response.context['books']), 5)
+
+        self.client.force_login(self.other_reader)
+        response = self.client.get(reverse('book_list'))
+        self.assertEqual(len(response.context['books']), 1)
+        self.assertEqual(response.context['total_fine'], 3)
+        self.assertContains(response, 'Multa a pagar: 3.')
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class RelatedValuesListFilterTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(Reader.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin'))
+
+    def add_loans(self, reader, total, days_ago):
+        HistoryItem.objects.bulk_create([
+            HistoryItem(book_item=self.book_items[0], reader=reader,
+                        date_taken=date.today() - timedelta(days=days_ago),
+                        date_due=date.today() - timedelta(days=days_ago - 7),
+                        date_returned=date.today(),
+                        status=HistoryItem.RETURNED)
+            for i in range(total)])
+
+    def choices(self, **params):
+        """ Labels listed by the reader and book filters, by parameter. """
+        response = self.client.get(
+            reverse('admin:library_sys_historyitem_changelist'), params)
+        self.assertEqual(response.status_code, 200)
+        changelist = response.context['cl']
+        return {
+            spec.parameter_name: [choice['display'] for choice in
+                                  spec.choices(changelist)][1:]
+            for spec in changelist.filter_specs
+            if spec.parameter_name in ('reader', 'book_item__book')}
+
+    def test_values_of_the_result_set(self):
+        other = Reader.objects.create_user('mlima', first_name='Maria',
+                                           last_name='Lima')
+        self.add_loans(self.reader, 1, 1)
+        self.add_loans(other, 1, 2)
+
+        self.assertEqual(self.choices(), {
+            'reader': ['leitor', 'mlima Maria Lima'],
+            'book_item__book': ['Dom Casmurro']})
+        self.assertEqual(self.choices(q='lima')['reader'],
+                         ['mlima Maria Lima'])
+
+    def test_only_the_first_rows_are_scanned(self):
+        late = Reader.objects.create_user('atrasado')
+        self.add_loans(self.reader, 500, 1)
+        self.add_loans(late, 1, 2)
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.choices()['reader'], ['leitor'])
+        self.assertTrue(any('LIMIT 500' in query['sql']
+                            for query in context.captured_queries))
+
+        # chosen values are listed even when no row has them
+        other = Book(title='Quincas Borba', author=self.book.author,
+                     publisher=self.book.publisher, book_item_total=1)
+        other.save()
+        self.assertEqual(self.choices(reader=late.id,
+                                      book_item__book=other.id), {
+            'reader': ['atrasado'], 'book_item__book': ['Quincas Borba']})
+
+    def test_at_most_twenty_values(self):
+        for i in range(25):
+            self.add_loans(Reader.objects.create_user('leitor-%02d' % i),
+                           1, i)
+
+        self.assertEqual(self.choices()['reader'],
+                         ['leitor-%02d' % i for i in range(20)])
+
+
+class CheckoutReturnManyTest(CirculationTestCase):
+
+    def test_checkout_many_opens_loans_and_counts_copies(self):
+        date_due = date.today() + timedelta(days=7)
+        history_items = HistoryItem.objects.checkout_many(
+            self.reader, self.book_items[:2], date_due)
+
+        self.assertEqual(len(history_items), 2)
+        self.assertCounters(3, 2)
+        for book_item, history_item in zip(self.book_items, history_items):
+            book_item.refresh_from_db()
+            self.assertEqual(book_item.last_history_item_id, history_item.pk)
+            self.assertEqual(book_item.last_reader_id, self.reader.pk)
+            self.assertEqual(book_item.last_date_due, date_due)
+            self.assertEqual(book_item.status, BookItem.BORROWED)
+        self.assertEqual(HistoryItem.objects.filter(
+            status=HistoryItem.BORROWED).count(), 2)
+
+    def test_checkout_many_refuses_copies_already_lent(self):
+        date_due = date.today() + timedelta(days=7)
+        HistoryItem.objects.checkout_many(self.reader, self.book_items[:1],
+                                          date_due)
+
+        with self.assertRaises(ValidationError):
+            HistoryItem.objects.checkout_many(self.reader, self.book_items,
+                                              date_due)
+        self.assertEqual(HistoryItem.objects.count(), 1)
+        self.assertCounters(3, 1)
+
+    def test_checkout_many_queries_do_not_grow_with_copies(self):
+        date_due = date.today() + timedelta(days=7)
+        with CaptureQueriesContext(connection) as one:
+            HistoryItem.objects.checkout_many(self.reader, self.book_items[:1],
+                                              date_due)
+        with CaptureQueriesContext(connection) as two:
+            HistoryItem.objects.checkout_many(self.reader, self.book_items[1:],
+                                              date_due)
+
+        self.assertEqual(len(one), len(two))
+
+    def test_return_many_closes_loans_with_fines(self):
+        history_items = HistoryItem.objects.checkout_many(
+            self.reader, self.book_items[:2], date.today() - timedelta(days=4),
+            date_taken=date.today() - timedelta(days=10), daily_fine=2)
+
+        self.assertEqual(HistoryItem.objects.return_many(history_items), 2)
+        self.assertEqual(HistoryItem.objects.return_many(history_items), 0)
+
+        self.assertCounters(3, 0)
+        for history_item in HistoryItem.objects.all():
+            self.assertEqual(history_item.date_returned, date.today())
+            self.assertEqual(history_item.status, HistoryItem.RETURNED)
+            self.assertEqual(history_item.fine, 8)
+        for book_item in BookItem.objects.filter(book=self.book):
+            self.assertEqual(book_item.status, BookItem.AVAILABLE)
+
+
+class AccrueFinesTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.late = self.lend(self.book_items[0], 3, 2)
+        self.very_late = self.lend(self.book_items[1], 100, 1000)
+        self.on_time = self.lend(self.book_items[2], -3, 2)
+        HistoryItem.objects.update(fine=0)
+
+    def lend(self, book_item, days_late, daily_fine):
+        today = date.today()
+        return HistoryItem.objects.checkout_many(
+            self.reader, [book_item], today - timedelta(days=days_late),
+            date_taken=today - timedelta(days=200), daily_fine=daily_fine)[0]
+
+    def assertFines(self, late, very_late, on_time):
+        self.assertEqual([HistoryItem.objects.get(id=item.id).fine for item in
+                          (self.late, self.very_late, self.on_time)],
+                         [late, very_late, on_time])
+
+    def test_calculate_fine_is_capped(self):
+        self.assertEqual(self.late.calculate_fine(), 6)
+        self.assertEqual(self.very_late.calculate_fine(), models.MAX_FINE)
+
+    def test_accrue_fines_updates_only_changed_rows(self):
+        self.assertEqual(HistoryItem.objects.accrue_fines(), 2)
+        self.assertFines(6, models.MAX_FINE, 0)
+        self.assertEqual(HistoryItem.objects.accrue_fines(), 0)
+
+        self.assertEqual(HistoryItem.objects.accrue_fines(
+            date.today() + timedelta(days=1)), 1)
+        self.assertFines(8, models.MAX_FINE, 0)
+
+    def test_accrue_fines_skips_returned_loans(self):
+        HistoryItem.objects.return_many([self.late])
+        HistoryItem.objects.filter(id=self.late.id).update(fine=0)
+
+        self.assertEqual(HistoryItem.objects.accrue_fines(), 1)
+        self.assertFines(0, models.MAX_FINE, 0)
+
+    def test_accrue_fines_without_sql_for_the_database(self):
+        with mock.patch.dict(models.DAYS_SINCE_SQL, clear=True):
+            self.assertEqual(HistoryItem.objects.accrue_fines(), 2)
+            self.assertEqual(HistoryItem.objects.accrue_fines(), 0)
+        self.assertFines(6, models.MAX_FINE, 0)
+
+
+class MarkOverdueTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.today = date.today()
+        self.history_items = [
+            HistoryItem.objects.checkout_many(
+                self.reader, [book_item],
+                self.today + timedelta(days=days))[0]
+            for book_item, days in zip(self.book_items, (1, 2, 10))]
+
+    def statuses(self):
+        return ([HistoryItem.objects.get(id=item.id).status
+                 for item in self.history_items],
+                [BookItem.objects.get(id=item.id).status
+                 for item in self.book_items])
+
+    def test_mark_overdue_moves_loans_and_copies_to_pending(self):
+        marked = HistoryItem.objects.mark_overdue(
+            self.today + timedelta(days=3))
+
+        self.assertEqual([item.id for item in marked],
+                         [item.id for item in self.history_items[:2]])
+        self.assertEqual(self.statuses(), (
+            [HistoryItem.PENDING, HistoryItem.PENDING, HistoryItem.BORROWED],
+            [BookItem.PENDING, BookItem.PENDING, BookItem.BORROWED]))
+
+    def test_mark_overdue_only_hands_new_loans_to_later_runs(self):
+        HistoryItem.objects.mark_overdue(self.today + timedelta(days=2))
+        marked = HistoryItem.objects.mark_overdue(
+            self.today + timedelta(days=3))
+
+        self.assertEqual([item.id for item in marked],
+                         [self.history_items[1].id])
+
+    def test_mark_overdue_skips_returned_loans(self):
+        HistoryItem.objects.return_many(self.history_items[:1])
+
+        self.assertEqual(HistoryItem.objects.mark_overdue(
+            self.today + timedelta(days=30)), self.history_items[1:])
+        self.assertEqual(self.statuses()[0], [
+            HistoryItem.RETURNED, HistoryItem.PENDING, HistoryItem.PENDING])
+
+
+class LatestLoanTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.book_item = self.book_items[0]
+        self.today = date.today()
+
+    def lend(self, days_ago, returned=True, book_item=None):
+        history_item = HistoryItem(
+            book_item=book_item or self.book_item, reader=self.reader,
+            date_taken=self.today - timedelta(days=days_ago),
+            date_due=self.today - timedelta(days=days_ago - 7),
+            date_returned=(self.today - timedelta(days=days_ago - 1)
+                           if returned else None))
+        history_item.save()
+        return history_item
+
+    def last_loan(self, book_item=None):
+        return BookItem.objects.get(
+            id=(book_item or self.book_item).id).last_history_item_id
+
+    def test_newer_loan_is_promoted(self):
+        old = self.lend(20)
+        self.assertEqual(self.last_loan(), old.id)
+
+        new = self.lend(10)
+        self.assertEqual(self.last_loan(), new.id)
+
+    def test_older_loan_is_not_promoted(self):
+        new = self.lend(10)
+        self.lend(20)
+
+        self.assertEqual(self.last_loan(), new.id)
+        self.assertEqual(BookItem.objects.get(id=self.book_item.id)
+                         .last_date_taken, new.date_taken)
+
+    def test_latest_loan_moved_back_or_deleted_is_replaced(self):
+        old = self.lend(20)
+        new = self.lend(10)
+
+        new.date_taken = self.today - timedelta(days=30)
+        new.save()
+        self.assertEqual(self.last_loan(), old.id)
+
+        old.delete()
+        self.assertEqual(self.last_loan(), new.id)
+
+    def test_latest_loan_moved_to_another_copy(self):
+        other = self.book_items[1]
+        old = self.lend(20)
+        new = self.lend(10)
+
+        new.book_item = other
+        new.save()
+        self.assertEqual(self.last_loan(), old.id)
+        self.assertEqual(self.last_loan(other), new.id)
+
+    def test_rebuild_latest_restores_the_pointers(self):
+        self.lend(20)
+        first = self.lend(10, returned=False)
+        second = self.lend(5, book_item=self.book_items[1])
+        BookItem.objects.update(
+            **dict.fromkeys(target for target, source
+                            in BookItem.LAST_LOAN_FIELDS))
+
+        self.assertEqual(HistoryItem.objects.rebuild_latest(
+            [self.book_item.id]), 1)
+        self.assertEqual(self.last_loan(), first.id)
+        self.assertIsNone(self.last_loan(self.book_items[1]))
+
+        self.assertEqual(HistoryItem.objects.rebuild_latest(), 3)
+        self.assertEqual(self.last_loan(self.book_items[1]), second.id)
+        self.assertIsNone(self.last_loan(self.book_items[2]))
+
+        book_item = BookItem.objects.get(id=self.book_item.id)
+        self.assertEqual(book_item.last_date_due, first.date_due)
+        self.assertIsNone(book_item.last_date_returned)
+        self.assertEqual(book_item.status, BookItem.PENDING)
+
+
+class BookItemStatusTest(CirculationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other = Book(title='Quincas Borba', author=self.book.author,
+                          publisher=self.book.publisher, book_item_total=1)
+        self.other.save()
+
+    def statuses(self, book=None):
+        return list(BookItem.objects.filter(book=book or self.book).order_by(
+            'id').values_list('status', flat=True))
+
+    def lend(self, book_item, date_due=None):
+        history_item = HistoryItem(
+            book_item=book_item, reader=self.reader,
+            date_taken=date.today() - timedelta(days=10),
+            date_due=date_due or date.today() + timedelta(days=7))
+        history_item.save()
+        return history_item
+
+    def test_new_copies_are_available(self):
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 3)
+
+        self.book.book_item_total = 4
+        self.book.save()
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 4)
+
+    def test_copy_available_toggle(self):
+        book_item = self.book_items[0]
+        book_item.available = False
+        book_item.save()
+        self.assertEqual(self.statuses(), [BookItem.UNAVAILABLE,
+                                           BookItem.AVAILABLE,
+                                           BookItem.AVAILABLE])
+
+        book_item.available = True
+        book_item.save()
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 3)
+
+    def test_book_available_toggle(self):
+        self.book.available = False
+        self.book.save()
+        self.assertEqual(self.statuses(), [BookItem.UNAVAILABLE] * 3)
+        self.assertEqual(self.statuses(self.other), [BookItem.AVAILABLE])
+
+        self.book.available = True
+        self.book.save()
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 3)
+
+    def test_loan_saves_and_deletes(self):
+        history_item = self.lend(self.book_items[0])
+        self.assertEqual(self.statuses()[0], BookItem.BORROWED)
+
+        history_item.date_due = date.today() - timedelta(days=1)
+        history_item.save()
+        self.assertEqual(self.statuses()[0], BookItem.PENDING)
+
+        history_item.date_returned = date.today()
+        history_item.save()
+        self.assertEqual(self.statuses()[0], BookItem.AVAILABLE)
+
+        history_item.date_returned = None
+        history_item.save()
+        self.assertEqual(self.statuses()[0], BookItem.PENDING)
+
+        history_item.delete()
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 3)
+
+    def test_loan_moved_to_another_copy(self):
+        history_item = self.lend(self.book_items[0])
+        history_item.book_item = self.other.bookitem_set.get()
+        history_item.save()
+
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 3)
+        self.assertEqual(self.statuses(self.other), [BookItem.BORROWED])
+
+    def test_copies_moving_between_books(self):
+        self.lend(self.book_items[0])
+        self.other.available = False
+        self.other.save()
+
+        # a lent copy stays lent, an available one takes the book's status
+        for book_item in self.book_items[:2]:
+            book_item = BookItem.objects.get(id=book_item.id)
+            book_item.book = self.other
+            book_item.save()
+        self.assertEqual(self.statuses(self.other), [BookItem.BORROWED,
+                                                     BookItem.UNAVAILABLE,
+                                                     BookItem.UNAVAILABLE])
+
+        book_item = BookItem.objects.get(id=self.book_items[1].id)
+        book_item.book = self.book
+        book_item.save()
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 2)
+
+    def test_copy_deleted_with_its_loan(self):
+        self.lend(self.book_items[0])
+        BookItem.objects.get(id=self.book_items[0].id).delete()
+
+        self.assertCounters(2, 0)
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 2)
+
+    def test_check_book_item_status(self):
+        BookItem.objects.filter(id=self.book_items[1].id).update(
+            status=BookItem.BORROWED)
+
+        stdout = io.StringIO()
+        call_command('check_book_item_status', stdout=stdout)
+        self.assertIn('№%s: ' % self.book_items[1].id, stdout.getvalue())
+        self.assertIn('1 exemplar(es) divergente(s)', stdout.getvalue())
+        self.assertEqual(self.statuses()[1], BookItem.BORROWED)
+
+        stdout = io.StringIO()
+        call_command('check_book_item_status', repair=True, stdout=stdout)
+        self.assertIn('1 exemplar(es) corrigido(s)', stdout.getvalue())
+        self.assertEqual(self.statuses(), [BookItem.AVAILABLE] * 3)
+
+        stdout = io.StringIO()
+        call_command('check_book_item_status', stdout=stdout)
+        self.assertIn('0 exemplar(es) divergente(s)', stdout.getvalue())
+
+
+class ParseRangeTest(SimpleTestCase):
+
+    def test_single_ranges(self):
+        self.assertEqual(downloads.parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(downloads.parse_range('bytes=500-', 1000), (500, 999))
+        self.assertEqual(downloads.parse_range('bytes=900-5000', 1000),
+                         (900, 999))
+        self.assertEqual(downloads.parse_range('bytes=-100', 1000),
+                         (900, 999))
+        self.assertEqual(downloads.parse_range('bytes=-5000', 1000), (0, 999))
+
+    def test_whole_file(self):
+        for header in (None, '', 'bytes=-', 'bytes=0-1,5-9', 'items=0-9',
+                       'bytes=a-b', 'bytes=9-5'):
+            self.assertIsNone(downloads.parse_range(header, 1000), header)
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=1000-', 'bytes=2000-3000', 'bytes=-0'):
+            self.assertEqual(downloads.parse_range(header, 1000), (), header)
+        self.assertEqual(downloads.parse_range('bytes=0-9', 0), ())
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class DownloadTest(TestCase):
+
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = self.settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        book = Book(title='Dom Casmurro',
+                    author=Author.objects.create(name='Machado de Assis'),
+                    publisher=Publisher.objects.create(name='Garnier'))
+        book.save()
+        os.makedirs(os.path.join(media_root, 'books'))
+        with open(os.path.join(media_root, 'books', 'dom.pdf'), 'wb') as f:
+            f.write(self.content)
+        Book.objects.filter(id=book.id).update(file='books/dom.pdf')
+
+        self.url = reverse('book_download', args=[book.slug])
+
+    def get(self, **headers):
+        response = self.client.get(self.url, **headers)
+        self.addCleanup(response.close)
+        return response
+
+    def test_whole_file_stores_the_hash(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(Book.objects.get().file_hash,
+                         response['ETag'].strip('"'))
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[10:20])
+
+    def test_range_past_the_end(self):
+        response = self.get(HTTP_RANGE='bytes=2000-')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_if_range_with_another_version_sends_the_whole_file(self):
+        response = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"old"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_matching_etag(self):
+        etag = self.get()['ETag']
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_missing_book_or_file(self):
+        self.assertEqual(self.client.get(
+            reverse('book_download', args=['nao-existe'])).status_code, 404)
+        Book.objects.update(file='')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class CatalogueImporterTest(TestCase):
+
+    csv = (
+        'title,author,publisher,year,categories,copies\n'
+        'Dom Casmurro,Machado de Assis,Garnier,1899,Romance;Ficção,2\n'
+        'Dom Casmurro,MACHADO DE ASSÍS,Garnier,1900,Romance,\n'
+        'Sem autor,,Garnier,1900,,\n'
+        'Iracema,José de Alencar,Garnier,1865,Romance,3\n'
+        'O Guarani,José de Alencar,Garnier,1857,,1\n'
+    )
+
+    def records(self, fail_after=None):
+        for i, record in enumerate(read_csv(io.StringIO(self.csv))):
+            if i == fail_after:
+                raise IOError('interrompido')
+            yield record
+
+    def test_batches_write_books_copies_and_names(self):
+        checkpoint = ImportCheckpoint.objects.create(source='livros.csv')
+        batches = list(CatalogueImporter(batch_size=2).run(self.records(),
+                                                           checkpoint))
+
+        self.assertEqual(batches, [(2, 2), (2, 1), (1, 1)])
+        self.assertEqual((checkpoint.records, checkpoint.imported), (5, 4))
+        self.assertEqual(sorted(Book.objects.values_list('slug', flat=True)),
+                         ['dom-casmurro', 'dom-casmurro-2', 'iracema',
+                          'o-guarani'])
+        self.assertEqual(Author.objects.count(), 2)
+        self.assertEqual(Publisher.objects.count(), 1)
+        self.assertEqual(
+            sorted(Book.objects.values_list('book_item_total', flat=True)),
+            [1, 1, 2, 3])
+        self.assertEqual(BookItem.objects.count(), 7)
+        self.assertEqual(Book.objects.get(slug='dom-casmurro')
+                         .category.count(), 2)
+
+    def test_interrupted_import_resumes_after_the_last_batch(self):
+        checkpoint = ImportCheckpoint.objects.create(source='livros.csv')
+        with self.assertRaises(IOError):
+            for batch in CatalogueImporter(batch_size=2).run(
+                    self.records(fail_after=3), checkpoint):
+                pass
+
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual((checkpoint.records, checkpoint.imported), (2, 2))
+        self.assertEqual(Book.objects.count(), 2)
+
+        batches = list(CatalogueImporter(batch_size=2).run(self.records(),
+                                                           checkpoint))
+
+        self.assertEqual(batches, [(2, 1), (1, 1)])
+        self.assertEqual((checkpoint.records, checkpoint.imported), (5, 4))
+        self.assertEqual(Book.objects.count(), 4)
+        self.assertEqual(BookItem.objects.count(), 7)
+
+
+@mock.patch.object(exports, 'CHUNK_SIZE', 2)
+class ExportTest(TestCase):
+
+    def setUp(self):
+        author = Author.objects.create(name='Machado de Assis')
+        publisher = Publisher.objects.create(name='Garnier')
+        for i in range(5):
+            Book(title='Livro %s' % i, author=author,
+                 publisher=publisher).save()
+
+        # ties on updated_at, broken by id
+        self.moment = (timezone.now() - timedelta(days=2)).replace(
+            hour=12, minute=0, second=0, microsecond=0)
+        Book.objects.update(updated_at=self.moment)
+        self.ids = list(Book.objects.order_by('id').values_list('id',
+                                                                flat=True))
+
+    def test_chunks_read_every_row_once(self):
+        cursor = {}
+        with CaptureQueriesContext(connection) as context:
+            rows = list(exports.EXPORTS['books'].rows(cursor=cursor))
+
+        self.assertEqual([row[0] for row in rows], self.ids)
+        self.assertEqual(len(context), 3)
+        self.assertEqual(cursor, {'key': (self.moment, self.ids[-1]),
+                                  'rows': 5})
+
+    def test_cursor_round_trip(self):
+        export = exports.EXPORTS['books']
+        position = (self.moment, self.ids[1])
+
+        self.assertEqual(export.parse_cursor(export.format_cursor(position)),
+                         position)
+        self.assertEqual([row[0] for row in export.rows(since=position)],
+                         self.ids[2:])
+
+    def test_since_an_id(self):
+        BookItem.objects.bulk_create([BookItem(book_id=self.ids[0])
+                                      for i in range(3)])
+        first = BookItem.objects.order_by('id').first().id
+
+        self.assertEqual([row[0] for row in exports.EXPORTS['book_items']
+                          .rows(since=first)], [first + 1, first + 2])
+
+    def test_since_a_date(self):
+        export = exports.EXPORTS['books']
+        tomorrow = self.moment + timedelta(days=1)
+        Book.objects.filter(id=self.ids[-1]).update(updated_at=tomorrow)
+
+        since = export.parse_cursor(tomorrow.date().isoformat())
+        self.assertEqual(timezone.localtime(since[0]).time(), time.min)
+        self.assertEqual(since[1], 0)
+        self.assertEqual([row[0] for row in export.rows(since=since)],
+                         [self.ids[-1]])
+        with self.assertRaises(ValueError):
+            export.parse_cursor('ontem')
+
+    def test_checkpoint_exports_only_new_rows(self):
+        def export():
+            stdout = io.StringIO()
+            call_command('export_records', 'books', format='jsonl',
+                         checkpoint='livros', stdout=stdout,
+                         stderr=io.StringIO())
+            return stdout.getvalue().splitlines()
+
+        self.assertEqual(len(export()), 5)
+        self.assertEqual(export(), [])
+
+        Book.objects.filter(id=self.ids[2]).update(
+            updated_at=self.moment + timedelta(seconds=1))
+        lines = export()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('"id": %s,' % self.ids[2], lines[0])
+
+        # a row stamped with the time of the last one exported, but with a
+        # higher id, is not skipped
+        book = Book(title='Livro 5', author=Author.objects.get(),
+                    publisher=Publisher.objects.get())
+        book.save()
+        Book.objects.filter(id=book.id).update(
+            updated_at=self.moment + timedelta(seconds=1))
+        lines = export()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('"id": %s,' % book.id, lines[0])
+
+    def test_recent_changes_wait_for_the_next_run(self):
+        def export():
+            stdout = io.StringIO()
+            call_command('export_records', 'books', format='jsonl',
+                         checkpoint='livros', stdout=stdout,
+                         stderr=io.StringIO())
+            return stdout.getvalue().splitlines()
+
+        Book.objects.filter(id=self.ids[0]).update(updated_at=timezone.now())
+        self.assertEqual(len(export()), 4)
+
+        with mock.patch('library_sys.management.commands.export_records.'
+                        'EXPORT_LAG', timedelta(0)):
+            lines = export()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('"id": %s,' % self.ids[0], lines[0])
+
+    def test_invalid_since(self):
+        with self.assertRaises(CommandError):
+            call_command('export_records', 'books', since='ontem',
+                         stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class NameMergeTest(TestCase):
+
+    def setUp(self):
+        self.publisher = Publisher.objects.create(name='Garnier')
+        self.authors = [Author.objects.create(name=name) for name in (
+            'Machado de Assis', 'MACHADO DE ASSÍS', 'machado de assis.',
+            'José de Alencar')]
+        self.books = []
+        for i, author in enumerate(self.authors):
+            book = Book(title='Livro %s' % i, author=author,
+                        publisher=self.publisher)
+            book.save()
+            self.books.append(book)
+
+    def author_ids(self):
+        return [Book.objects.get(id=book.id).author_id for book in self.books]
+
+    def test_name_key(self):
+        self.assertEqual(Author.objects.by_name('machado  de ASSIS').count(),
+                         3)
+        self.assertEqual(Author.objects.prefix('JOSE').get(),
+                         self.authors[3])
+
+    def test_merge_moves_books_and_deletes_duplicates(self):
+        keep, first, second, other = self.authors
+        moved = Author.objects.merge({first.id: keep.id, second.id: keep.id,
+                                      keep.id: keep.id})
+
+        self.assertEqual(moved, 2)
+        self.assertEqual(self.author_ids(),
+                         [keep.id, keep.id, keep.id, other.id])
+        self.assertEqual(list(Author.objects.order_by('id')), [keep, other])
+        self.assertEqual(Author.objects.merge({}), 0)
+
+    def test_merge_duplicates_keeps_the_oldest(self):
+        keep, first, second, other = self.authors
+
+        self.assertEqual(Author.objects.merge_duplicates(batch_size=1),
+                         (2, 2))
+        self.assertEqual(self.author_ids(),
+                         [keep.id, keep.id, keep.id, other.id])
+        self.assertEqual(Author.objects.merge_duplicates(), (0, 0))
+
+    def test_merge_names_command(self):
+        keep, first, second, other = self.authors
+        call_command('merge_names', 'authors', str(other.id), str(first.id),
+                     stdout=io.StringIO())
+
+        self.assertEqual(self.author_ids(),
+                         [keep.id, other.id, second.id, other.id])
+        with self.assertRaises(CommandError):
+            call_command('merge_names', 'authors', stdout=io.StringIO())
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class AutocompleteTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(Reader.objects.create_superuser(
+            'admin', 'admin@example.com', 'admin'))
+        author = Author.objects.create(name='Machado de Assis')
+        publisher = Publisher.objects.create(name='Garnier')
+        for title in ('Memórias Póstumas de Brás Cubas', 'Memorial de Aires',
+                      'Dom Casmurro'):
+            Book(title=title, author=author, publisher=publisher).save()
+        Category.objects.create(title='Ficção')
+        Reader.objects.create_user('mlima', first_name='Maria',
+                                   last_name='Lima')
+
+    def texts(self, model_name, query):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                reverse('admin:library_sys_%s_autocomplete' % model_name),
+                {'q': query})
+        self.assertEqual(response.status_code, 200)
+        for query in context.captured_queries:
+            # prefixes only, which the indexes serve
+            self.assertNotIn("LIKE '%", query['sql'])
+            self.assertNotIn('UPPER(', query['sql'])
+        return [result['text'] for result in response.json()['results']]
+
+    def test_books_by_title_prefix(self):
+        self.assertEqual(self.texts('book', 'MEMO'), [
+            'Machado de Assis - Memorial de Aires',
+            'Machado de Assis - Memórias Póstumas de Brás Cubas'])
+        self.assertEqual(self.texts('book', 'memórias  pos'),
+                         ['Machado de Assis - Memórias Póstumas de Brás Cubas'])
+        self.assertEqual(self.texts('book', 'casmurro'), [])
+
+    def test_title_key_follows_the_title(self):
+        book = Book.objects.get(title='Dom Casmurro')
+        book.title = 'Quincas Borba'
+        book.save()
+
+        self.assertEqual(Book.objects.get(id=book.id).title_key,
+                         'quincas borba')
+        self.assertEqual(self.texts('book', 'quincas'),
+                         ['Machado de Assis - Quincas Borba'])
+
+    def test_categories_by_slug_prefix(self):
+        self.assertEqual(self.texts('category', 'ficcao'), ['Ficção'])
+        self.assertEqual(self.texts('category', 'FIC'), ['Ficção'])
+        self.assertEqual(self.texts('category', '!'), [])
+
+    def test_readers_by_name_prefix(self):
+        reader = str(Reader.objects.get(username='mlima'))
+        self.assertEqual(self.texts('reader', 'MARIA L'), [reader])
+        self.assertEqual(self.texts('reader', 'lima'), [])
+        self.assertIn('admin', self.texts('reader', 'adm')[0])
+
+    def test_authors_by_name_prefix(self):
+        self.assertEqual(self.texts('author', 'machado'), ['Machado de Assis'])
+
+    def test_pages_are_cached_until_a_row_changes(self):
+        self.assertEqual(self.texts('author', 'ma'), ['Machado de Assis'])
+        Author.objects.filter(name='Machado de Assis').update(name='Mário')
+        self.assertEqual(self.texts('author', 'ma'), ['Machado de Assis'])
+
+        with run_on_commit():
+            Author.objects.create(name='Manuel Antônio de Almeida')
+        self.assertEqual(sorted(self.texts('author', 'ma')), [
+            'Manuel Antônio de Almeida', 'Mário'])
+
+        with run_on_commit():
+            Author.objects.get(name='Mário').delete()
+        self.assertEqual(self.texts('author', 'ma'),
+                         ['Manuel Antônio de Almeida'])
+
+
+
+@contextmanager
+def run_on_commit():
+    """
+    Run the on_commit callbacks registered in the block when it ends, as
+    a commit would: TestCase never commits.
+    """
+    callbacks = []
+    with mock.patch('django.db.transaction.on_commit',
+                    side_effect=callbacks.append):
+        yield
+        while callbacks:
+            callbacks.pop(0)()
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class BookDetailsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.book = Book(title='Dom Casmurro',
+                         author=Author.objects.create(name='Machado de Assis'),
+                         publisher=Publisher.objects.create(name='Garnier'))
+        self.book.save()
+        Book.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        self.url = reverse('book', args=[self.book.slug])
+        self.first = self.client.get(self.url)
+
+    def assertRevalidates(self, status_code):
+        self.assertEqual(self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=self.first['ETag']).status_code,
+            status_code)
+        self.assertEqual(self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=self.first['Last-Modified']
+        ).status_code, status_code)
+
+    def test_unchanged_page(self):
+        self.assertEqual(self.first.status_code, 200)
+        self.assertContains(self.first, 'Dom Casmurro')
+        self.assertRevalidates(304)
+
+    def test_edited_book(self):
+        with mock.patch('django.utils.timezone.now',
+                        return_value=timezone.now() + timedelta(minutes=1)):
+            book = Book.objects.get(id=self.book.id)
+            book.title = 'Dom Casmurro (2a edição)'
+            book.save()
+
+        self.assertRevalidates(200)
+        self.assertContains(self.client.get(self.url), '2a edição')
+
+    def test_edited_author(self):
+        with mock.patch('django.utils.timezone.now',
+                        return_value=timezone.now() + timedelta(minutes=1)):
+            Author.objects.filter(id=self.book.author_id).get().save()
+
+        self.assertRevalidates(200)
+
+    def test_changed_tags(self):
+        with mock.patch('library_sys.caching.time.time',
+                        return_value=caching.time.time() + 60), \
+                run_on_commit():
+            signals.tags_changed(sender=None)
+
+        self.assertRevalidates(200)
+
+    def test_unknown_or_inactive_book(self):
+        self.assertEqual(self.client.get(
+            reverse('book', args=['nao-existe'])).status_code, 404)
+        Book.objects.update(activated=False)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+@override_settings(ROOT_URLCONF='library_sys.tests')
+class MemorySearchTest(TestCase):
+
+    def make_backend(self):
+        return search.MemoryBackend()
+
+    def setUp(self):
+        backend = mock.patch.object(search, '_backend', self.make_backend())
+        backend.start()
+        self.addCleanup(backend.stop)
+
+        self.author = Author.objects.create(name='Machado de Assis')
+        self.publisher = Publisher.objects.create(name='Garnier')
+        self.category = Category.objects.create(title='Ficção')
+        self.ids = []
+        with run_on_commit():
+            for i in range(5):
+                book = Book(title='Contos', author=self.author,
+                            publisher=self.publisher)
+                book.save()
+                self.ids.append(book.id)
+            book = Book(title='Análise de Contos Fluminenses',
+                        author=Author.objects.create(name='Lúcia Miguel'),
+                        publisher=self.publisher)
+            book.save()
+            book.category.add(self.category)
+            self.other_id = book.id
+
+    def find(self, **params):
+        """ Ids of the books found, as the JSON mode of the view lists them. """
+        response = self.client.get(reverse('search'),
+                                   dict(params, format='json'))
+        self.assertEqual(response.status_code, 200)
+        return [result['id'] for result in response.json()['results']]
+
+    def backend_ids(self, text):
+        hits, total = search.get_backend().search(search.parse_terms(text))
+        return sorted(book_id for rank, book_id in hits)
+
+    def test_pages_of_equal_ranks(self):
+        url = '%s?%s' % (reverse('search'), 'title=contos&page_size=2&'
+                                            'format=json')
+        found = []
+        while url:
+            data = self.client.get(url).json()
+            self.assertEqual(data['total'], 6)
+            found += [result['id'] for result in data['results']]
+            url = data['next'] and reverse('search') + data['next']
+
+        self.assertEqual(found, self.ids + [self.other_id])
+
+    def test_malformed_cursor_gives_the_first_page(self):
+        first = self.find(title='contos', page_size=2)
+        for after in ('abc', '1_2_3', '_', 'x_1'):
+            self.assertEqual(self.find(title='contos', page_size=2,
+                                       after=after), first)
+
+    def test_accents_and_prefixes(self):
+        self.assertEqual(self.find(title='ANALISE flu'), [self.other_id])
+        self.assertEqual(self.find(author='lucia'), [self.other_id])
+        self.assertEqual(self.find(title='contos', author='machado'),
+                         self.ids)
+
+    def test_html_mode(self):
+        response = self.client.get(reverse('search'),
+                                   {'title': 'contos', 'page_size': 2})
+        self.assertContains(response, 'Registros encontrados: 6.')
+        self.assertContains(response, 'Próximos')
+        self.assertNotContains(response, 'Início')
+
+        response = self.client.get(reverse('search'), {'title': 'nada'})
+        self.assertContains(response, 'Nenhum registro encontrado')
+
+        response = self.client.get(reverse('search'), {'title': ''})
+        self.assertTemplateUsed(response, 'search_form.html')
+
+    def test_author_and_publisher_renamed(self):
+        with run_on_commit():
+            self.author.name = 'Joaquim Maria'
+            self.author.save()
+            self.publisher.name = 'Laemmert'
+            self.publisher.save()
+
+        self.assertEqual(self.find(author='joaquim'), self.ids)
+        self.assertEqual(self.find(author='machado'), [])
+        self.assertEqual(self.backend_ids('laemmert'),
+                         self.ids + [self.other_id])
+        self.assertEqual(self.backend_ids('garnier'), [])
+
+    def test_category_renamed_and_deleted(self):
+        with run_on_commit():
+            self.category.title = 'Crítica'
+            self.category.save()
+        self.assertEqual(self.backend_ids('critica'), [self.other_id])
+
+        with run_on_commit():
+            self.category.delete()
+        self.assertEqual(self.backend_ids('critica'), [])
+
+    def test_book_deactivated_and_deleted(self):
+        with run_on_commit():
+            book = Book.objects.get(id=self.ids[0])
+            book.activated = False
+            book.save()
+            Book.objects.get(id=self.ids[1]).delete()
+
+        self.assertEqual(self.find(title='contos', author='machado'),
+                         self.ids[2:])
+
+
+class SQLiteFTS5SearchTest(MemorySearchTest):
+
+    def make_backend(self):
+        if (search.SQLiteFTS5Backend.table not in
+                connection.introspection.table_names()):
+            self.skipTest('SQLite without FTS5')
+        return search.SQLiteFTS5Backend()
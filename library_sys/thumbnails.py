@@ -0,0 +1,158 @@
+"""
+Resized copies of ``Book.cover`` for the public pages.
+
+Thumbnails are named after the SHA-1 of the cover content and their width,
+so they are written once, shared by books with the same cover and never
+go stale: a new cover has a new hash. They are made after the commit that
+stores a cover, or on first use for covers uploaded before.
+
+Settings:
+
+- ``LIBRARY_SYS_THUMBNAIL_WIDTHS``: widths in pixels, by default
+  ``(160, 320, 640)``. Covers are never enlarged.
+- ``LIBRARY_SYS_THUMBNAIL_QUALITY``: JPEG and WebP quality, by default 80.
+"""
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image
+
+from .caching import KEY_PREFIX
+from .downloads import content_hash
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = tuple(sorted(getattr(settings, 'LIBRARY_SYS_THUMBNAIL_WIDTHS',
+                              (160, 320, 640))))
+QUALITY = getattr(settings, 'LIBRARY_SYS_THUMBNAIL_QUALITY', 80)
+DIRECTORY = 'book/thumbs'
+
+Image.init()
+''' WebP FIRST, WHEN PILLOW WAS BUILT WITH IT; JPEG IS THE FALLBACK '''
+FORMATS = tuple(fmt for fmt in ('WEBP', 'JPEG') if fmt in Image.SAVE)
+MIME_TYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+
+
+def thumbnail_prefix(cover_hash):
+    """
+    Common prefix of the thumbnails of ``cover_hash``, used to remove them.
+    """
+    return '%s/%s/%s' % (DIRECTORY, cover_hash[:2], cover_hash)
+
+
+def hash_of_prefix(path):
+    """
+    The cover hash of a ``thumbnail_prefix``, ``None`` for other paths.
+    """
+    if path.startswith(DIRECTORY + '/'):
+        return os.path.basename(path)
+    return None
+
+
+def thumbnail_name(cover_hash, width, fmt):
+    return '%s_%s.%s' % (thumbnail_prefix(cover_hash), width,
+                         'jpg' if fmt == 'JPEG' else fmt.lower())
+
+
+def _cache_key(cover_hash):
+    return '%s:thumbnails:%s' % (KEY_PREFIX, cover_hash)
+
+
+def forget(cover_hash):
+    """
+    Drop what is known of the thumbnails of ``cover_hash``, after they are
+    removed from the storage.
+    """
+    cache.delete(_cache_key(cover_hash))
+
+
+def generate(book):
+    """
+    Write the missing thumbnails of the cover of ``book``. Returns
+    ``{format: [(width, name)]}``, smallest width first.
+    """
+    storage = book.cover.storage
+    book.cover.open('rb')
+    try:
+        image = Image.open(book.cover)
+        image.load()
+    finally:
+        book.cover.close()
+
+    widths = [w for w in WIDTHS if w <= image.width] or [image.width]
+    thumbnails = {}
+    for fmt in FORMATS:
+        thumbnails[fmt] = []
+        for width in widths:
+            name = thumbnail_name(book.cover_hash, width, fmt)
+            if not storage.exists(name):
+                resized = image.copy()
+                if fmt == 'JPEG' and resized.mode != 'RGB':
+                    resized = resized.convert('RGBA')
+                    background = Image.new('RGB', resized.size, 'white')
+                    background.paste(resized, mask=resized.split()[-1])
+                    resized = background
+                resized.thumbnail((width, image.height), Image.LANCZOS)
+
+                content = io.BytesIO()
+                resized.save(content, fmt, quality=QUALITY)
+                storage.save(name, ContentFile(content.getvalue()))
+            thumbnails[fmt].append((width, name))
+
+    cache.set(_cache_key(book.cover_hash), thumbnails, None)
+    return thumbnails
+
+
+def generate_on_commit(book):
+    """
+    Make the thumbnails of a new cover once the current transaction
+    commits. Failures are logged: they are retried on first use.
+    """
+    def run():
+        try:
+            generate(book)
+        except (IOError, OSError):
+            logger.exception('could not make the thumbnails of %s',
+                             book.cover.name)
+
+    transaction.on_commit(run)
+
+
+def get_thumbnails(book):
+    """
+    ``{format: [(width, name)]}`` of the cover of ``book``, made on first
+    use. Empty when the book has no cover or it cannot be read.
+    """
+    if not book.cover:
+        return {}
+
+    if not book.cover_hash:
+        ''' COVERS STORED BEFORE THE HASH WAS KEPT '''
+        try:
+            book.cover_hash = content_hash(book.cover)
+        except (IOError, OSError):
+            return {}
+        type(book).objects.filter(id=book.id).update(
+            cover_hash=book.cover_hash)
+
+    thumbnails = cache.get(_cache_key(book.cover_hash))
+    if thumbnails is None:
+        try:
+            thumbnails = generate(book)
+        except (IOError, OSError):
+            return {}
+    return thumbnails
+
+
+def srcset(book, fmt):
+    """
+    ``srcset`` attribute of the ``fmt`` thumbnails of ``book``.
+    """
+    url = book.cover.storage.url
+    return ', '.join('%s %sw' % (url(name), width)
+                     for width, name in get_thumbnails(book).get(fmt, []))
@@ -0,0 +1,90 @@
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.utils.datastructures import MultiValueDict
+
+''' LARGEST UPLOAD KEPT, BY DEFAULT THE LARGEST BOOK FILE ALLOWED '''
+MAX_UPLOAD_SIZE = getattr(settings, 'LIBRARY_SYS_MAX_UPLOAD_SIZE',
+                          5 * 1024 * 1024)
+
+
+class OversizeUploadedFile(UploadedFile):
+    """
+    Stand-in for an upload over ``max_size``: only its first chunk is
+    kept, ``size`` is the size received.
+    """
+    oversize = True
+
+    def __init__(self, head, name, content_type, size, charset,
+                 content_type_extra=None, max_size=MAX_UPLOAD_SIZE):
+        super().__init__(BytesIO(head), name, content_type, size, charset,
+                         content_type_extra)
+        self.max_size = max_size
+
+    def open(self, mode=None):
+        self.file.seek(0)
+        return self
+
+
+class MaxSizeUploadHandler(FileUploadHandler):
+    """
+    Stop reading the request once an upload goes over ``max_size`` (by
+    default ``MAX_UPLOAD_SIZE``), without waiting for the rest of it. An
+    ``OversizeUploadedFile`` is kept in ``request.oversize_uploads`` by
+    field name, for the forms made with ``oversize_form``, whose
+    validators always reject it, whatever the size the field allows.
+
+    The fields sent after the upload are lost with the rest of the
+    request, so the form is shown again with their errors too.
+
+    Put it first in ``FILE_UPLOAD_HANDLERS``, so the handlers after it
+    never see the dropped chunks.
+    """
+
+    max_size = MAX_UPLOAD_SIZE
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.head = b''
+
+    def receive_data_chunk(self, raw_data, start):
+        if not start:
+            self.head = raw_data
+        received = start + len(raw_data)
+        if received > self.max_size:
+            if self.request is not None:
+                if not hasattr(self.request, 'oversize_uploads'):
+                    self.request.oversize_uploads = {}
+                self.request.oversize_uploads[self.field_name] = (
+                    OversizeUploadedFile(self.head, self.file_name,
+                                         self.content_type, received,
+                                         self.charset,
+                                         self.content_type_extra,
+                                         self.max_size))
+            raise StopUpload(connection_reset=True)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def oversize_form(form_class, request):
+    """
+    ``form_class`` binding the uploads ``MaxSizeUploadHandler`` stopped
+    in ``request`` along with the files it is given.
+    """
+    class OversizeUploadForm(form_class):
+
+        def __init__(self, data=None, files=None, *args, **kwargs):
+            ''' READ HERE: THE REQUEST IS PARSED AFTER THE CLASS IS MADE '''
+            oversize = getattr(request, 'oversize_uploads', None)
+            if oversize:
+                files = files.copy() if files else MultiValueDict()
+                for field_name, upload in oversize.items():
+                    files[field_name] = upload
+            super().__init__(data, files, *args, **kwargs)
+
+    OversizeUploadForm.__name__ = form_class.__name__
+    return OversizeUploadForm
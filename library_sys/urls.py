@@ -11,5 +11,7 @@ urlpatterns = [
     url(r'^logout/$', forms.LogoutView.as_view(), name='logout'),
     url(r'^change_pass/$', views.change_password, name='change_password'),
     url(r'^book_list/$', views.BookListView.as_view(), name='book_list'),
-    url(r'^(?P<slug>.*?)/$', views.book, name='book'),
+    url(r'^(?P<slug>[-\w]+)/download/$', views.download,
+        name='book_download'),
+    url(r'^(?P<slug>[-\w]+)/$', views.book, name='book'),
 ]
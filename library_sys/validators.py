@@ -16,6 +16,60 @@ from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import filesizeformat
 from django.utils.deconstruct import deconstructible
 
+''' BYTES ENOUGH TO TELL EVERY FORMAT OF MAGIC_NUMBERS APART '''
+HEAD_SIZE = 64
+
+''' (OFFSET, BYTES, MIMETYPE), THE FIRST MATCH WINS '''
+MAGIC_NUMBERS = (
+    (0, b'%PDF-', 'application/pdf'),
+    (30, b'mimetypeapplication/epub+zip', 'application/epub+zip'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (8, b'WEBP', 'image/webp'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+)
+
+IMAGE_MIMETYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp',
+                   'image/bmp', 'image/tiff')
+
+
+def sniff_mimetype(head):
+    """
+    Mimetype of a file from its first ``HEAD_SIZE`` bytes, ``None`` when
+    they match none of ``MAGIC_NUMBERS``.
+    """
+    for offset, magic, mimetype in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return mimetype
+    return None
+
+
+def read_head(value):
+    """
+    First ``HEAD_SIZE`` bytes of the uploaded or stored file ``value``,
+    ``None`` when it cannot be read.
+    """
+    committed = getattr(value, '_committed', False)
+    try:
+        if committed:
+            value.open('rb')
+        try:
+            value.seek(0)
+            return value.read(HEAD_SIZE)
+        finally:
+            if committed:
+                value.close()
+            else:
+                value.seek(0)
+    except (IOError, OSError, ValueError):
+        return None
+
+
 @deconstructible
 class FileValidator(object):
     """
@@ -30,6 +84,9 @@ class FileValidator(object):
             ie. 100
         max_size: maximum number of bytes allowed
             ie. 24*1024*1024 for 24 MB
+        sniff: take the mimetype from the first bytes of the file
+            instead of its extension
+            ie. True
 
     Usage example::
 
@@ -48,10 +105,11 @@ class FileValidator(object):
         self.allowed_mimetypes = kwargs.pop('allowed_mimetypes', None)
         self.min_size = kwargs.pop('min_size', 0)
         self.max_size = kwargs.pop('max_size', None)
+        self.sniff = kwargs.pop('sniff', False)
 
     def __call__(self, value):
         """
-        Check the extension, content type and file size.
+        Check the extension, file size and content type.
         """
 
         # Check the extension
@@ -64,19 +122,21 @@ class FileValidator(object):
 
             raise ValidationError(message)
 
-        # Check the content type
-        mimetype = mimetypes.guess_type(value.name)[0]
-        if self.allowed_mimetypes and not mimetype in self.allowed_mimetypes:
-            message = self.mime_message % {
-                'mimetype': mimetype,
-                'allowed_mimetypes': ', '.join(self.allowed_mimetypes)
+        # Check the file size, known from the upload handler before the
+        # content is read. Uploads dropped by MaxSizeUploadHandler only
+        # hold their first bytes, so they are refused whatever max_size is
+        filesize = len(value)
+        upload = getattr(value, '_file', None) or value
+        if getattr(upload, 'oversize', False):
+            message = self.max_size_message % {
+                'size': filesizeformat(filesize),
+                'allowed_size': filesizeformat(min(
+                    self.max_size or upload.max_size, upload.max_size))
             }
 
             raise ValidationError(message)
 
-        # Check the file size
-        filesize = len(value)
-        if self.max_size and filesize > self.max_size:
+        elif self.max_size and filesize > self.max_size:
             message = self.max_size_message % {
                 'size': filesizeformat(filesize),
                 'allowed_size': filesizeformat(self.max_size)
@@ -91,3 +151,18 @@ class FileValidator(object):
             }
 
             raise ValidationError(message)
+
+        # Check the content type, from the first bytes of the file, new
+        # upload or stored one, or from its name when it cannot be read
+        head = read_head(value) if self.sniff else None
+        if head is not None:
+            mimetype = sniff_mimetype(head)
+        else:
+            mimetype = mimetypes.guess_type(value.name)[0]
+        if self.allowed_mimetypes and not mimetype in self.allowed_mimetypes:
+            message = self.mime_message % {
+                'mimetype': mimetype,
+                'allowed_mimetypes': ', '.join(self.allowed_mimetypes)
+            }
+
+            raise ValidationError(message)
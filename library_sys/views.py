@@ -1,14 +1,36 @@
 # -*- coding: utf-8 -*-
 
+import calendar
+import hashlib
+import math
+import os
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.forms import PasswordChangeForm
-from django.shortcuts import render_to_response, render, redirect
-from django.db.models.query import EmptyQuerySet
+from django.shortcuts import (get_object_or_404, render_to_response, render,
+                              redirect)
 from django.views.generic import ListView
-from django.core.exceptions import ObjectDoesNotExist
-
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, JsonResponse
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from . import caching, downloads
 from .models import Book, HistoryItem
+from .search import get_backend, parse_terms
+
+DETAILS_CACHE_TIMEOUT = getattr(settings,
+                                'LIBRARY_SYS_DETAILS_CACHE_TIMEOUT',
+                                24 * 60 * 60)
+SEARCH_PAGE_SIZE = getattr(settings, 'LIBRARY_SYS_SEARCH_PAGE_SIZE', 20)
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_RESULT_FIELDS = ('title', 'slug', 'year', 'book_item_total',
+                        'cover', 'cover_hash', 'cover_width', 'cover_height',
+                        'author__name', 'publisher__name')
 
 
 def index(request):
@@ -43,58 +65,158 @@ def change_password(request):
                    'message': messages})
 
 
+def encode_cursor(hit):
+    return '%r_%s' % hit
+
+
+def decode_cursor(cursor):
+    try:
+        rank, book_id = cursor.split('_')
+        return float(rank), int(book_id)
+    except (AttributeError, ValueError):
+        return None
+
+
 def search(request):
     error = False
     if 'title' in request.GET or 'author' in request.GET:
-        title = request.GET['title']
-        author = request.GET['author']
+        title = request.GET.get('title', '')
+        author = request.GET.get('author', '')
         if not title and not author:
             error = True
-        elif title and author:
-            books = Book.obj_active.filter(author__name__icontains=author,
-                                        title__icontains=title)
+        else:
+            try:
+                page_size = min(int(request.GET.get('page_size',
+                                                    SEARCH_PAGE_SIZE)),
+                                SEARCH_MAX_PAGE_SIZE)
+            except ValueError:
+                page_size = SEARCH_PAGE_SIZE
+            page_size = max(page_size, 1)
+
+            terms = (parse_terms(title, 'title') +
+                     parse_terms(author, 'author'))
+            hits, total = get_backend().search(
+                terms, limit=page_size + 1,
+                after=decode_cursor(request.GET.get('after')))
+
+            book_ids = [book_id for rank, book_id in hits[:page_size]]
+            books = Book.obj_active.select_related(
+                'author', 'publisher').only(*SEARCH_RESULT_FIELDS).in_bulk(
+                book_ids)
+            books = [books[i] for i in book_ids if i in books]
+
+            params = request.GET.copy()
+            params.pop('after', None)
+            first_url = '?%s' % params.urlencode()
+            next_url = None
+            if len(hits) > page_size:
+                params['after'] = encode_cursor(hits[page_size - 1])
+                next_url = '?%s' % params.urlencode()
+
+            if request.GET.get('format') == 'json':
+                return JsonResponse({
+                    'total': total,
+                    'next': next_url,
+                    'results': [{
+                        'id': book.id,
+                        'title': book.title,
+                        'author': book.author.name,
+                        'publisher': book.publisher.name,
+                        'year': book.year,
+                        'url': book.get_absolute_url(),
+                    } for book in books],
+                })
+
             return render_to_response('search_results.html',
                                       {'books': books,
-                                       'query': author + '-' + title})
-        elif title:
-            books = Book.obj_active.filter(title__icontains=title)
-            return render_to_response('search_results.html',
-                                      {'books': books, 'query': title})
-        elif author:
-            books = Book.obj_active.filter(author__name__icontains=author)
-            return render_to_response('search_results.html',
-                                      {'books': books, 'query': author})
+                                       'total': total,
+                                       'first_url': (first_url
+                                                     if 'after' in request.GET
+                                                     else None),
+                                       'next_url': next_url,
+                                       'query': '-'.join(
+                                           x for x in (author, title) if x)})
     return render_to_response('search_form.html', {'error': error})
 
 
 def book(request, slug):
+    """
+    Details of a book. The rendered page is cached by slug and
+    ``updated_at``, which changes with the book and with its author,
+    publisher and categories (see ``signals.py``). Tag changes drop every
+    cached page and move every Last-Modified past them. ETag and
+    Last-Modified let browsers revalidate for free.
+    """
+    book = get_object_or_404(Book.obj_active.only('id', 'updated_at'),
+                             slug=slug)
+
+    updated_at = book.updated_at
+    if timezone.is_naive(updated_at):
+        updated_at = timezone.make_aware(updated_at)
+    ''' TAG CHANGES DO NOT TOUCH updated_at, ONLY THE NAMESPACE '''
+    tags_changed_at = caching.get_changed_at(caching.BOOK_DETAILS)
+    last_modified = max(calendar.timegm(updated_at.utctimetuple()),
+                        math.ceil(tags_changed_at))
+    key = caching.make_key(caching.BOOK_DETAILS, slug, updated_at.isoformat())
+    etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    response = get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified)
+    if response is None:
+        content = cache.get(key)
+        if content is None:
+            book = Book.obj_active.select_related(
+                'author', 'publisher').get(id=book.id)
+            content = render_to_string('details.html', {'book': book})
+            cache.set(key, content, DETAILS_CACHE_TIMEOUT)
+        response = HttpResponse(content)
+
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def download(request, slug):
+    """
+    File of an active book, with ranges for resumed downloads and a
+    strong ETag from the hash of the file (see ``downloads.py``).
+    """
+    book = get_object_or_404(
+        Book.obj_active.only('id', 'slug', 'file', 'file_hash'), slug=slug)
+    if not book.file:
+        raise Http404
 
     try:
-        book = Book.obj_active.get(slug=slug)
-    except ObjectDoesNotExist:
-        book = None
+        if not book.file_hash:
+            ''' FILES STORED BEFORE THE HASH WAS KEPT '''
+            book.file_hash = downloads.content_hash(book.file)
+            book.file.close()
+            Book.objects.filter(id=book.id).update(file_hash=book.file_hash)
 
-    return render_to_response('details.html',
-                              {'book': book})
+        return downloads.serve(request, book.file, book.file_hash,
+                               book.slug + os.path.splitext(book.file.name)[1])
+    except (IOError, OSError):
+        raise Http404
 
 
 class BookListView(ListView):
     model = HistoryItem
     template_name = 'book_list.html'
     context_object_name = 'books'
+    paginate_by = 20
 
     def get_queryset(self):
         if self.request.user.is_authenticated():
-            return super().get_queryset().filter(reader=self.request.user)
+            return super().get_queryset().filter(
+                reader=self.request.user).select_related(
+                'book_item__book__author', 'book_item__book__publisher')
         else:
-            return EmptyQuerySet
+            return self.model.objects.none()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        total_fine = 0
-        if self.get_queryset() != EmptyQuerySet:
-            for item in self.get_queryset():
-                if item.fine > 0 and not item.is_fine_paid:
-                    total_fine = total_fine + item.fine
-            context['total_fine'] = total_fine
+        if self.request.user.is_authenticated():
+            context['account'] = HistoryItem.objects.account_summary(
+                self.request.user)
+            context['total_fine'] = context['account']['fine_owed']
         return context